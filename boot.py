@@ -0,0 +1,11 @@
+# boot.py
+#
+# Runs once before code.py. Names the USB device so host tools can find
+# Trkey pads among other serial ports (pc_companion daemon mode matches
+# "Trkey" in the product/manufacturer strings).
+import supervisor
+
+try:
+    supervisor.set_usb_identification(manufacturer="Trkey", product="Trkey Macropad")
+except (AttributeError, RuntimeError):
+    pass  # CircuitPython before 8.x, or USB already enumerated
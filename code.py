@@ -10,6 +10,12 @@ import digitalio
 import usb_hid
 import usb_cdc
 import os
+import struct
+
+try:
+    import alarm
+except ImportError:
+    alarm = None  # no light sleep on this port
 
 from adafruit_hid.keyboard import Keyboard
 from adafruit_hid.keycode import Keycode
@@ -17,37 +23,121 @@ from adafruit_hid.consumer_control import ConsumerControl
 from adafruit_hid.consumer_control_code import ConsumerControlCode
 from adafruit_hid.keyboard_layout_us import KeyboardLayoutUS
 
+from hid_queue import HIDQueue
+from cdc_transport import CDCTransport
+from framed_upload import FramedUpload
+import binproto
+import keymap_cache
+import macro_compiler
+import ztransfer
+from layer_store import LayerStore
+from key_scanner import KeyScanner
+from debounce import Debouncer
+from chords import ChordEngine
+from tap_hold import TapHoldResolver
+from loop_stats import LoopStats
+
 # === Globals / Config ===
 WIDTH, HEIGHT = 128, 64
-DEBOUNCE_TIME = 0.1
+DEBOUNCE_MS = 5           # default settle time per key (override in layers.json "debounce")
+DEBOUNCE_MODE = "eager"   # "eager" (report first edge) or "deferred" (report once stable)
 PRESS_DISPLAY_TIME = 0.3
 REPEAT_DELAY = 0.4   # seconds before repeat starts
 REPEAT_RATE = 0.05   # seconds between repeats
+KEY_HOLD_TIME = 0.05    # seconds a combo/single key is held before release
+MACRO_KEY_DELAY = 0.01  # seconds between macro reports (override with "typing_rate" in layers.json)
+HID_QUEUE_DEPTH = 32    # max pending HID actions (a text macro is one slot)
+SCAN_INTERVAL = 0.002   # main loop period in seconds (500 Hz scan rate)
+CHORD_TERM_MS = 50      # default window for chord keys (override in layers.json "chord_term")
+TAPPING_TERM_MS = 200   # LT()/MT() held this long is a hold (override in layers.json "tap_hold")
+QUICK_TAP_MS = 150      # LT()/MT() pressed again this soon after a tap repeats the tap
+KEY_REPORT_SLOTS = 6    # non-modifier keys per keyboard report (boot protocol 6KRO)
+USE_KEYPAD = True       # use the keypad.Keys background scanner when available
+DISPLAY_MAX_FPS = 20    # display refreshes per second at most (override in layers.json "display_fps")
+I2C_FREQUENCY = 400000  # display bus clock in Hz (the SSD1306 supports fast mode)
+
+# Power management (override in layers.json "power"; times are seconds without input, 0 = never)
+IDLE_AFTER = 5.0          # the loop period doubles after each IDLE_AFTER without input ...
+IDLE_MAX_INTERVAL = 0.02  # ... up to this (keypad queues key events in the background meanwhile)
+POLLED_MAX_INTERVAL = 0.01  # cap with the digitalio fallback, where a tap shorter than a pass is lost
+DIM_AFTER = 30.0          # OLED dimmed to DIM_BRIGHTNESS
+DIM_BRIGHTNESS = 0.05
+BLANK_AFTER = 120.0       # OLED switched off
+SLEEP_AFTER = 600.0       # light sleep until a key or the layer button is pressed
+SLEEP_WAKE_INTERVAL = 1.0  # seconds between checks for CDC traffic while asleep
+WAKE_HOLD = 0.05          # the key that woke the board reads as down at least this long
 
 last_press_time = 0
 pressed_index = None
 
 # Layers
-current_layer = 0
+current_layer = 0  # highest active layer: shown on the OLED, selects chords
 default_layer = 0
-layers = []
+layer_state = 0    # bit n set while layer n is active on top of default_layer (MO/TO/TT/LT)
+layer_names = {}   # lower-cased layer name -> index, for MODE <name>
+layers = LayerStore()  # sequence of layer dicts, materialised on demand
 grid_size = 3
 physical_layout = []
 macros = {}  # id -> sequence (string)
+macro_cache = {}  # id -> compiled macro (see compile_macro), rebuilt whenever layers load
+config_extra = None  # other top-level layers.json fields; None while the ERROR layer is shown
+LAYERS_CACHE = "layers.bin"  # compiled keymap, valid while layers.json size+crc32 match
+LAYERS_RESIDENT = 3  # layers kept materialised in RAM (active + recently used)
+
+# PATCH edits are applied in RAM and written back to layers.json lazily
+PATCH_FLUSH_DELAY = 2.0  # seconds without further PATCHes before saving
+layers_dirty = False
+last_patch_time = 0.0
+
+# Compiled action kinds (see compile_key_entry)
+ACT_NONE = 0
+ACT_KEYS = 1      # (ACT_KEYS, (Keycode, ...))
+ACT_CONSUMER = 2  # (ACT_CONSUMER, ConsumerControlCode)
+ACT_MACRO = 3     # (ACT_MACRO, macro_id)
+ACT_APP = 4       # (ACT_APP, "APP_...")
+ACT_LAYER = 5     # (ACT_LAYER, "MO"|"TO"|"TT"|"DF", target)
+ACT_CANCEL = 6    # (ACT_CANCEL,) stop running/queued macros
+ACT_TAPHOLD = 7   # (ACT_TAPHOLD, "LT"|"MT", layer|modifier bits, *tap action)
+ACT_TRNS = 8      # (ACT_TRNS,) falls through to the next active layer below
+MACRO_TAG = "macro"  # hid_queue tag for everything a macro emits
+NOOP_ACTION = (ACT_NONE,)
+KEYMAP_COMPILER = 1  # bump when compiled actions/macros change: layers.bin caches from older firmware are rebuilt
+TRNS_NAMES = ("TRNS", "KC_TRNS", "_______")
+
+# Effective keymap of the active layer stack, rebuilt by set_layer_state()
+effective_actions = [NOOP_ACTION] * 9
+effective_labels = [""] * 9
+effective_th_mask = 0  # keys that resolve to LT()/MT()
+
+# Action each key was pressed with, used for its repeats and release
+key_press_action = [NOOP_ACTION] * 9
 
 # Repeat tracking
 repeat_active = [False] * 9
 repeat_start = [0] * 9
 repeat_last = [0] * 9
 
+# Plain key presses of one scan, merged into as few reports as possible
+key_batch = []
+
+# Chords from layers.json "chords" (see apply_chord_config)
+chord_actions = []  # chord index -> compiled action
+chord_keys = []     # chord index -> lowest key index (MO() bookkeeping, UI highlight)
+
+# Tap-hold keys resolved as hold: the action they were pressed with (per key)
+th_hold_action = [None] * 9
+th_mods = [0] * 9  # modifier bits each MT() hold adds
+
 # Momentary layer tracking (per key)
-mo_active = [False] * 9
-mo_prev_layer = [0] * 9
-mo_target_for_key = [None] * 9  # if this key is MO(x), store x
+mo_target_for_key = [None] * 9  # while this MO(x) key is held, x
 
 # === USB CDC State ===
 uart = usb_cdc.console
-cdc_buffer = b""
+cdc = CDCTransport(uart)
+EOF_MARKER = b"<EOF>"
+upload = FramedUpload(cdc, root="/")  # PUTF/PUTR framed transfers
+binary_mode = False  # set by `PROTO BIN`, see lib/binproto.py
+bin_files = binproto.BinaryFileOps(cdc, root="/")
 receiving_file = False
 file = None
 filename = ""
@@ -64,6 +154,13 @@ now_playing = {
     "duration": 0,
     "source": "",
 }
+# Position is interpolated locally from an anchor (NP_SET / NP_POS / NP_PLAYSTATE),
+# so the companion only has to send changes, not a position every second.
+np_playing = False
+np_anchor_pos = 0.0   # seconds into the track at np_anchor_time
+np_anchor_time = 0.0  # time.monotonic() of the last anchor
+np_shown_second = -1  # whole second currently on the time line
+NP_TEXT_FIELDS = {"NP_TITLE": "title", "NP_ARTIST": "artist", "NP_SOURCE": "source"}
 
 # === Known consumer/media codes ===
 consumer_map = {
@@ -79,7 +176,7 @@ consumer_map = {
 
 # === I2C Display ===
 displayio.release_displays()
-i2c = busio.I2C(board.GP17, board.GP16)
+i2c = busio.I2C(board.GP17, board.GP16, frequency=I2C_FREQUENCY)
 while not i2c.try_lock():
     pass
 while 0x3C not in i2c.scan():
@@ -89,6 +186,7 @@ i2c.unlock()
 
 display_bus = displayio.I2CDisplay(i2c, device_address=0x3C)
 display = SSD1306(display_bus, width=WIDTH, height=HEIGHT)
+display.auto_refresh = False  # refreshed by flush_ui() in loop slack
 splash = displayio.Group()
 display.root_group = splash
 
@@ -96,6 +194,13 @@ display.root_group = splash
 kbd = Keyboard(usb_hid.devices)
 consumer_control = ConsumerControl(usb_hid.devices)
 kbd_layout = KeyboardLayoutUS(kbd)
+hid_queue = HIDQueue(
+    kbd,
+    consumer=consumer_control,
+    depth=HID_QUEUE_DEPTH,
+    hold_time=KEY_HOLD_TIME,
+    key_delay=MACRO_KEY_DELAY,
+)
 
 # === Buttons ===
 button_pins = [
@@ -103,19 +208,80 @@ button_pins = [
     board.GP5, board.GP6, board.GP7,
     board.GP8, board.GP9, board.GP10
 ]
-buttons = []
-button_times = []
-for pin in button_pins:
-    btn = digitalio.DigitalInOut(pin)
-    btn.direction = digitalio.Direction.INPUT
-    btn.pull = digitalio.Pull.UP
-    buttons.append(btn)
-    button_times.append(0)
-
-layer_switch_btn = digitalio.DigitalInOut(board.GP15)
-layer_switch_btn.direction = digitalio.Direction.INPUT
-layer_switch_btn.pull = digitalio.Pull.UP
-last_layer_switch_state = True
+
+# Keys are bits 0..8 of the scan mask, the layer-cycle button on GP15 is bit 9
+KEY_MASK = (1 << len(button_pins)) - 1
+LAYER_BUTTON = len(button_pins)
+LAYER_BUTTON_BIT = 1 << LAYER_BUTTON
+key_pins = button_pins + [board.GP15]
+scanner = KeyScanner(key_pins, use_keypad=USE_KEYPAD, interval=SCAN_INTERVAL)
+debouncer = Debouncer(LAYER_BUTTON + 1, settle_ms=DEBOUNCE_MS, eager=DEBOUNCE_MODE != "deferred")
+chords = ChordEngine(CHORD_TERM_MS)
+tap_hold = TapHoldResolver(TAPPING_TERM_MS, QUICK_TAP_MS)
+
+def apply_debounce_config():
+    """
+    Apply the optional "debounce" block from layers.json, e.g.
+    {"mode": "eager", "ms": 5, "keys": {"4": {"mode": "deferred", "ms": 20}, "layer": 30}}
+    Per-key entries are a settle time in ms or an object with mode/ms.
+    """
+    cfg = (config_extra or {}).get("debounce") or {}
+    mode = cfg.get("mode", DEBOUNCE_MODE)
+    ms = cfg.get("ms", DEBOUNCE_MS)
+    for i in range(LAYER_BUTTON + 1):
+        debouncer.configure(i, ms, mode != "deferred")
+    per_key = cfg.get("keys") or {}
+    for k in per_key:
+        try:
+            idx = LAYER_BUTTON if k == "layer" else int(k)
+        except ValueError:
+            continue
+        if not 0 <= idx <= LAYER_BUTTON:
+            continue
+        entry = per_key[k]
+        if isinstance(entry, dict):
+            debouncer.configure(idx, entry.get("ms", ms), entry.get("mode", mode) != "deferred")
+        else:
+            debouncer.configure(idx, entry, mode != "deferred")
+
+def apply_chord_config():
+    """
+    Apply the optional "chords" list from layers.json, e.g.
+    [{"keys": [0, 1], "action": "ESCAPE"}, {"keys": [3, 4, 5], "action": "MACRO_1", "layer": 2}]
+    An action is any keys[] entry; "layer" limits a chord to one layer.
+    "chord_term" sets the window in ms within which the keys must go down.
+    """
+    cfg = config_extra or {}
+    specs = []
+    del chord_actions[:]
+    del chord_keys[:]
+    for entry in cfg.get("chords") or []:
+        try:
+            idx = sorted(set(int(k) for k in entry["keys"]))
+            layer = entry.get("layer")
+            layer = None if layer is None else int(layer)
+        except Exception as e:
+            print("Bad chord entry:", e)
+            continue
+        if len(idx) < 2 or idx[0] < 0 or idx[-1] >= LAYER_BUTTON:
+            print(f"Ignoring chord {idx}: needs 2+ key indices 0-{LAYER_BUTTON - 1}")
+            continue
+        mask = 0
+        for k in idx:
+            mask |= 1 << k
+        specs.append((mask, layer))
+        chord_actions.append(compile_key_entry(entry.get("action", "")))
+        chord_keys.append(idx[0])
+    chords.configure(specs, cfg.get("chord_term", CHORD_TERM_MS))
+
+def apply_tap_hold_config():
+    """
+    Apply the optional "tap_hold" block from layers.json, e.g.
+    {"term": 200, "quick_tap": 150, "permissive": true}
+    """
+    cfg = (config_extra or {}).get("tap_hold") or {}
+    tap_hold.configure(cfg.get("term", TAPPING_TERM_MS), cfg.get("quick_tap", QUICK_TAP_MS),
+                       bool(cfg.get("permissive", True)))
 
 # === UI ===
 key_labels = []
@@ -127,6 +293,34 @@ np_line_1 = None
 np_line_2 = None
 np_line_3 = None
 
+# Retained-mode render cache: slot -> last text/color written to the label
+UI_SLOT_TITLE = 0
+UI_SLOT_KEYS = 1   # 9 key cells: slots 1..9
+UI_SLOT_NP = 10    # now-playing title + 3 lines: slots 10..13
+UI_SLOT_COUNT = 14
+ui_slot_labels = [None] * UI_SLOT_COUNT
+ui_text_cache = [None] * UI_SLOT_COUNT
+ui_color_cache = [None] * UI_SLOT_COUNT
+ui_view = None  # "layer" | "np" | None (unknown)
+
+# Deferred rendering: update_ui() only records the wanted view, flush_ui() draws it
+ui_dirty = False
+ui_want_layer = 0
+ui_want_pressed = None
+ui_frame_time = 1.0 / DISPLAY_MAX_FPS
+ui_next_flush = 0.0   # earliest time of the next refresh
+ui_flush_cost = 0.0   # seconds the last refresh took (smoothed)
+
+# Render counters (see ui_stats_line)
+ui_label_mutations = 0
+ui_refreshes = 0
+ui_requests = 0
+ui_stats_since = 0.0
+
+# Main loop timing histograms and scan-to-report latency (see STATS)
+stats = LoopStats()
+pending_edge_ns = 0  # scan time of the last press edge not yet reported over HID
+
 app_action_fallback = {
     "APP_PLAY_PAUSE": "PLAY_PAUSE",
     "APP_NEXT": "SCAN_NEXT_TRACK",
@@ -152,45 +346,111 @@ def _truncate(text, length):
     return text[: max(0, length - 1)] + "…"
 
 
+def np_position(now=None):
+    """Playback position in seconds, advanced from the anchor while playing."""
+    pos = np_anchor_pos
+    if np_playing:
+        if now is None:
+            now = time.monotonic()
+        pos += now - np_anchor_time
+    dur = now_playing["duration"]
+    if dur and pos > dur:
+        pos = dur
+    return pos
+
+
 def should_show_now_playing(now=None):
     if not show_now_playing:
         return False
     if now is None:
         now = time.monotonic()
-    return (now - last_now_playing_update) <= SHOW_NOW_PLAYING_TIMEOUT
+    last = last_now_playing_update
+    if np_playing and now_playing["duration"]:
+        # quiet companion is fine while the track is still playing out
+        last = max(last, np_anchor_time + now_playing["duration"] - np_anchor_pos)
+    return (now - last) <= SHOW_NOW_PLAYING_TIMEOUT
+
+
+def _set_label(slot, text, color=None):
+    """Write text/color to a label only if it differs from what is already shown."""
+    global ui_label_mutations
+    lbl = ui_slot_labels[slot]
+    changed = 0
+    if ui_text_cache[slot] != text:
+        lbl.text = text
+        ui_text_cache[slot] = text
+        changed += 1
+    if color is not None and ui_color_cache[slot] != color:
+        lbl.color = color
+        ui_color_cache[slot] = color
+        changed += 1
+    ui_label_mutations += changed
+    return changed
+
+
+def _show_view(view):
+    global ui_view
+    if ui_view == view:
+        return 0
+    layer_group.hidden = view != "layer"
+    now_playing_group.hidden = view != "np"
+    ui_view = view
+    return 1
 
 
 def render_layer_view(layer_index, pressed_idx=None):
-    now_playing_group.hidden = True
-    layer_group.hidden = False
+    changed = _show_view("layer")
 
     lyr = layers[layer_index]
-    title_label.text = f"Layer: {lyr.get('name','?')} ({layer_index+1}/{len(layers)})"
-    labels = lyr.get("labels", [])
+    changed += _set_label(UI_SLOT_TITLE, f"Layer: {lyr.get('name','?')} ({layer_index+1}/{len(layers)})")
+    # the active stack shows what each key does, transparent keys included
+    labels = effective_labels if layer_index == current_layer else lyr.get("labels", [])
     for i in range(9):
         lbl_text = safe_get(labels, i, "")
         txt = f"[{(lbl_text[:5]).center(5) if lbl_text else '     '}]"
-        key_labels[i].text = txt
-        key_labels[i].color = 0x00FF00 if i == pressed_idx else 0xFFFFFF
+        changed += _set_label(UI_SLOT_KEYS + i, txt, 0x00FF00 if i == pressed_idx else 0xFFFFFF)
+    return changed
 
 
 def render_now_playing_view():
-    layer_group.hidden = True
-    now_playing_group.hidden = False
+    changed = _show_view("np")
+
+    changed += _set_label(UI_SLOT_NP, "Now Playing (Beta)")
+    changed += _set_label(UI_SLOT_NP + 1, _truncate(now_playing.get("title", "No track"), 20))
+    changed += _set_label(UI_SLOT_NP + 2, _truncate(now_playing.get("artist", "Unknown artist"), 20))
+    return changed + render_np_time()
 
-    np_title_label.text = "Now Playing (Beta)"
-    np_line_1.text = _truncate(now_playing.get("title", "No track"), 20)
-    np_line_2.text = _truncate(now_playing.get("artist", "Unknown artist"), 20)
 
-    pos = _fmt_seconds(now_playing.get("position", 0))
+def render_np_time(now=None):
+    """Only the time line; called about once a second while playing."""
+    global np_shown_second
+    np_shown_second = int(np_position(now))
+    pos = _fmt_seconds(np_shown_second)
     dur = _fmt_seconds(now_playing.get("duration", 0))
     src = _truncate(now_playing.get("source", ""), 8)
-    np_line_3.text = _truncate(f"{pos}/{dur} {src}".strip(), 20)
+    state = "" if np_playing else "|| "
+    return _set_label(UI_SLOT_NP + 3, _truncate(f"{state}{pos}/{dur} {src}".strip(), 20))
+
+
+def ui_stats_line(now=None, reset=False):
+    """Label mutations, display refreshes and redraw requests since the last reset."""
+    global ui_label_mutations, ui_refreshes, ui_requests, ui_stats_since
+    if now is None:
+        now = time.monotonic()
+    elapsed = max(now - ui_stats_since, 0.001)
+    line = f"UI_STATS mutations={ui_label_mutations} refreshes={ui_refreshes} refresh_rate={ui_refreshes / elapsed:.2f}/s requests={ui_requests} window={elapsed:.1f}s"
+    if reset:
+        ui_label_mutations = 0
+        ui_refreshes = 0
+        ui_requests = 0
+        ui_stats_since = now
+    return line
 
 def init_ui():
     global key_labels, title_label
     global layer_group, now_playing_group
     global np_title_label, np_line_1, np_line_2, np_line_3
+    global ui_view, ui_stats_since
     if len(splash):
         splash.pop()
 
@@ -225,6 +485,15 @@ def init_ui():
     splash.append(layer_group)
     splash.append(now_playing_group)
 
+    ui_slot_labels[UI_SLOT_TITLE] = title_label
+    ui_slot_labels[UI_SLOT_KEYS:UI_SLOT_KEYS + 9] = key_labels
+    ui_slot_labels[UI_SLOT_NP:UI_SLOT_NP + 4] = [np_title_label, np_line_1, np_line_2, np_line_3]
+    for slot in range(UI_SLOT_COUNT):
+        ui_text_cache[slot] = ui_slot_labels[slot].text
+        ui_color_cache[slot] = ui_slot_labels[slot].color
+    ui_view = None
+    ui_stats_since = time.monotonic()
+
 def safe_get(arr, idx, default=""):
     try:
         return arr[idx]
@@ -232,10 +501,231 @@ def safe_get(arr, idx, default=""):
         return default
 
 def update_ui(layer_index, pressed_idx=None):
-    if should_show_now_playing():
-        render_now_playing_view()
+    """Request a redraw; any number of requests between two flushes cost one refresh."""
+    global ui_dirty, ui_want_layer, ui_want_pressed, ui_requests
+    ui_want_layer = layer_index
+    ui_want_pressed = pressed_idx
+    ui_dirty = True
+    ui_requests += 1
+
+
+def apply_display_fps():
+    """Apply the optional "display_fps" from layers.json (max display refreshes per second)."""
+    global ui_frame_time
+    fps = (config_extra or {}).get("display_fps", DISPLAY_MAX_FPS)
+    if not isinstance(fps, (int, float)) or fps <= 0:
+        fps = DISPLAY_MAX_FPS
+    ui_frame_time = 1.0 / fps
+
+
+def ui_slack(now):
+    """
+    True when a refresh fits before anything time-critical: no CDC transfer
+    in progress, no undecided chord or tap-hold key and no HID report due
+    within the time a refresh takes.
+    """
+    if receiving_file or upload.active or chords.busy() or tap_hold.busy():
+        return False
+    slack = hid_queue.slack(now)
+    return slack is None or slack > ui_flush_cost
+
+
+def flush_ui(now):
+    """Render the requested view and refresh the display, at most once per ui_frame_time."""
+    global ui_dirty, ui_next_flush, ui_refreshes, ui_flush_cost
+    if not ui_dirty or now < ui_next_flush:
+        return False
+    started = time.monotonic_ns()
+    ui_dirty = False
+    if should_show_now_playing(now):
+        changed = render_now_playing_view()
+    else:
+        changed = render_layer_view(ui_want_layer, pressed_idx=ui_want_pressed)
+    if changed:
+        display.refresh()
+        ui_refreshes += 1
+        ui_next_flush = now + ui_frame_time
+        ui_flush_cost = (ui_flush_cost * 3 + (time.monotonic_ns() - started) / 1e9) / 4
+    stats.ui.mark(started)
+    return bool(changed)
+
+
+# === Power ===
+POWER_ACTIVE = 0
+POWER_IDLE = 1   # slower polling
+POWER_DIM = 2
+POWER_BLANK = 3
+POWER_SLEEP = 4
+POWER_NAMES = ("active", "idle", "dim", "blank", "sleep")
+power_state = POWER_ACTIVE
+power_since = 0.0          # time.monotonic() power_state was entered
+power_time = [0.0] * 5     # seconds spent in each state since power_stats_since
+power_stats_since = 0.0
+power_wakes = 0            # wakes from light sleep
+last_input_time = 0.0      # last key, CDC or HID activity
+last_display_time = 0.0    # ... or a playing now-playing view
+loop_interval = SCAN_INTERVAL
+wake_bits = 0              # key that woke the board, held in the scan mask until wake_until
+wake_until = 0.0
+
+# Active settings (see apply_power_config)
+power_idle_after = IDLE_AFTER
+power_max_interval = IDLE_MAX_INTERVAL
+power_dim_after = DIM_AFTER
+power_dim_brightness = DIM_BRIGHTNESS
+power_blank_after = BLANK_AFTER
+power_sleep_after = SLEEP_AFTER
+
+
+def _power_value(cfg, name, default):
+    value = cfg.get(name, default)
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+        return default
+    return value
+
+
+def apply_power_config():
+    """
+    Apply the optional "power" block from layers.json, e.g.
+    {"idle": 5, "max_interval_ms": 20, "dim": 30, "dim_brightness": 0.05, "blank": 120, "sleep": 600}
+    Times are seconds without input; 0 turns that stage off.
+    """
+    global power_idle_after, power_max_interval, power_dim_after
+    global power_dim_brightness, power_blank_after, power_sleep_after
+    cfg = (config_extra or {}).get("power")
+    if not isinstance(cfg, dict):
+        cfg = {}
+    power_idle_after = _power_value(cfg, "idle", IDLE_AFTER)
+    power_max_interval = max(SCAN_INTERVAL, _power_value(cfg, "max_interval_ms", IDLE_MAX_INTERVAL * 1000) / 1000)
+    if scanner.backend != "keypad":
+        power_max_interval = min(power_max_interval, POLLED_MAX_INTERVAL)
+    power_dim_after = _power_value(cfg, "dim", DIM_AFTER)
+    power_dim_brightness = min(1.0, _power_value(cfg, "dim_brightness", DIM_BRIGHTNESS))
+    power_blank_after = _power_value(cfg, "blank", BLANK_AFTER)
+    power_sleep_after = _power_value(cfg, "sleep", SLEEP_AFTER)
+
+
+def set_power_state(state, now):
+    """Switch power state, account the time spent in the old one and set the display to match."""
+    global power_state, power_since
+    if state == power_state:
+        return
+    prev = power_state
+    power_time[prev] += now - power_since
+    power_since = now
+    power_state = state
+    try:
+        if state >= POWER_BLANK:
+            if prev < POWER_BLANK:
+                display.sleep()
+        else:
+            if prev >= POWER_BLANK:
+                display.wake()
+            if (state == POWER_DIM) != (prev == POWER_DIM):
+                display.brightness = power_dim_brightness if state == POWER_DIM else 1.0
+    except (AttributeError, RuntimeError, ValueError) as e:
+        print("Display power error:", e)
+
+
+def can_sleep():
+    """Light sleep only with nothing in flight: no HID output, transfer or held key."""
+    return (
+        alarm is not None
+        and hid_queue.idle()
+        and not receiving_file
+        and not upload.active
+        and not scanner.pressed
+        and not chords.busy()
+        and not tap_hold.busy()
+    )
+
+
+def light_sleep(now):
+    """
+    Sleep until a key or the layer button is pressed, waking every
+    SLEEP_WAKE_INTERVAL to check for CDC traffic. The scanner releases its
+    pins for the pin alarms and is recreated afterwards; the key that woke
+    the board is held down in the scan mask for WAKE_HOLD, so the waking
+    press is typed like any other.
+    """
+    global scanner, power_wakes, power_sleep_after, wake_bits, wake_until
+    global last_input_time, last_display_time
+    flush_layers_if_due(now, force=True)
+    set_power_state(POWER_SLEEP, now)
+    scanner.deinit()
+    woke = None
+    try:
+        pin_alarms = [alarm.pin.PinAlarm(pin, value=False, pull=True) for pin in key_pins]
+        while True:
+            timer = alarm.time.TimeAlarm(monotonic_time=time.monotonic() + SLEEP_WAKE_INTERVAL)
+            woke = alarm.light_sleep_until_alarms(timer, *pin_alarms)
+            if isinstance(woke, alarm.pin.PinAlarm) or uart.in_waiting:
+                break
+    except Exception as e:
+        print("Light sleep failed, disabled:", e)
+        power_sleep_after = 0
+    scanner = KeyScanner(key_pins, use_keypad=USE_KEYPAD, interval=SCAN_INTERVAL)
+    now = time.monotonic()
+    if isinstance(woke, alarm.pin.PinAlarm):
+        for i, pin in enumerate(key_pins):
+            if pin == woke.pin:
+                wake_bits = 1 << i
+                wake_until = now + WAKE_HOLD
+    if woke is not None:
+        power_wakes += 1
+    last_input_time = last_display_time = now
+    set_power_state(POWER_ACTIVE, now)
+
+
+def update_power(now, busy):
+    """
+    Step through the power states on input activity (busy: keys down or
+    changing, CDC traffic or HID output this pass) and return the main loop
+    period for the next pass.
+    """
+    global last_input_time, last_display_time, loop_interval
+    if busy:
+        last_input_time = now
+    if busy or (show_now_playing and np_playing):
+        last_display_time = now
+    dark = now - last_display_time
+    if power_sleep_after and dark >= power_sleep_after and can_sleep():
+        light_sleep(now)
+        loop_interval = SCAN_INTERVAL
+        return loop_interval
+    idle = now - last_input_time
+    loop_interval = SCAN_INTERVAL
+    if power_idle_after and idle >= power_idle_after:
+        steps = min(int(idle / power_idle_after), 16)
+        loop_interval = min(SCAN_INTERVAL * (1 << steps), power_max_interval)
+    if power_blank_after and dark >= power_blank_after:
+        state = POWER_BLANK
+    elif power_dim_after and dark >= power_dim_after:
+        state = POWER_DIM
+    elif loop_interval > SCAN_INTERVAL:
+        state = POWER_IDLE
     else:
-        render_layer_view(layer_index, pressed_idx=pressed_idx)
+        state = POWER_ACTIVE
+    set_power_state(state, now)
+    return loop_interval
+
+
+def power_stats_line(now=None, reset=False):
+    """Seconds spent in each power state and wakes from sleep since the last reset."""
+    global power_since, power_wakes, power_stats_since
+    if now is None:
+        now = time.monotonic()
+    spent = list(power_time)
+    spent[power_state] += now - power_since
+    parts = " ".join(f"{POWER_NAMES[n]}={spent[n]:.1f}s" for n in range(len(POWER_NAMES)))
+    line = f"POWER state={POWER_NAMES[power_state]} {parts} wakes={power_wakes} interval={loop_interval * 1000:.0f}ms window={now - power_stats_since:.1f}s"
+    if reset:
+        for n in range(len(power_time)):
+            power_time[n] = 0.0
+        power_since = now
+        power_wakes = 0
+        power_stats_since = now
+    return line
 
 # === JSON / Layers loader (per spec) ===
 def normalize_keys_or_labels(arr, target_len):
@@ -248,69 +738,322 @@ def normalize_keys_or_labels(arr, target_len):
         arr = arr[:target_len]
     return arr
 
-def load_layers():
-    global layers, grid_size, physical_layout, macros, default_layer, current_layer
+def write_layers_cache(src_key):
+    """Write LAYERS_CACHE and switch `layers` to a lazy store over it. Returns False on failure."""
+    extra = {"physical_layout": physical_layout}
+    for k in config_extra:
+        extra[k] = config_extra[k]
     try:
-        with open("layers.json", "r") as f:
-            data = json.load(f)
-
-        if not isinstance(data, dict) or "layers" not in data:
-            raise ValueError("layers.json must be an object with a 'layers' array")
-
-        grid_size_in = data.get("grid_size", 3)
-        # We keep hardware as 3x3, but use grid_size to validate/pad data
-        if not isinstance(grid_size_in, int) or grid_size_in < 2 or grid_size_in > 5:
-            grid_size_in = 3
-        grid_size = grid_size_in
-
-        physical_layout = data.get("physical_layout", [])
-        raw_layers = data["layers"]
-        if not isinstance(raw_layers, list) or not raw_layers:
-            raise ValueError("layers[] is empty")
+        keymap_cache.write(LAYERS_CACHE, src_key, grid_size, layers, macros, macro_cache, json.dumps(extra))
+    except Exception as e:
+        print("Could not write layers cache:", e)
+        return False
+    return load_layers_cache(src_key)
 
-        target_len = grid_size * grid_size
+def load_layers_cache(src_key):
+    """Index the compiled keymap in LAYERS_CACHE; returns False if it is missing or stale."""
+    global layers, grid_size, physical_layout, macros, macro_cache, config_extra
+    try:
+        cached = keymap_cache.open_index(LAYERS_CACHE, src_key)
+    except Exception as e:
+        print("Ignoring unreadable layers cache:", e)
+        return False
+    if not cached:
+        return False
+    grid_size, macros, macro_cache, extra_json, spans, names = cached
+    layers = LayerStore(LAYERS_CACHE, spans, names, resident=LAYERS_RESIDENT)
+    extra = json.loads(extra_json) if extra_json else {}
+    physical_layout = extra.pop("physical_layout", [])
+    config_extra = extra
+    return True
 
-        # Build layers with normalized keys/labels
-        built_layers = []
-        for lyr in raw_layers:
-            if not isinstance(lyr, dict):
-                continue
-            name = lyr.get("name", "Layer")
-            labels = normalize_keys_or_labels(lyr.get("labels", []), target_len)
-            keys = normalize_keys_or_labels(lyr.get("keys", []), target_len)
-            built_layers.append({"name": name, "labels": labels, "keys": keys, "macros": lyr.get("macros", [])})
-
-        if not built_layers:
-            raise ValueError("No valid layer entries parsed")
-
-        layers = built_layers
-
-        # Load macros from layer 0 (by spec, UI manages them there)
-        macros = {}
-        if layers and isinstance(layers[0].get("macros", []), list):
-            for m in layers[0]["macros"]:
-                try:
-                    mid = int(m["id"])
-                    macros[mid] = str(m.get("sequence", ""))
-                except Exception:
-                    pass
+def load_layers():
+    global layers, grid_size, physical_layout, macros, default_layer
+    global config_extra, layers_dirty
+    started = time.monotonic()
+    try:
+        src_key = keymap_cache.source_key("layers.json", KEYMAP_COMPILER)
+        if load_layers_cache(src_key):
+            source = "cache"
+        else:
+            load_layers_json()
+            compile_macros()
+            source = "json" if write_layers_cache(src_key) else "json, all resident"
+        layers_dirty = False
 
         # Reset layer indices safely
         default_layer = 0 if default_layer >= len(layers) else default_layer
-        current_layer = 0 if current_layer >= len(layers) else current_layer
 
-        print(f"Loaded layers.json: layers={len(layers)} grid={grid_size} keys_per_layer={grid_size*grid_size}")
+        elapsed_ms = (time.monotonic() - started) * 1000
+        print(f"Loaded layers.json ({source}, {elapsed_ms:.0f} ms): layers={len(layers)} grid={grid_size} keys_per_layer={grid_size*grid_size}")
     except Exception as e:
         print("Failed to load layers.json:", e)
         # Safe fallback: 1 error layer visible on UI
-        layers = [{
+        layers = LayerStore.from_list([{
             "name": "ERROR",
             "keys": [""] * 9,
             "labels": ["ERR"] * 9,
-            "macros": []
-        }]
+            "macros": [],
+            "actions": [NOOP_ACTION] * 9,
+        }])
         default_layer = 0
-        current_layer = 0
+        config_extra = None
+        layers_dirty = False
+    index_layer_names()
+    set_layer_state(layer_state)
+    apply_debounce_config()
+    apply_chord_config()
+    apply_tap_hold_config()
+    apply_typing_rate()
+    apply_display_fps()
+    apply_power_config()
+
+def compile_macros():
+    """Compile every macro once; the results are stored in LAYERS_CACHE with the keymap."""
+    macro_cache.clear()
+    for mid in macros:
+        macro_cache[mid] = compile_macro(macros[mid])
+
+def apply_typing_rate():
+    """
+    Apply the optional "typing_rate" from layers.json: characters per
+    second with a release between each (runs that can roll over type up
+    to twice as fast); 0 sends a report every pass.
+    """
+    rate = (config_extra or {}).get("typing_rate")
+    if isinstance(rate, (int, float)) and rate >= 0:
+        hid_queue.key_delay = 0.5 / rate if rate else 0.0
+    else:
+        hid_queue.key_delay = MACRO_KEY_DELAY
+
+def load_layers_json():
+    """Parse, normalise and compile layers.json. Raises on invalid input."""
+    global layers, grid_size, physical_layout, macros, config_extra
+    with open("layers.json", "r") as f:
+        data = json.load(f)
+
+    if not isinstance(data, dict) or "layers" not in data:
+        raise ValueError("layers.json must be an object with a 'layers' array")
+
+    grid_size_in = data.get("grid_size", 3)
+    # We keep hardware as 3x3, but use grid_size to validate/pad data
+    if not isinstance(grid_size_in, int) or grid_size_in < 2 or grid_size_in > 5:
+        grid_size_in = 3
+    grid_size = grid_size_in
+
+    physical_layout = data.get("physical_layout", [])
+    raw_layers = data["layers"]
+    if not isinstance(raw_layers, list) or not raw_layers:
+        raise ValueError("layers[] is empty")
+
+    target_len = grid_size * grid_size
+
+    # Build layers with normalized keys/labels
+    built_layers = []
+    for lyr in raw_layers:
+        if not isinstance(lyr, dict):
+            continue
+        name = lyr.get("name", "Layer")
+        labels = normalize_keys_or_labels(lyr.get("labels", []), target_len)
+        keys = normalize_keys_or_labels(lyr.get("keys", []), target_len)
+        built_layers.append({"name": name, "labels": labels, "keys": keys, "macros": lyr.get("macros", [])})
+
+    if not built_layers:
+        raise ValueError("No valid layer entries parsed")
+
+    layers = LayerStore.from_list(built_layers)
+
+    # Load macros from layer 0 (by spec, UI manages them there)
+    macros = {}
+    if layers and isinstance(layers[0].get("macros", []), list):
+        for m in layers[0]["macros"]:
+            try:
+                mid = int(m["id"])
+                macros[mid] = str(m.get("sequence", ""))
+            except Exception:
+                pass
+
+    # Resolve every key string once so the scan loop only dispatches
+    for lyr in layers:
+        lyr["actions"] = [compile_key_entry(k) for k in lyr["keys"]]
+
+    config_extra = {}
+    for k in data:
+        if k not in ("grid_size", "physical_layout", "layers"):
+            config_extra[k] = data[k]
+
+def save_layers():
+    """Write the keymap back to layers.json (via a temp file), one layer at a time."""
+    global layers_dirty
+    with open("/layers.json.tmp", "w") as f:
+        f.write('{"grid_size": %d' % grid_size)
+        if physical_layout:
+            f.write(', "physical_layout": ' + json.dumps(physical_layout))
+        for k in config_extra:
+            f.write(", " + json.dumps(k) + ": " + json.dumps(config_extra[k]))
+        f.write(', "layers": [')
+        for i in range(len(layers)):
+            lyr = layers[i]
+            out = {"name": lyr["name"], "labels": lyr["labels"], "keys": lyr["keys"]}
+            if lyr.get("macros"):
+                out["macros"] = lyr["macros"]
+            f.write((", " if i else "") + json.dumps(out))
+        f.write("]}")
+    try:
+        os.remove("/layers.json")
+    except OSError:
+        pass
+    os.rename("/layers.json.tmp", "/layers.json")
+    layers_dirty = False
+    write_layers_cache(keymap_cache.source_key("layers.json", KEYMAP_COMPILER))
+    print("Saved layers.json")
+
+def flush_layers_if_due(now, force=False):
+    if not layers_dirty:
+        return
+    if force or (now - last_patch_time) >= PATCH_FLUSH_DELAY:
+        try:
+            save_layers()
+        except Exception as e:
+            print("Failed to save layers.json:", e)
+
+def _patch_value(text):
+    """PATCH values are raw text, or a JSON string literal for spaces/newlines."""
+    text = text.strip()
+    if text.startswith('"'):
+        return str(json.loads(text))
+    return text
+
+def apply_patch(args):
+    """
+    PATCH KEY <layer> <index> <value>
+    PATCH LABEL <layer> <index> <value>
+    PATCH NAME <layer> <value>
+    PATCH MACRO <id> <value>
+    Updates the in-memory keymap only; returns the layer index touched (or None).
+    """
+    global layers_dirty, last_patch_time
+    if config_extra is None:
+        raise ValueError("no layers.json loaded")
+    parts = args.strip().split(" ", 1)
+    what = parts[0].upper()
+    rest = parts[1] if len(parts) > 1 else ""
+    touched = None
+
+    if what in ("KEY", "LABEL"):
+        li, ki, value = rest.split(" ", 2)
+        li, ki = int(li), int(ki)
+        lyr = layers[li]
+        if not 0 <= ki < len(lyr["keys"]):
+            raise ValueError("key index out of range")
+        value = _patch_value(value)
+        layers.pin(li)
+        if what == "KEY":
+            lyr["keys"][ki] = value
+            lyr["actions"][ki] = compile_key_entry(value)
+        else:
+            lyr["labels"][ki] = value
+        touched = li
+    elif what == "NAME":
+        li, value = rest.split(" ", 1)
+        li = int(li)
+        layers.pin(li)
+        layers.set_name(li, _patch_value(value))
+        index_layer_names()
+        touched = li
+    elif what == "MACRO":
+        mid, value = rest.split(" ", 1)
+        mid = int(mid)
+        seq = _patch_value(value)
+        macros[mid] = seq
+        macro_cache[mid] = compile_macro(seq)
+        layers.pin(0)
+        entries = layers[0].get("macros")
+        if not isinstance(entries, list):
+            entries = []
+            layers[0]["macros"] = entries
+        for m in entries:
+            if isinstance(m, dict) and str(m.get("id")) == str(mid):
+                m["sequence"] = seq
+                break
+        else:
+            entries.append({"id": mid, "name": f"Macro {mid}", "sequence": seq})
+    else:
+        raise ValueError("PATCH expects KEY, LABEL, NAME or MACRO")
+
+    layers_dirty = True
+    last_patch_time = time.monotonic()
+    return touched
+
+# === Layer state ===
+def set_layer_state(state):
+    """
+    Activate the layers set in `state` (bit n = layer n) on top of
+    default_layer and rebuild the effective keymap: each key takes the
+    action of the highest active layer that is not TRNS there, so a key
+    press is one lookup however many layers are stacked.
+    """
+    global layer_state, current_layer, effective_actions, effective_labels, effective_th_mask
+    state &= (1 << len(layers)) - 1
+    stack = state | (1 << default_layer)
+    top = len(layers) - 1
+    while not stack >> top & 1:
+        top -= 1
+    count = grid_size * grid_size
+    actions = [NOOP_ACTION] * count
+    labels = [""] * count
+    unresolved = (1 << count) - 1
+    li = top
+    while unresolved and li >= 0:
+        if stack >> li & 1:
+            lyr = layers[li]
+            acts = lyr["actions"]
+            lbls = lyr.get("labels", [])
+            for k in range(min(count, len(acts))):
+                bit = 1 << k
+                if unresolved & bit and acts[k][0] != ACT_TRNS:
+                    actions[k] = acts[k]
+                    labels[k] = safe_get(lbls, k, "")
+                    unresolved &= ~bit
+        li -= 1
+    th_mask = 0
+    for k in range(count):
+        if actions[k][0] == ACT_TAPHOLD:
+            th_mask |= 1 << k
+    layer_state = state
+    current_layer = top
+    effective_actions = actions
+    effective_labels = labels
+    effective_th_mask = th_mask
+    update_ui(current_layer)
+
+def layer_active(idx):
+    """True if layer idx is part of the active stack."""
+    return bool((layer_state | (1 << default_layer)) >> idx & 1)
+
+def index_layer_names():
+    layer_names.clear()
+    for i in range(len(layers)):
+        layer_names.setdefault(str(layers.names[i]).lower(), i)
+
+def find_layer(query):
+    """
+    Layer index for MODE: a 1-based number, a layer name in any case or
+    part of one (the first layer containing it). None if nothing matches.
+    """
+    q = query.strip().lower()
+    if not q:
+        return None
+    if q.isdigit():
+        idx = int(q)
+        idx = idx - 1 if idx >= 1 else idx
+        return idx if idx < len(layers) else None
+    idx = layer_names.get(q)
+    if idx is None:
+        for i in range(len(layers)):
+            if q in str(layers.names[i]).lower():
+                return i
+    return idx
 
 # === Key utilities ===
 def _to_keycode(name):
@@ -353,6 +1096,23 @@ def parse_combo_name(name):
 def is_noop(val):
     return (val is None) or (val == "") or (val == "NO_OP")
 
+def parse_tap_hold(name):
+    """
+    Detect LT(layer,key) and MT(mod,key) and return (fn, arg, key) as
+    strings, or None. key is any keys[] entry; mod is a modifier combo name
+    like CONTROL or CONTROL_SHIFT.
+    """
+    if not isinstance(name, str) or "(" not in name or not name.endswith(")"):
+        return None
+    prefix = name.split("(")[0].strip().upper()
+    if prefix not in ("LT", "MT"):
+        return None
+    inside = name[name.index("(") + 1 : -1]
+    if "," not in inside:
+        return None
+    arg, key = inside.split(",", 1)
+    return (prefix, arg.strip(), key.strip())
+
 def parse_layer_fn(name):
     """
     Detect layer switching functions and return (fn, target:int) or (None, None).
@@ -371,24 +1131,53 @@ def parse_layer_fn(name):
     return (None, None)
 
 # === Sending actions ===
-def send_combo(kc_tuple, hold_time=0.05):
+def send_combo(kc_tuple, hold_time=None, tag=None):
+    """Queue a press of all keycodes, released after hold_time (non-blocking)."""
     if not kc_tuple:
         return
-    try:
-        # press all
-        for k in kc_tuple:
-            kbd.press(k)
-        time.sleep(hold_time)
-        # release all
-        for k in kc_tuple:
-            kbd.release(k)
-    except Exception as e:
-        print("Combo send error:", e)
+    hid_queue.push_combo(kc_tuple, hold_time=hold_time, tag=tag)
 
-def send_macro_sequence(seq):
+def _modifier_bits(kc_tuple):
+    bits = 0
+    for kc in kc_tuple:
+        bits |= macro_compiler.modifier_bit(kc)
+    return bits
+
+def flush_key_batch():
+    """
+    Send the key presses collected during this scan. Presses with the same
+    modifiers share one report (up to KEY_REPORT_SLOTS keys, the rest spill
+    into the next), so keys pressed together go out together instead of one
+    press/hold/release cycle each.
     """
-    If the sequence contains '+', treat it as a single combo (e.g., 'control+alt+t').
-    Otherwise, type literal text.
+    while key_batch:
+        bits = _modifier_bits(key_batch[0])
+        mods = []
+        keys = []
+        rest = []
+        for kcs in key_batch:
+            if _modifier_bits(kcs) != bits:
+                rest.append(kcs)  # different modifiers: its own report
+                continue
+            for kc in kcs:
+                if macro_compiler.modifier_bit(kc):
+                    if kc not in mods:
+                        mods.append(kc)
+                elif kc not in keys:
+                    keys.append(kc)
+        key_batch[:] = rest
+        mods = tuple(mods)
+        if not keys:
+            send_combo(mods)
+        for n in range(0, len(keys), KEY_REPORT_SLOTS):
+            send_combo(mods + tuple(keys[n:n + KEY_REPORT_SLOTS]))
+
+def compile_macro(seq):
+    """
+    Compile a macro sequence at load time. If it contains '+' it is a
+    single combo (e.g., 'control+alt+t') and compiles to a keycode tuple,
+    otherwise it is literal text and compiles to report steps
+    (lib/macro_compiler.py). Errors compile to an empty tuple.
     """
     try:
         s = seq.strip()
@@ -402,24 +1191,35 @@ def send_macro_sequence(seq):
                     kc = getattr(Keycode, t, None)
                 if kc is None:
                     print("Unknown token in macro combo:", t)
-                    return
+                    return ()
                 kc_list.append(kc)
-            send_combo(tuple(kc_list))
-        else:
-            # literal typing
-            kbd_layout.write(s)
+            return tuple(kc_list)
+        return macro_compiler.text_steps(kbd_layout, s)
     except Exception as e:
         print("Macro sequence error:", e)
+        return ()
+
+def send_macro(mid):
+    """Queue a compiled macro; text is streamed out by hid_queue.poll()."""
+    compiled = macro_cache.get(mid)
+    if compiled is None:
+        print(f"Macro id {mid} not found")
+    elif isinstance(compiled, tuple):
+        send_combo(compiled, tag=MACRO_TAG)
+    else:
+        hid_queue.push_steps(compiled, tag=MACRO_TAG)
 
 
 def send_companion_event(event, payload=""):
     if not companion_connected:
         return
     try:
-        if payload:
-            uart.write(f"{event} {payload}\n".encode())
+        if binary_mode and event == "APP_EVENT":
+            binproto.write_frame(cdc, binproto.E_APP_EVENT, 0, payload.encode())
+        elif payload:
+            cdc.write(f"{event} {payload}\n".encode())
         else:
-            uart.write(f"{event}\n".encode())
+            cdc.write(f"{event}\n".encode())
     except Exception:
         pass
 
@@ -428,7 +1228,7 @@ def handle_app_action(action):
     fallback = app_action_fallback.get(action, "")
     if fallback and fallback in consumer_map:
         try:
-            consumer_control.send(consumer_map[fallback])
+            hid_queue.push_consumer(consumer_map[fallback])
         except Exception as e:
             print("Companion fallback send error:", e)
 
@@ -436,276 +1236,646 @@ def handle_app_action(action):
 
 
 def set_now_playing(payload):
-    global show_now_playing, last_now_playing_update
     if not isinstance(payload, dict):
         raise ValueError("NP_SET payload must be a JSON object")
 
-    now_playing["title"] = str(payload.get("title", ""))
-    now_playing["artist"] = str(payload.get("artist", ""))
-    now_playing["source"] = str(payload.get("source", ""))
-    now_playing["position"] = payload.get("position", 0)
-    now_playing["duration"] = payload.get("duration", 0)
-    last_now_playing_update = time.monotonic()
+    apply_now_playing(
+        str(payload.get("title", "")),
+        str(payload.get("artist", "")),
+        str(payload.get("source", "")),
+        payload.get("position", 0),
+        payload.get("duration", 0),
+        bool(payload.get("playing", True)),
+    )
+
+
+def apply_now_playing(title, artist, source, position, duration, playing=True):
+    global np_playing
+    now_playing["title"] = title
+    now_playing["artist"] = artist
+    now_playing["source"] = source
+    now_playing["duration"] = duration
+    np_playing = playing
+    np_set_position(position)
+
+
+def _np_touch(now):
+    global show_now_playing, last_now_playing_update
+    last_now_playing_update = now
     show_now_playing = True
 
+
+def np_set_position(position):
+    """Re-anchor the interpolated position (NP_POS)."""
+    global np_anchor_pos, np_anchor_time
+    now = time.monotonic()
+    np_anchor_pos = max(0.0, float(position))
+    np_anchor_time = now
+    now_playing["position"] = int(np_anchor_pos)
+    _np_touch(now)
+
+
+def np_set_playing(playing):
+    """Pause/resume interpolation at the current position (NP_PLAYSTATE)."""
+    global np_playing
+    if playing != np_playing:
+        pos = np_position()
+        np_playing = playing
+        np_set_position(pos)
+    else:
+        _np_touch(time.monotonic())
+
+
+def np_set_field(name, value):
+    """Single-field update (NP_TITLE/NP_ARTIST/NP_SOURCE/NP_DUR); position keeps running."""
+    if name == "duration":
+        value = max(0, int(value))
+    now_playing[name] = value
+    _np_touch(time.monotonic())
+
+
+def handle_np_delta(verb, arg):
+    """Apply one delta now-playing command; returns False if verb is not one."""
+    if verb == "NP_POS":
+        np_set_position(arg)
+    elif verb == "NP_PLAYSTATE":
+        if arg not in ("playing", "paused"):
+            raise ValueError("NP_PLAYSTATE expects playing or paused")
+        np_set_playing(arg == "playing")
+    elif verb == "NP_DUR":
+        np_set_field("duration", arg)
+    elif verb in NP_TEXT_FIELDS:
+        np_set_field(NP_TEXT_FIELDS[verb], arg)
+    else:
+        return False
+    return True
+
+
+def np_state():
+    """now_playing with the interpolated position, for NP_GET."""
+    state = dict(now_playing)
+    state["position"] = int(np_position())
+    state["playing"] = np_playing
+    return state
+
 def handle_layer_fn(fn, target, key_index=None, on_press=True):
-    """Apply layer switching behavior."""
-    global current_layer, default_layer
+    """Apply layer switching behavior to layer_state."""
+    global default_layer
+    target = min(max(target, 0), len(layers) - 1)
 
     if fn == "MO":
-        # Momentary: switch on press, revert on release
+        # Momentary: layer on while held. Keys are released in any order, so
+        # the layer stays on until the last MO() key holding it is released.
         if on_press:
             if key_index is not None:
-                mo_prev_layer[key_index] = current_layer
-                mo_active[key_index] = True
                 mo_target_for_key[key_index] = target
-            current_layer = min(max(target, 0), len(layers) - 1)
-            update_ui(current_layer)
-        else:
-            if key_index is not None and mo_active[key_index]:
-                current_layer = mo_prev_layer[key_index]
-                mo_active[key_index] = False
-                mo_target_for_key[key_index] = None
-                update_ui(current_layer)
+            set_layer_state(layer_state | (1 << target))
+        elif key_index is not None and mo_target_for_key[key_index] is not None:
+            held = mo_target_for_key[key_index]
+            mo_target_for_key[key_index] = None
+            if held not in mo_target_for_key:
+                set_layer_state(layer_state & ~(1 << held))
         return
 
     if on_press:
         if fn == "TO":
-            current_layer = min(max(target, 0), len(layers) - 1)
-            update_ui(current_layer)
+            # Only the target layer on top of the default layer
+            set_layer_state(1 << target)
         elif fn == "TT":
-            # Toggle between default_layer and target
-            tgt = min(max(target, 0), len(layers) - 1)
-            current_layer = tgt if current_layer != tgt else default_layer
-            update_ui(current_layer)
+            # Toggle the target layer on or off
+            set_layer_state(layer_state ^ (1 << target))
         elif fn == "DF":
-            default_layer = min(max(target, 0), len(layers) - 1)
-            current_layer = default_layer
-            update_ui(current_layer)
+            default_layer = target
+            set_layer_state(0)
 
-def send_key_entry(entry, key_index=None, on_press=True, hold_time=0.05):
+def compile_key_entry(entry):
     """
-    entry is a string from keys[].
-    on_press=True for press edge; False for release edge (used for MO()).
+    Resolve a keys[] string into an action tuple (kind, ...) at load time.
+    Unknown or empty entries compile to NOOP_ACTION.
     """
-    if is_noop(entry):
-        return
+    if is_noop(entry) or not isinstance(entry, str):
+        return NOOP_ACTION
+    if entry.strip().upper() in TRNS_NAMES:
+        return (ACT_TRNS,)
+
+    # Tap-hold: the tap action is compiled inline after the hold part
+    th = parse_tap_hold(entry)
+    if th:
+        fn, arg, key = th
+        tap = compile_key_entry(key)
+        try:
+            if tap[0] == ACT_TAPHOLD:
+                raise ValueError("tap action cannot be LT()/MT()")
+            if fn == "LT":
+                hold = int(arg)
+            else:
+                hold = 0
+                for kc in parse_combo_name(arg.upper()):
+                    hold |= macro_compiler.modifier_bit(kc)
+                if not hold:
+                    raise ValueError(f"no modifier in {arg}")
+        except Exception as e:
+            print(f"Bad tap-hold entry {entry}: {e}")
+            return NOOP_ACTION
+        return (ACT_TAPHOLD, fn, hold) + tap
 
     # Layer functions
     fn, tgt = parse_layer_fn(entry)
     if fn:
-        handle_layer_fn(fn, tgt, key_index=key_index, on_press=on_press)
-        return
+        return (ACT_LAYER, fn, tgt)
 
     # Consumer/media
     up = entry.upper()
     if up in consumer_map:
-        if on_press:  # only send on initial press
-            try:
-                consumer_control.send(consumer_map[up])
-            except Exception as e:
-                print("Consumer send error:", e)
-        return
+        return (ACT_CONSUMER, consumer_map[up])
+
+    # Stop a macro that is still typing
+    if up == "MACRO_CANCEL":
+        return (ACT_CANCEL,)
 
     # Macros: "MACRO_X"
     if up.startswith("MACRO_"):
-        if on_press:
-            try:
-                mid = int(up.split("_", 1)[1])
-                seq = macros.get(mid, None)
-                if seq:
-                    send_macro_sequence(seq)
-                else:
-                    print(f"Macro id {mid} not found")
-            except Exception as e:
-                print("Macro parse error:", e)
-        return
+        try:
+            return (ACT_MACRO, int(up.split("_", 1)[1]))
+        except Exception as e:
+            print("Macro parse error:", e)
+            return NOOP_ACTION
 
     # Companion app actions (optional)
     if up.startswith("APP_"):
-        if on_press:
-            handle_app_action(up)
-        return
+        return (ACT_APP, up)
 
     # Combos like CONTROL_C or LEFT_SHIFT_A
     kc_tuple = parse_combo_name(up)
     if kc_tuple:
-        if on_press:
-            send_combo(kc_tuple, hold_time=hold_time)
+        return (ACT_KEYS, kc_tuple)
+
+    # Single keycode (e.g., "A", "ENTER", "F1", "PAGE_UP", etc.)
+    kc = getattr(Keycode, up, None)
+    if kc is None:
+        print(f"Unknown key entry: {entry}")
+        return NOOP_ACTION
+    return (ACT_KEYS, (kc,))
+
+def send_action(action, key_index=None, on_press=True, hold_time=None):
+    """
+    Dispatch a compiled action tuple.
+    on_press=True for press edge; False for release edge (used for MO()).
+    """
+    kind = action[0]
+    if kind == ACT_TAPHOLD:
+        # only reaches here once resolved as a tap
+        send_action(action[3:], key_index=key_index, on_press=on_press, hold_time=hold_time)
+        return
+    if kind == ACT_LAYER:
+        handle_layer_fn(action[1], action[2], key_index=key_index, on_press=on_press)
+        return
+    if not on_press:
         return
 
-    # Single keycode (e.g., "A", "ENTER", "F1", etc.)
-    try:
-        kc = getattr(Keycode, up, None)
-        if kc is None:
-            print(f"Unknown key entry: {entry}")
-            return
-        if on_press:
-            kbd.press(kc)
-            time.sleep(hold_time)
-            kbd.release(kc)
-    except Exception as e:
-        print(f"Key send error for {entry}: {e}")
+    if kind == ACT_KEYS:
+        if hold_time is None:
+            key_batch.append(action[1])  # sent by flush_key_batch() at the end of the scan
+        else:
+            send_combo(action[1], hold_time=hold_time)
+    elif kind == ACT_CONSUMER:
+        hid_queue.push_consumer(action[1])
+    elif kind == ACT_MACRO:
+        send_macro(action[1])
+    elif kind == ACT_APP:
+        handle_app_action(action[1])
+    elif kind == ACT_CANCEL:
+        hid_queue.cancel(MACRO_TAG)
 
 # === USB CDC File Handling ===
 def handle_command(cmd):
-    global receiving_file, file, filename, companion_connected, show_now_playing
+    global receiving_file, file, filename, companion_connected, show_now_playing, binary_mode
     cmd = cmd.strip()
     companion_connected = True
 
     if cmd == "LIST":
-        uart.write(b"Files:\n")
+        cdc.write(b"Files:\n")
         for f in os.listdir("/"):
-            uart.write(f"{f}\n".encode())
-        uart.write(b"<END>\n")
+            cdc.write(f"{f}\n".encode())
+        cdc.write(b"<END>\n")
     elif cmd.startswith("DEL "):
         try:
             os.remove("/" + cmd[4:].strip())
-            uart.write(b"DELETED\n")
+            cdc.write(b"DELETED\n")
         except Exception as e:
-            uart.write(f"ERROR: {e}\n".encode())
+            cdc.write(f"ERROR: {e}\n".encode())
     elif cmd.startswith("PUT "):
         try:
             filename = cmd[4:].strip()
             file = open("/" + filename, "wb")
             receiving_file = True
-            uart.write(b"READY\n")
+            cdc.write(b"READY\n")
         except Exception as e:
-            uart.write(f"ERROR: {e}\n".encode())
-    elif cmd.startswith("GET "):
+            cdc.write(f"ERROR: {e}\n".encode())
+    elif cmd.startswith("PUTF ") or cmd.startswith("PUTR ") or cmd.startswith("PUTZ "):
+        if upload.start(cmd[5:], resume=cmd.startswith("PUTR "), compressed=cmd.startswith("PUTZ ")) \
+                and upload.completed:
+            after_file_received(upload.filename)
+    elif cmd.startswith("GET ") or cmd.startswith("GETZ "):
+        # GET <file> [<offset> <length>]; GETZ sends a block stream (lib/ztransfer.py)
         try:
-            with open("/" + cmd[4:].strip(), "rb") as f:
-                while True:
-                    chunk = f.read(512)
-                    if not chunk:
-                        break
-                    uart.write(chunk)
-            uart.write(b"<EOF>\n")
+            name, offset, length = ztransfer.parse_range(cmd[cmd.index(" ") + 1:])
+            if cmd.startswith("GETZ "):
+                ztransfer.send_blocks(cdc, "/" + name, offset, length)
+            else:
+                ztransfer.send_range(cdc, "/" + name, offset, length)
+                cdc.write(b"<EOF>\n")
         except Exception as e:
-            uart.write(f"ERROR: {e}\n".encode())
+            cdc.write(f"ERROR: {e}\n".encode())
     elif cmd.startswith("NP_SET "):
         try:
             payload = json.loads(cmd[7:].strip())
             set_now_playing(payload)
             update_ui(current_layer)
-            uart.write(b"NP_OK\n")
+            cdc.write(b"NP_OK\n")
         except Exception as e:
-            uart.write(f"ERROR: {e}\n".encode())
+            cdc.write(f"ERROR: {e}\n".encode())
     elif cmd == "NP_CLEAR":
         show_now_playing = False
         update_ui(current_layer)
-        uart.write(b"NP_CLEARED\n")
+        cdc.write(b"NP_CLEARED\n")
     elif cmd == "NP_GET":
         try:
-            uart.write((json.dumps(now_playing) + "\n").encode())
+            cdc.write((json.dumps(np_state()) + "\n").encode())
+        except Exception as e:
+            cdc.write(f"ERROR: {e}\n".encode())
+    elif cmd.startswith("NP_") and " " in cmd:
+        verb, arg = cmd.split(" ", 1)
+        try:
+            if not handle_np_delta(verb, arg.strip()):
+                cdc.write(b"UNKNOWN COMMAND\n")
+                return
+            update_ui(current_layer)  # rewrites only the labels whose text changed
+            cdc.write(b"NP_OK\n")
         except Exception as e:
-            uart.write(f"ERROR: {e}\n".encode())
+            cdc.write(f"ERROR: {e}\n".encode())
+    elif cmd == "MODE LIST":
+        cdc.write(b"Modes:\n")
+        for i in range(len(layers)):
+            cdc.write(f"{i + 1}: {layers.names[i]}\n".encode())
+        cdc.write(b"<END>\n")
+    elif cmd == "MODE" or cmd.startswith("MODE "):
+        arg = cmd[5:].strip()
+        idx = find_layer(arg) if arg else None
+        if not arg:
+            cdc.write(b"ERROR: MODE ARG\n")
+        elif idx is None:
+            cdc.write(b"ERROR: MODE NOT FOUND\n")
+        else:
+            show_now_playing = False
+            set_layer_state(1 << idx)  # like TO()
+            cdc.write(b"MODE LOADED\n")
+    elif cmd == "UI_STATS":
+        cdc.write((ui_stats_line() + "\n").encode())
+    elif cmd == "UI_STATS RESET":
+        cdc.write((ui_stats_line(reset=True) + "\n").encode())
+    elif cmd == "POWER":
+        cdc.write((power_stats_line() + "\n").encode())
+    elif cmd == "POWER RESET":
+        cdc.write((power_stats_line(reset=True) + "\n").encode())
+    elif cmd == "STATS":
+        for line in stats.lines():
+            cdc.write((line + "\n").encode())
+        cdc.write(b"<END>\n")
+    elif cmd == "STATS RESET":
+        stats.reset()
+        cdc.write(b"STATS RESET OK\n")
     elif cmd == "RELOAD":
         load_layers()
         update_ui(current_layer)
-        uart.write(b"LAYERS RELOADED\n")
+        cdc.write(b"LAYERS RELOADED\n")
+    elif cmd.startswith("PATCH "):
+        try:
+            touched = apply_patch(cmd[6:])
+            if touched is not None and layer_active(touched):
+                set_layer_state(layer_state)  # rebuild the effective keymap and redraw
+            cdc.write(b"PATCHED\n")
+        except Exception as e:
+            cdc.write(f"ERROR: {e}\n".encode())
+    elif cmd == "SAVE":
+        try:
+            if layers_dirty:
+                save_layers()
+            cdc.write(b"SAVED\n")
+        except Exception as e:
+            cdc.write(f"ERROR: {e}\n".encode())
+    elif cmd == "PROTO BIN":
+        binary_mode = True
+        cdc.write(b"PROTO BIN OK\n")
+    elif cmd == "PROTO TEXT":
+        binary_mode = False
+        cdc.write(b"PROTO TEXT OK\n")
     else:
-        uart.write(b"UNKNOWN COMMAND\n")
-def process_usb_cdc():
-    global cdc_buffer, receiving_file, file, filename
-    if receiving_file and uart.in_waiting:
-        data = uart.read(uart.in_waiting)
-        if b"<EOF>" in data:
-            parts = data.split(b"<EOF>")
-            if file:
-                file.write(parts[0])
-                file.close()
-                file = None
-            receiving_file = False
-            uart.write(b"FILE RECEIVED\n")
-            if filename.strip() == "layers.json":
-                try:
-                    load_layers()
-                    update_ui(current_layer)
-                    uart.write(b"LAYERS RELOADED\n")
-                except Exception as e:
-                    uart.write(f"ERROR reloading layers: {e}\n".encode())
-            cdc_buffer = parts[1] if len(parts) > 1 else b""
-        else:
-            if file:
-                file.write(data)
-        return
+        cdc.write(b"UNKNOWN COMMAND\n")
+
+def handle_binary_frame(ftype, seq, payload):
+    """Dispatch one binary frame (see lib/binproto.py for layouts)."""
+    global companion_connected, show_now_playing, binary_mode
+    companion_connected = True
+    bp = binproto
+
+    if ftype == bp.T_NP_SET:
+        title, artist, source, position, duration, flags = bp.unpack_np(payload)
+        apply_now_playing(title, artist, source, position, duration, bool(flags & bp.NP_PLAYING))
+        update_ui(current_layer)
+        bp.write_frame(cdc, bp.R_OK, seq)
+    elif ftype == bp.T_NP_POS or ftype == bp.T_NP_STATE or ftype == bp.T_NP_FIELD:
+        try:
+            if ftype == bp.T_NP_POS:
+                np_set_position(struct.unpack_from("<I", payload, 0)[0])
+            elif ftype == bp.T_NP_STATE:
+                np_set_playing(bool(payload[0] & bp.NP_PLAYING))
+            else:
+                np_set_field(*bp.unpack_np_field(payload))
+            update_ui(current_layer)
+            bp.write_frame(cdc, bp.R_OK, seq)
+        except Exception as e:
+            bp.write_frame(cdc, bp.R_ERR, seq, str(e).encode())
+    elif ftype == bp.T_NP_CLEAR:
+        show_now_playing = False
+        update_ui(current_layer)
+        bp.write_frame(cdc, bp.R_OK, seq)
+    elif ftype == bp.T_NP_GET:
+        bp.write_frame(cdc, bp.R_NP, seq, bp.pack_np(
+            now_playing["title"], now_playing["artist"], now_playing["source"],
+            np_position(), now_playing["duration"],
+            bp.NP_PLAYING if np_playing else 0,
+        ))
+    elif ftype == bp.T_RELOAD:
+        load_layers()
+        update_ui(current_layer)
+        bp.write_frame(cdc, bp.R_OK, seq)
+    elif ftype == bp.T_HELLO:
+        bp.write_frame(cdc, bp.R_OK, seq, b"TRKEY")
+    elif ftype == bp.T_PROTO_TEXT:
+        binary_mode = False
+        bp.write_frame(cdc, bp.R_OK, seq)
+    else:
+        done = bin_files.handle(ftype, seq, payload)
+        if not done:
+            bp.write_frame(cdc, bp.R_ERR, seq, b"UNKNOWN FRAME")
+        elif done == "layers.json":
+            load_layers()
+            update_ui(current_layer)
 
-    if uart.in_waiting:
-        char = uart.read(1)
-        if char == b'\r':
-            return
-        if char == b'\n':
+def after_file_received(name):
+    if name.strip() == "layers.json":
+        try:
+            load_layers()
+            update_ui(current_layer)
+            cdc.write(b"LAYERS RELOADED\n")
+        except Exception as e:
+            cdc.write(f"ERROR reloading layers: {e}\n".encode())
+
+def finish_file_upload():
+    global receiving_file, file
+    if file:
+        file.close()
+        file = None
+    receiving_file = False
+    cdc.write(b"FILE RECEIVED\n")
+    after_file_received(filename)
+
+def receive_file_data():
+    """Write buffered upload bytes to the open file; returns True once <EOF> is seen."""
+    idx = cdc.find(EOF_MARKER)
+    if idx >= 0:
+        if file and idx:
+            file.write(cdc.peek(idx))
+        cdc.skip(idx + len(EOF_MARKER))
+        finish_file_upload()
+        return True
+    # Hold back a possible partial marker at the tail until more bytes arrive
+    n = cdc.available() - (len(EOF_MARKER) - 1)
+    if n > 0:
+        if file:
+            file.write(cdc.peek(n))
+        cdc.skip(n)
+    return False
+
+def process_usb_cdc():
+    """Drain everything waiting on CDC, run complete commands, flush replies. Returns bytes read."""
+    got = cdc.poll()
+    while True:
+        if receiving_file:
+            if not receive_file_data():
+                break
+            continue
+        if upload.active:
+            if not upload.feed():
+                break
+            if upload.completed:
+                after_file_received(upload.filename)
+            continue
+        if binary_mode and binproto.at_frame(cdc):
+            frame = binproto.read_frame(cdc)
+            if frame is None:
+                break
+            ftype, seq, payload, total = frame
             try:
-                handle_command(cdc_buffer.decode().strip())
+                if ftype is not None:
+                    handle_binary_frame(ftype, seq, payload)
             except Exception as e:
-                uart.write(f"ERR: {e}\n".encode())
-            cdc_buffer = b""
-        else:
-            cdc_buffer += char
+                binproto.write_frame(cdc, binproto.R_ERR, seq, str(e).encode())
+            cdc.skip(total)
+            continue
+        line = cdc.readline()
+        if line is None:
+            break
+        try:
+            handle_command(line.decode().strip())
+        except Exception as e:
+            cdc.write(f"ERR: {e}\n".encode())
+    cdc.flush()
+    return got
+
+# === Key events ===
+def key_action(i):
+    return effective_actions[i] if i < len(effective_actions) else NOOP_ACTION
+
+def on_key_press(i, now):
+    """Press edge for key i."""
+    global pressed_index, last_press_time, pending_edge_ns
+    if not pending_edge_ns:
+        pending_edge_ns = scan_ns
+    action = key_press_action[i] = key_action(i)
+    send_action(action, key_index=i, on_press=True)
+    pressed_index = i
+    last_press_time = now
+    repeat_start[i] = now
+    repeat_last[i] = now
+    repeat_active[i] = True
+    update_ui(current_layer, pressed_index)
+
+def on_chord(n, now, pressed):
+    """Chord n fired (pressed=True) or its first key was released."""
+    global pressed_index, last_press_time, pending_edge_ns
+    action = chord_actions[n]
+    if not pressed:
+        if action[0] == ACT_LAYER:
+            send_action(action, key_index=chord_keys[n], on_press=False)
+        return
+    if not pending_edge_ns:
+        pending_edge_ns = scan_ns
+    send_action(action, key_index=chord_keys[n], on_press=True)
+    pressed_index = chord_keys[n]
+    last_press_time = now
+    update_ui(current_layer, pressed_index)
+
+def on_tap_hold(i, start):
+    """LT()/MT() key i was resolved as hold (start=True) or, held, was released."""
+    if start:
+        action = th_hold_action[i] = key_action(i)
+    else:
+        action = th_hold_action[i]
+        th_hold_action[i] = None
+    if action is None or action[0] != ACT_TAPHOLD:
+        return
+    if action[1] == "LT":
+        handle_layer_fn("MO", action[2], key_index=i, on_press=start)
+        return
+    th_mods[i] = action[2] if start else 0
+    bits = 0
+    for m in th_mods:
+        bits |= m
+    hid_queue.push_mods(bits)
+
+def on_key_hold(i, now):
+    """Key i is still down: auto-repeat (skip repeats for MO keys)."""
+    global pressed_index, last_press_time
+    action = key_press_action[i]
+    if action[0] == ACT_LAYER and action[1] == "MO":
+        # Do nothing on hold; layer remains switched until release
+        return
+    # only repeat once the previous report has gone out
+    if (now - repeat_start[i]) > REPEAT_DELAY and (now - repeat_last[i]) > REPEAT_RATE and hid_queue.idle():
+        send_action(action, key_index=i, on_press=True)
+        repeat_last[i] = now
+        pressed_index = i
+        last_press_time = now
+        update_ui(current_layer, pressed_index)
+
+def on_key_release(i):
+    """Release edge for key i."""
+    if repeat_active[i]:
+        # Release edge for momentary layer: the action it was pressed with,
+        # whatever layer is on top now
+        action = key_press_action[i]
+        if action[0] == ACT_LAYER and action[1] == "MO":
+            send_action(action, key_index=i, on_press=False)
+    repeat_active[i] = False
 
 # === Initialize ===
 load_layers()
 init_ui()
 update_ui(current_layer)
+power_since = power_stats_since = last_input_time = last_display_time = time.monotonic()
 
 # === Main Loop ===
 while True:
     now = time.monotonic()
-    process_usb_cdc()
-
-    # Physical button to cycle layers (kept from your original)
-    current_state = layer_switch_btn.value
-    if last_layer_switch_state and not current_state:
-        current_layer = (current_layer + 1) % len(layers)
-        update_ui(current_layer)
-        time.sleep(0.2)
-    last_layer_switch_state = current_state
-
-    # Key input handling with repeat + MO()
-    for i, btn in enumerate(buttons):
-        state = btn.value  # True = released (pull-up), False = pressed
-        keyname = layers[current_layer]["keys"][i] if i < len(layers[current_layer]["keys"]) else ""
-
-        if not state:
-            # pressed
-            if (now - button_times[i]) > DEBOUNCE_TIME:
-                if not repeat_active[i]:
-                    # First press edge
-                    send_key_entry(keyname, key_index=i, on_press=True)
-                    pressed_index = i
-                    last_press_time = now
-                    repeat_start[i] = now
-                    repeat_last[i] = now
-                    repeat_active[i] = True
-                    update_ui(current_layer, pressed_index)
-                else:
-                    # hold repeat (skip repeats for MO keys)
-                    fn, _tgt = parse_layer_fn(keyname)
-                    if fn == "MO":
-                        # Do nothing on hold; layer remains switched until release
-                        pass
-                    else:
-                        if (now - repeat_start[i]) > REPEAT_DELAY and (now - repeat_last[i]) > REPEAT_RATE:
-                            send_key_entry(keyname, key_index=i, on_press=True)
-                            repeat_last[i] = now
-                            pressed_index = i
-                            update_ui(current_layer, pressed_index)
+    loop_ns = time.monotonic_ns()
+    cdc_active = process_usb_cdc()
+    scan_ns = stats.cdc.mark(loop_ns)
+
+    raw, _ = scanner.scan()
+    raw |= scanner.taps  # a tap shorter than one pass still counts as down for this pass
+    if wake_bits:
+        # the key that woke the board from light sleep
+        if now < wake_until:
+            raw |= wake_bits
         else:
-            # released
-            if repeat_active[i]:
-                # Release edge for momentary layer
-                fn, _tgt = parse_layer_fn(keyname)
-                if fn == "MO":
-                    send_key_entry(keyname, key_index=i, on_press=False)
-            repeat_active[i] = False
+            wake_bits = 0
+    pressed_mask, changed = debouncer.update(raw, scan_ns // 1000000)
+    busy = raw | changed | pressed_mask
+    if chords.masks:
+        # hold back chord keys until they resolve to a chord or plain presses
+        pressed_mask, changed = chords.update(pressed_mask, changed, scan_ns // 1000000, current_layer)
+        events = chords.ended | chords.fired
+        n = 0
+        while events:
+            if events & 1:
+                bit = 1 << n
+                if chords.ended & bit:
+                    on_chord(n, now, False)
+                if chords.fired & bit:
+                    on_chord(n, now, True)
+            events >>= 1
+            n += 1
+    # hold back keys behind an undecided LT()/MT() key
+    pressed_mask, changed = tap_hold.update(pressed_mask, changed, scan_ns // 1000000, effective_th_mask)
+    if tap_hold.hold_started or tap_hold.hold_ended:
+        events = tap_hold.hold_ended | tap_hold.hold_started
+        i = 0
+        while events:
+            if events & 1:
+                bit = 1 << i
+                if tap_hold.hold_ended & bit:
+                    on_tap_hold(i, False)
+                if tap_hold.hold_started & bit:
+                    on_tap_hold(i, True)
+            events >>= 1
+            i += 1
+
+    # Physical button to cycle layers (press edge, no blocking delay)
+    if changed & pressed_mask & LAYER_BUTTON_BIT:
+        set_layer_state(1 << ((current_layer + 1) % len(layers)))
+
+    # Key input handling with repeat + MO(): only keys with an edge or held down
+    active = (changed | pressed_mask) & KEY_MASK
+    i = 0
+    while active:
+        if active & 1:
+            bit = 1 << i
+            if not changed & bit:
+                on_key_hold(i, now)
+            elif pressed_mask & bit:
+                on_key_press(i, now)
+            else:
+                on_key_release(i)
+        active >>= 1
+        i += 1
+    flush_key_batch()
+
+    t = stats.keys.mark(scan_ns)
+
+    # Drain due HID reports (combos, media keys, macro typing)
+    emitted = hid_queue.poll(now)
+    t = stats.hid.mark(t)
+    if pending_edge_ns and (emitted or hid_queue.idle()):
+        # first report after the press edge (nothing to report for layer keys)
+        if emitted:
+            stats.latency.add_ns(t - pending_edge_ns)
+        pending_edge_ns = 0
 
     if pressed_index is not None and (now - last_press_time) > PRESS_DISPLAY_TIME:
         pressed_index = None
         update_ui(current_layer)
 
-    if show_now_playing and not should_show_now_playing(now):
-        update_ui(current_layer)
-
-    time.sleep(0.01)
-
+    if show_now_playing:
+        if not should_show_now_playing(now):
+            # companion went quiet: back to the layer view
+            show_now_playing = False
+            update_ui(current_layer)
+        elif np_playing and ui_view == "np" and int(np_position(now)) != np_shown_second:
+            ui_dirty = True  # next second on the time line; flush_ui() redraws it
+
+    # Persist PATCH edits once they stop coming in
+    flush_layers_if_due(now)
+
+    # Redraw last, in the slack left after input, HID and CDC work (not while the OLED is off)
+    if ui_dirty and not cdc_active and power_state < POWER_BLANK and ui_slack(now):
+        flush_ui(now)
+
+    # Keep polling without sleeping while the host is streaming data
+    cdc.flush()
+    stats.loop.mark(loop_ns)
+    stats.tick()
+    interval = update_power(now, busy or cdc_active or emitted or not hid_queue.idle())
+    if not cdc_active:
+        time.sleep(interval)
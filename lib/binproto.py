@@ -0,0 +1,269 @@
+# binproto.py
+#
+# Opt-in binary framing for the CDC command channel. The host switches a
+# connection over with the text line `PROTO BIN` (reply `PROTO BIN OK`) and
+# back with `PROTO TEXT` or a T_PROTO_TEXT frame. Text lines keep working in
+# binary mode; a frame is recognised by its sync byte at a line boundary.
+#
+#   0xB5 | type:u8 | seq:u8 | length:u16le | payload
+#
+# Replies echo the request seq. Payload layouts (little-endian):
+#
+#   T_LIST      -> R_LIST  names separated by b"\n"
+#   T_GET       name -> R_DATA offset:u32 + bytes ... then R_END size:u32 crc32:u32
+#   T_GET_RANGE offset:u32 length:u32 name -> as T_GET for that range; R_DATA
+#               offsets are file offsets, R_END has the range size and its crc32
+#               (length 0xFFFFFFFF reads to the end)
+#   T_PUT_BEGIN size:u32 crc32:u32 name -> R_OK | R_ERR
+#   T_PUT_DATA  offset:u32 + bytes -> R_ACK next_offset:u32 (R_OK once committed)
+#   T_DEL       name -> R_OK | R_ERR
+#   T_RELOAD    -> R_OK | R_ERR
+#   T_NP_SET    position:u32 duration:u32 flags:u8 + 3 x (len:u8 + utf8)
+#               for title, artist, source -> R_OK
+#   T_NP_CLEAR  -> R_OK
+#   T_NP_GET    -> R_NP (same layout as T_NP_SET)
+#   T_NP_POS    position:u32 -> R_OK (re-anchors the device's interpolation)
+#   T_NP_STATE  flags:u8 -> R_OK (NP_PLAYING set: playing, clear: paused)
+#   T_NP_FIELD  field:u8 + value -> R_OK; value is utf8 for NP_F_TITLE,
+#               NP_F_ARTIST and NP_F_SOURCE, u32 for NP_F_DURATION
+#   E_APP_EVENT action (device-initiated, seq 0)
+
+import os
+import struct
+
+from framed_upload import crc32_update
+
+SYNC = 0xB5
+HEADER_FMT = "<BBBH"
+HEADER = 5
+MAX_PAYLOAD = 512
+
+T_HELLO = 0x01
+T_PROTO_TEXT = 0x02
+T_LIST = 0x10
+T_GET = 0x11
+T_PUT_BEGIN = 0x12
+T_PUT_DATA = 0x13
+T_DEL = 0x14
+T_RELOAD = 0x15
+T_GET_RANGE = 0x16
+T_NP_SET = 0x20
+T_NP_CLEAR = 0x21
+T_NP_GET = 0x22
+T_NP_POS = 0x23
+T_NP_STATE = 0x24
+T_NP_FIELD = 0x25
+
+R_OK = 0x80
+R_ERR = 0x81
+R_ACK = 0x82
+R_LIST = 0x90
+R_DATA = 0x91
+R_END = 0x92
+R_NP = 0xA0
+E_APP_EVENT = 0xC0
+
+NP_FMT = "<IIB"
+NP_FIXED = 9
+NP_PLAYING = 0x01
+NP_F_TITLE = 0
+NP_F_ARTIST = 1
+NP_F_SOURCE = 2
+NP_F_DURATION = 3
+NP_FIELD_NAMES = ("title", "artist", "source", "duration")
+PART_SUFFIX = ".part"
+
+_header = bytearray(HEADER)
+
+
+def write_frame(cdc, ftype, seq, payload=b""):
+    """Write one frame through a CDCTransport without building a joined bytes object."""
+    struct.pack_into(HEADER_FMT, _header, 0, SYNC, ftype, seq & 0xFF, len(payload))
+    cdc.write(_header)
+    if payload:
+        cdc.write(payload)
+
+
+def encode_frame(ftype, seq, payload=b""):
+    return struct.pack(HEADER_FMT, SYNC, ftype, seq & 0xFF, len(payload)) + bytes(payload)
+
+
+def read_frame(cdc):
+    """
+    Parse the frame at the head of the transport buffer.
+    Returns (type, seq, payload_view, total_len) or None if incomplete.
+    payload_view aliases the receive buffer; call cdc.skip(total_len) when done with it.
+    """
+    avail = cdc.available()
+    if avail < HEADER:
+        return None
+    head = cdc.peek(HEADER)
+    _sync, ftype, seq, length = struct.unpack_from(HEADER_FMT, head, 0)
+    total = HEADER + length
+    if length > MAX_PAYLOAD:
+        # Not a sane frame: drop the sync byte so the caller resynchronises
+        return (None, seq, None, 1)
+    if avail < total:
+        return None
+    return (ftype, seq, cdc.peek(total)[HEADER:], total)
+
+
+def at_frame(cdc):
+    return cdc.available() and cdc.peek(1)[0] == SYNC
+
+
+def _put_str(buf, pos, text):
+    data = text.encode()[:255]
+    buf[pos] = len(data)
+    buf[pos + 1:pos + 1 + len(data)] = data
+    return pos + 1 + len(data)
+
+
+def _get_str(view, pos):
+    n = view[pos]
+    return str(bytes(view[pos + 1:pos + 1 + n]), "utf-8"), pos + 1 + n
+
+
+def pack_np(title, artist, source, position, duration, flags=NP_PLAYING):
+    buf = bytearray(NP_FIXED + 3 * 256)
+    struct.pack_into(NP_FMT, buf, 0, max(0, int(position)), max(0, int(duration)), flags)
+    pos = _put_str(buf, NP_FIXED, title)
+    pos = _put_str(buf, pos, artist)
+    pos = _put_str(buf, pos, source)
+    return buf[:pos]
+
+
+def unpack_np(view):
+    """Return (title, artist, source, position, duration, flags)."""
+    position, duration, flags = struct.unpack_from(NP_FMT, view, 0)
+    title, pos = _get_str(view, NP_FIXED)
+    artist, pos = _get_str(view, pos)
+    source, pos = _get_str(view, pos)
+    return title, artist, source, position, duration, flags
+
+
+def pack_np_field(name, value):
+    field = NP_FIELD_NAMES.index(name)
+    if field == NP_F_DURATION:
+        return struct.pack("<BI", field, max(0, int(value)))
+    return bytes((field,)) + str(value).encode()[:255]
+
+
+def unpack_np_field(view):
+    """Return (name, value) of a T_NP_FIELD payload."""
+    field = view[0]
+    if field == NP_F_DURATION:
+        return "duration", struct.unpack_from("<I", view, 1)[0]
+    return NP_FIELD_NAMES[field], str(bytes(view[1:]), "utf-8")
+
+
+class BinaryFileOps:
+    """LIST/GET/PUT/DEL over binary frames, shared by code.py and USBFileServer."""
+
+    def __init__(self, cdc, root="/", chunk=MAX_PAYLOAD - 4):
+        self.cdc = cdc
+        self.root = root
+        self.chunk = chunk
+        self._buf = bytearray(4 + chunk)
+        self._u32 = bytearray(8)
+        self.file = None
+        self.filename = ""
+        self.size = 0
+        self.expected_crc = 0
+        self.offset = 0
+        self.crc = 0
+
+    def error(self, seq, e):
+        write_frame(self.cdc, R_ERR, seq, str(e).encode())
+
+    def handle(self, ftype, seq, payload):
+        """Handle a file frame. Returns the committed filename for a finished PUT, True if handled, False if not a file frame."""
+        try:
+            if ftype == T_LIST:
+                names = "\n".join(os.listdir(self.root)).encode()
+                write_frame(self.cdc, R_LIST, seq, names)
+            elif ftype == T_GET:
+                self._get(seq, str(bytes(payload), "utf-8"))
+            elif ftype == T_GET_RANGE:
+                offset, length = struct.unpack_from("<II", payload, 0)
+                self._get(seq, str(bytes(payload[8:]), "utf-8"), offset, -1 if length == 0xFFFFFFFF else length)
+            elif ftype == T_DEL:
+                os.remove(self.root + str(bytes(payload), "utf-8"))
+                write_frame(self.cdc, R_OK, seq)
+            elif ftype == T_PUT_BEGIN:
+                self._put_begin(seq, payload)
+            elif ftype == T_PUT_DATA:
+                return self._put_data(seq, payload)
+            else:
+                return False
+        except Exception as e:
+            self.error(seq, e)
+        return True
+
+    def _get(self, seq, name, offset=0, length=-1):
+        buf = self._buf
+        view = memoryview(buf)
+        sent = 0
+        crc = 0
+        with open(self.root + name, "rb") as f:
+            if offset:
+                f.seek(offset)
+            while length < 0 or sent < length:
+                want = self.chunk if length < 0 else min(self.chunk, length - sent)
+                n = f.readinto(view[4:4 + want])
+                if not n:
+                    break
+                struct.pack_into("<I", buf, 0, offset + sent)
+                write_frame(self.cdc, R_DATA, seq, view[:4 + n])
+                crc = crc32_update(view[4:4 + n], crc)
+                sent += n
+        struct.pack_into("<II", self._u32, 0, sent, crc)
+        write_frame(self.cdc, R_END, seq, self._u32)
+
+    def _put_begin(self, seq, payload):
+        if self.file:
+            self.file.close()
+            self.file = None
+        self.size, self.expected_crc = struct.unpack_from("<II", payload, 0)
+        self.filename = str(bytes(payload[8:]), "utf-8").strip()
+        self.file = open(self.root + self.filename + PART_SUFFIX, "wb")
+        self.offset = 0
+        self.crc = 0
+        write_frame(self.cdc, R_OK, seq)
+        if self.size == 0:
+            return self._commit(seq)
+        return True
+
+    def _put_data(self, seq, payload):
+        if not self.file:
+            raise ValueError("no PUT in progress")
+        (off,) = struct.unpack_from("<I", payload, 0)
+        data = payload[4:]
+        if off != self.offset or off + len(data) > self.size:
+            # Tell the host where to continue from
+            struct.pack_into("<I", self._u32, 0, self.offset)
+            write_frame(self.cdc, R_ACK, seq, memoryview(self._u32)[:4])
+            return True
+        self.file.write(data)
+        self.crc = crc32_update(data, self.crc)
+        self.offset += len(data)
+        struct.pack_into("<I", self._u32, 0, self.offset)
+        write_frame(self.cdc, R_ACK, seq, memoryview(self._u32)[:4])
+        if self.offset >= self.size:
+            return self._commit(seq)
+        return True
+
+    def _commit(self, seq):
+        self.file.close()
+        self.file = None
+        part = self.root + self.filename + PART_SUFFIX
+        if self.crc != self.expected_crc:
+            os.remove(part)
+            raise ValueError("CRC MISMATCH")
+        try:
+            os.remove(self.root + self.filename)
+        except OSError:
+            pass
+        os.rename(part, self.root + self.filename)
+        write_frame(self.cdc, R_OK, seq)
+        return self.filename
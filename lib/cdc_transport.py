@@ -0,0 +1,105 @@
+# cdc_transport.py
+
+
+class CDCTransport:
+    """
+    Buffered USB CDC transport.
+
+    poll() moves everything waiting on the port into a preallocated receive
+    buffer in one readinto() call; readline() then splits complete lines out
+    of it without building intermediate bytes objects. Writes are collected
+    in a preallocated transmit buffer and sent in bulk by flush().
+    """
+
+    def __init__(self, uart, rx_size=1024, tx_size=512):
+        self.uart = uart
+        self._rx = bytearray(rx_size)
+        self._rx_view = memoryview(self._rx)
+        self._rx_start = 0  # first unconsumed byte
+        self._rx_end = 0    # one past the last received byte
+        self._tx = bytearray(tx_size)
+        self._tx_view = memoryview(self._tx)
+        self._tx_len = 0
+
+    # --- receive ---
+    def available(self):
+        return self._rx_end - self._rx_start
+
+    def _compact(self):
+        n = self._rx_end - self._rx_start
+        if n and self._rx_start:
+            self._rx[0:n] = self._rx[self._rx_start:self._rx_end]
+        self._rx_start = 0
+        self._rx_end = n
+
+    def poll(self):
+        """Pull all bytes waiting on the port into the buffer. Returns the count."""
+        waiting = self.uart.in_waiting
+        if not waiting:
+            return 0
+        if self._rx_start:
+            self._compact()
+        room = len(self._rx) - self._rx_end
+        if not room:
+            # A full buffer with no newline can never become a line: drop it.
+            if self._rx.find(b"\n", 0, self._rx_end) < 0:
+                self._rx_start = self._rx_end = 0
+                room = len(self._rx)
+            else:
+                return 0
+        n = min(waiting, room)
+        got = self.uart.readinto(self._rx_view[self._rx_end:self._rx_end + n])
+        if got:
+            self._rx_end += got
+        return got or 0
+
+    def readline(self):
+        """Return the next complete line (without CR/LF) as bytes, or None."""
+        idx = self._rx.find(b"\n", self._rx_start, self._rx_end)
+        if idx < 0:
+            return None
+        end = idx
+        if end > self._rx_start and self._rx[end - 1] == 13:  # strip '\r'
+            end -= 1
+        line = bytes(self._rx_view[self._rx_start:end])
+        self._rx_start = idx + 1
+        if self._rx_start == self._rx_end:
+            self._rx_start = self._rx_end = 0
+        return line
+
+    def find(self, marker):
+        """Offset of marker in the unconsumed data, or -1."""
+        idx = self._rx.find(marker, self._rx_start, self._rx_end)
+        return idx - self._rx_start if idx >= 0 else -1
+
+    def peek(self, n=None):
+        """Memoryview of up to n unconsumed bytes (valid until the next poll)."""
+        avail = self.available()
+        if n is None or n > avail:
+            n = avail
+        return self._rx_view[self._rx_start:self._rx_start + n]
+
+    def skip(self, n):
+        self._rx_start += min(n, self.available())
+        if self._rx_start == self._rx_end:
+            self._rx_start = self._rx_end = 0
+
+    # --- transmit ---
+    def write(self, data):
+        """Queue bytes (or str) for sending; flushes when the buffer fills."""
+        if isinstance(data, str):
+            data = data.encode()
+        n = len(data)
+        if self._tx_len + n > len(self._tx):
+            self.flush()
+            if n > len(self._tx):
+                self.uart.write(data)
+                return n
+        self._tx[self._tx_len:self._tx_len + n] = data
+        self._tx_len += n
+        return n
+
+    def flush(self):
+        if self._tx_len:
+            self.uart.write(self._tx_view[:self._tx_len])
+            self._tx_len = 0
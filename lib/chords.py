@@ -0,0 +1,139 @@
+# chords.py
+
+
+class ChordEngine:
+    """
+    Chords (combos): several keys pressed within `term` ms act as one key.
+
+    Sits between the Debouncer and the key handlers and works on the same
+    (pressed, changed) bitmasks. A press of a key that belongs to a chord
+    on the current layer is held back until it is resolved:
+
+    - the held-back keys exactly match a chord that no larger chord
+      contains, or match a chord when `term` runs out, a held-back key is
+      released or another key is pressed: the chord fires and its keys are
+      swallowed until they are released;
+    - otherwise the held-back keys are let through as ordinary presses (a
+      key released while held back is reported as pressed for one update).
+
+    update() returns the filtered (pressed, changed). Chords that fired on
+    that update are set in `fired` and chords that ended (first key
+    released) in `ended`, as bitmasks over chord indices.
+    """
+
+    def __init__(self, term_ms=50):
+        self.term = term_ms
+        self.masks = []        # chord index -> key mask
+        self.layers = []       # chord index -> layer index, or None for every layer
+        self.fired = 0
+        self.ended = 0
+        self._buf = 0          # keys held back, physically down
+        self._since = 0        # ms of the first held-back press
+        self._eaten = 0        # keys swallowed by an active chord
+        self._active = 0       # chords that fired and have not ended
+        self._end_next = 0     # chords whose keys were already up when they fired
+        self._tap = 0          # let-through keys already released: pressed for one update
+        self._out = 0          # previous filtered mask
+        self._members = {}     # layer -> union of its chord masks
+
+    def configure(self, chords, term_ms=None):
+        """chords: sequence of (key mask, layer or None)."""
+        self.masks = [c[0] for c in chords]
+        self.layers = [c[1] for c in chords]
+        if term_ms is not None:
+            self.term = term_ms
+        self._members = {}
+        self.reset()
+
+    def busy(self):
+        """True while keys are held back waiting for a chord."""
+        return self._buf != 0
+
+    def reset(self):
+        self._buf = 0
+        self._eaten = 0
+        self._active = 0
+        self._end_next = 0
+        self._tap = 0
+
+    def members(self, layer):
+        m = self._members.get(layer)
+        if m is None:
+            m = 0
+            for n in range(len(self.masks)):
+                if self.layers[n] is None or self.layers[n] == layer:
+                    m |= self.masks[n]
+            self._members[layer] = m
+        return m
+
+    def _match(self, keys, layer):
+        """(index of the chord equal to keys or -1, True if a larger chord contains keys)."""
+        exact = -1
+        larger = False
+        for n in range(len(self.masks)):
+            lyr = self.layers[n]
+            if lyr is not None and lyr != layer:
+                continue
+            m = self.masks[n]
+            if m == keys:
+                exact = n
+            elif m & keys == keys:
+                larger = True
+        return exact, larger
+
+    def _resolve(self, layer, pressed):
+        buf = self._buf
+        self._buf = 0
+        n, _ = self._match(buf, layer)
+        if n >= 0:
+            bit = 1 << n
+            self.fired |= bit
+            self._eaten |= buf & pressed
+            if buf & ~pressed:
+                self._end_next |= bit  # tapped: ends on the next update
+            else:
+                self._active |= bit
+        else:
+            self._tap |= buf & ~pressed
+
+    def update(self, pressed, changed, now_ms, layer):
+        self.fired = 0
+        self.ended = self._end_next
+        self._end_next = 0
+        tap = self._tap
+        self._tap = 0
+        if not (changed or self._buf or self._eaten or tap or self.ended or self._out ^ pressed):
+            return pressed, 0
+
+        released = changed & ~pressed
+        if released & self._eaten:
+            for n in range(len(self.masks)):
+                bit = 1 << n
+                if self._active & bit and self.masks[n] & released:
+                    self._active &= ~bit
+                    self.ended |= bit
+            self._eaten &= ~released
+
+        members = self.members(layer)
+        pressing = changed & pressed
+        if self._buf and (released & self._buf or pressing & ~members):
+            self._resolve(layer, pressed)
+        new = pressing & members
+        if new:
+            if self._buf:
+                if self._match(self._buf | new, layer) == (-1, False):
+                    self._resolve(layer, pressed)
+                else:
+                    new |= self._buf
+            if not self._buf:
+                self._since = now_ms
+            self._buf = new
+        if self._buf:
+            n, larger = self._match(self._buf, layer)
+            if (n >= 0 and not larger) or now_ms - self._since >= self.term:
+                self._resolve(layer, pressed)
+
+        out = (pressed & ~self._buf & ~self._eaten) | self._tap
+        changed_out = out ^ self._out
+        self._out = out
+        return out, changed_out
@@ -0,0 +1,74 @@
+# debounce.py
+
+
+class Debouncer:
+    """
+    Per-key debounce over the bitmasks produced by KeyScanner.
+
+    Each key uses one of two algorithms with its own settle time:
+
+    - eager: the first raw edge is reported immediately, then the key is
+      locked for `settle` ms and ignores chatter. Lowest press latency.
+    - deferred: an edge is reported once the raw level has held for
+      `settle` ms. Adds `settle` ms of latency but filters noisy switches.
+
+    update() takes the raw mask and a millisecond timestamp and returns
+    (state, changed) like KeyScanner.scan(). Keys that are idle and settled
+    cost nothing per pass.
+    """
+
+    def __init__(self, count, settle_ms=5, eager=True):
+        self.state = 0          # debounced mask
+        self._raw = 0           # raw mask from the previous update
+        self._eager = 0         # bit set -> eager algorithm for that key
+        self._busy = 0          # keys locked (eager) or waiting to settle (deferred)
+        self._settle = [0] * count
+        self._since = [0] * count  # eager: lock start; deferred: last raw edge
+        for i in range(count):
+            self.configure(i, settle_ms, eager)
+
+    def configure(self, key, settle_ms, eager=True):
+        bit = 1 << key
+        self._settle[key] = max(0, int(settle_ms))
+        if eager:
+            self._eager |= bit
+        else:
+            self._eager &= ~bit
+
+    def update(self, raw, now_ms):
+        prev = self.state
+        state = prev
+        moved = raw ^ self._raw
+        self._raw = raw
+        todo = (raw ^ state) | moved | self._busy
+        i = 0
+        while todo:
+            if todo & 1:
+                bit = 1 << i
+                if self._eager & bit:
+                    if self._busy & bit:
+                        if now_ms - self._since[i] < self._settle[i]:
+                            todo >>= 1
+                            i += 1
+                            continue
+                        self._busy &= ~bit
+                    if (raw ^ state) & bit:
+                        state ^= bit
+                        self._since[i] = now_ms
+                        if self._settle[i]:
+                            self._busy |= bit
+                else:
+                    if moved & bit:
+                        self._since[i] = now_ms
+                    if (raw ^ state) & bit:
+                        if now_ms - self._since[i] >= self._settle[i]:
+                            state ^= bit
+                            self._busy &= ~bit
+                        else:
+                            self._busy |= bit
+                    else:
+                        self._busy &= ~bit
+            todo >>= 1
+            i += 1
+        self.state = state
+        return state, state ^ prev
@@ -0,0 +1,264 @@
+# framed_upload.py
+#
+# Framed, checksummed upload mode used alongside the plain `PUT <file>` flow.
+#
+#   host: PUTF <size> <crc32-hex> <file>      (fresh upload)
+#         PUTR <size> <crc32-hex> <file>      (resume a dropped upload)
+#         PUTZ <size> <crc32-hex> <zsize> <file>
+#                                             (compressed: frames carry a <zsize>-byte
+#                                              block stream, see ztransfer.py; no resume)
+#   dev:  READY FRAMED <offset> <max_chunk> <window> <prefix-crc32-hex>
+#
+# The host then streams frames starting at <offset>, keeping up to <window>
+# frames unacknowledged:
+#
+#   0x01 | offset:u32le | length:u16le | payload | crc32(payload):u32le
+#
+# Each good frame is answered with `ACK <next_offset>`. A bad CRC or an
+# unexpected offset gets one `NAK <expected_offset>` and the host goes back
+# to that offset. Data is written to `<file>.part` and only renamed over
+# `<file>` once all <size> bytes arrived and the whole-file CRC matches.
+#
+# Frame offsets count wire bytes, so for PUTZ they index the block stream;
+# <size> and the whole-file CRC are always those of the inflated file.
+#
+# A text line `ABORT`, `PUTF ...`, `PUTR ...` or `PUTZ ...` arriving instead of a frame
+# ends the transfer (the part file is kept so PUTR can pick it up later).
+
+import os
+import struct
+
+from ztransfer import BlockInflater
+
+try:
+    from binascii import crc32
+except ImportError:
+    crc32 = None
+
+FRAME_MAGIC = 0x01
+FRAME_HEADER = 7   # magic + offset + length
+FRAME_TRAILER = 4  # crc32
+MAX_CHUNK = 512
+WINDOW = 8
+PART_SUFFIX = ".part"
+CONTROL_WORDS = (b"ABORT", b"PUTF ", b"PUTR ", b"PUTZ ")  # lines accepted between frames
+
+_crc_table = None
+
+
+def _crc32_soft(data, crc=0):
+    global _crc_table
+    if _crc_table is None:
+        _crc_table = []
+        for n in range(256):
+            c = n
+            for _ in range(8):
+                c = (c >> 1) ^ 0xEDB88320 if c & 1 else c >> 1
+            _crc_table.append(c)
+    crc ^= 0xFFFFFFFF
+    for b in data:
+        crc = _crc_table[(crc ^ b) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+def crc32_update(data, crc=0):
+    if crc32 is not None:
+        return crc32(data, crc) & 0xFFFFFFFF
+    return _crc32_soft(data, crc)
+
+
+def _file_size(path):
+    try:
+        return os.stat(path)[6]
+    except OSError:
+        return -1
+
+
+class FramedUpload:
+    """Receiver state for one PUTF/PUTR transfer, fed from a CDCTransport."""
+
+    def __init__(self, cdc, root="/", max_chunk=MAX_CHUNK, window=WINDOW):
+        self.cdc = cdc
+        self.root = root
+        self.max_chunk = max_chunk
+        self.window = window
+        self.active = False
+        self.completed = False
+        self.filename = ""
+        self.file = None
+        self.size = 0
+        self.expected_crc = 0
+        self.offset = 0     # wire bytes received
+        self.wire_size = 0  # == size unless compressed
+        self.written = 0    # file bytes written
+        self.crc = 0
+        self.inflater = None
+        self._nak_for = -1
+
+    def start(self, args, resume=False, compressed=False):
+        """Parse `<size> <crc32-hex> [<zsize>] <file>` and open the part file. Replies READY or ERROR."""
+        try:
+            if compressed:
+                size_s, crc_s, zsize_s, name = args.strip().split(" ", 3)
+                self.wire_size = int(zsize_s)
+            else:
+                size_s, crc_s, name = args.strip().split(" ", 2)
+                self.wire_size = int(size_s)
+            self.size = int(size_s)
+            self.expected_crc = int(crc_s, 16)
+            self.filename = name.strip()
+            if self.size < 0 or self.wire_size < 0 or not self.filename:
+                raise ValueError("bad PUTF arguments")
+        except Exception as e:
+            self.cdc.write(f"ERROR: {e}\n".encode())
+            return False
+
+        part = self.root + self.filename + PART_SUFFIX
+        self.offset = 0
+        self.written = 0
+        self.crc = 0
+        self.inflater = BlockInflater(self._write) if compressed else None
+        if compressed:
+            resume = False  # a part file cannot tell where the block stream stopped
+        try:
+            have = _file_size(part) if resume else -1
+            if 0 <= have <= self.size:
+                # Re-checksum what is already on flash so the host can verify the prefix
+                with open(part, "rb") as f:
+                    buf = bytearray(256)
+                    while True:
+                        n = f.readinto(buf)
+                        if not n:
+                            break
+                        self.crc = crc32_update(memoryview(buf)[:n], self.crc)
+                self.offset = self.written = have
+                self.file = open(part, "ab")
+            else:
+                self.file = open(part, "wb")
+        except Exception as e:
+            self.cdc.write(f"ERROR: {e}\n".encode())
+            return False
+
+        self.active = True
+        self.completed = False
+        self._nak_for = -1
+        self.cdc.write(f"READY FRAMED {self.offset} {self.max_chunk} {self.window} {self.crc:08x}\n".encode())
+        if self.offset == self.wire_size:
+            self._finish()
+        return True
+
+    def _write(self, data):
+        self.file.write(data)
+        self.crc = crc32_update(data, self.crc)
+        self.written += len(data)
+
+    def abort(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+        self.active = False
+
+    def _nak(self):
+        if self._nak_for != self.offset:
+            self._nak_for = self.offset
+            self.cdc.write(f"NAK {self.offset}\n".encode())
+
+    def _finish(self):
+        self.file.close()
+        self.file = None
+        self.active = False
+        part = self.root + self.filename + PART_SUFFIX
+        if self.written != self.size or (self.inflater and not self.inflater.done):
+            error = f"SIZE MISMATCH {self.written}"
+        elif self.crc != self.expected_crc:
+            error = f"CRC MISMATCH {self.crc:08x}"
+        else:
+            error = None
+        self.inflater = None
+        if error:
+            try:
+                os.remove(part)
+            except OSError:
+                pass
+            self.cdc.write(f"ERROR: {error}\n".encode())
+            return
+        dest = self.root + self.filename
+        try:
+            os.remove(dest)
+        except OSError:
+            pass
+        os.rename(part, dest)
+        self.completed = True
+        self.cdc.write(b"FILE RECEIVED\n")
+
+    def feed(self):
+        """
+        Consume every complete frame in the transport buffer.
+        Returns True when the transfer ended during this call; `completed`
+        tells whether the file was committed.
+        """
+        cdc = self.cdc
+        while self.active:
+            avail = cdc.available()
+            if not avail:
+                return False
+            head = cdc.peek(FRAME_HEADER)
+            if head[0] != FRAME_MAGIC:
+                word = bytes(cdc.peek(5))
+                if len(word) < 5:
+                    # wait for the rest of what may be a control word
+                    for w in CONTROL_WORDS:
+                        if w.startswith(word):
+                            return False
+                if word in CONTROL_WORDS:
+                    nl = cdc.find(b"\n")
+                    if nl < 0:
+                        return False
+                    self.abort()
+                    if word == b"ABORT":
+                        cdc.skip(nl + 1)
+                        cdc.write(b"ABORTED\n")
+                    return True
+                # Lost sync: drop bytes up to the next possible frame start
+                nxt = cdc.find(b"\x01")
+                cdc.skip(nxt if nxt > 0 else avail)
+                self._nak()
+                continue
+            if avail < FRAME_HEADER:
+                return False
+            _magic, off, length = struct.unpack("<BIH", bytes(head))
+            if length > self.max_chunk:
+                cdc.skip(1)
+                self._nak()
+                continue
+            total = FRAME_HEADER + length + FRAME_TRAILER
+            if avail < total:
+                return False
+
+            frame = cdc.peek(total)
+            payload = frame[FRAME_HEADER:FRAME_HEADER + length]
+            (want_crc,) = struct.unpack("<I", bytes(frame[FRAME_HEADER + length:total]))
+            if off != self.offset or off + length > self.wire_size or crc32_update(payload) != want_crc:
+                cdc.skip(total)
+                self._nak()
+                continue
+
+            try:
+                if self.inflater:
+                    self.inflater.feed(payload)
+                else:
+                    self._write(payload)
+            except Exception as e:
+                cdc.skip(total)
+                self.abort()
+                cdc.write(f"ERROR: {e}\n".encode())
+                return True
+            self.offset += length
+            cdc.skip(total)
+            self._nak_for = -1
+            cdc.write(f"ACK {self.offset}\n".encode())
+
+            if self.offset >= self.wire_size:
+                self._finish()
+                return True
+        return False
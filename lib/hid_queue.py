@@ -0,0 +1,241 @@
+# hid_queue.py
+
+import time
+
+from macro_compiler import MOD_FIRST
+
+OP_KEYS = 0      # press keycodes, release them after `wait`
+OP_CONSUMER = 1  # one consumer-control report
+OP_STEPS = 2     # stream compiled (modifier, keycode) steps (macro_compiler.py)
+OP_MODS = 3      # set the modifier bits held under every report (MT() holds)
+
+
+class HIDQueue:
+    """
+    Cooperative HID output scheduler.
+
+    Actions are queued as press/release report events with a hold time and
+    drained from the main loop via poll(), so nothing ever sleeps inline.
+    Text macros occupy a single slot holding their compiled steps, which
+    are written straight into the keyboard's report buffer one at a time,
+    so typing allocates nothing and the queue depth stays bounded. A step
+    with the same modifiers as the one held rolls over to it in a single
+    report instead of a release plus a press. Modifiers set with
+    push_mods() stay down under everything sent until they are cleared.
+    """
+
+    def __init__(self, keyboard, consumer=None, depth=32,
+                 hold_time=0.05, key_delay=0.01, max_burst=8):
+        self.kbd = keyboard
+        self.consumer = consumer
+        self.hold_time = hold_time   # combo / single key hold
+        self.key_delay = key_delay   # time between reports while typing text
+        self.max_burst = max_burst   # reports emitted per poll() at most
+
+        self.depth = depth
+        self._ops = [0] * depth
+        self._args = [None] * depth
+        self._waits = [0.0] * depth
+        self._tags = [None] * depth
+        self._head = 0
+        self._count = 0
+
+        self._held = None        # keycodes currently pressed by the queue
+        self._next_due = 0.0
+        self._steps = None       # active step job (bytes)
+        self._step_pos = 0
+        self._step_down = False  # a step is pressed in the report
+        self._steps_tag = None
+        self.mods = 0            # modifier bits held by OP_MODS
+        # adafruit_hid's Keyboard (6.1.7 in lib/) keeps its report in .report;
+        # steps are written there directly and sent without going through
+        # press(). Other versions fall back to the public press()/release_all().
+        report = getattr(keyboard, "report", None)
+        device = getattr(keyboard, "_keyboard_device", None)
+        if isinstance(report, bytearray) and len(report) == 8 and hasattr(device, "send_report"):
+            self._report = report
+            self._send = device.send_report
+        else:
+            self._report = bytearray(8)
+            self._send = self._send_public
+
+    def idle(self):
+        """True when nothing is queued, typing or held."""
+        return self._count == 0 and self._held is None and self._steps is None
+
+    def slack(self, now):
+        """Seconds until the next report is due (<= 0: overdue), or None when idle."""
+        if self.idle():
+            return None
+        return self._next_due - now
+
+    def _push(self, op, arg, wait, tag):
+        if self._count >= self.depth:
+            print("HID queue full, dropping action")
+            return False
+        idx = (self._head + self._count) % self.depth
+        self._ops[idx] = op
+        self._args[idx] = arg
+        self._waits[idx] = wait
+        self._tags[idx] = tag
+        self._count += 1
+        return True
+
+    def push_combo(self, keycodes, hold_time=None, tag=None):
+        if not keycodes:
+            return False
+        return self._push(OP_KEYS, keycodes, self.hold_time if hold_time is None else hold_time, tag)
+
+    def push_consumer(self, code, tag=None):
+        return self._push(OP_CONSUMER, code, 0.0, tag)
+
+    def push_steps(self, steps, tag=None):
+        """Queue compiled text (macro_compiler.text_steps); the bytes are not copied."""
+        if not steps:
+            return False
+        return self._push(OP_STEPS, steps, self.key_delay, tag)
+
+    def push_mods(self, bits):
+        """Hold modifier bits (report byte 0) from this point in the queue on; 0 releases them."""
+        return self._push(OP_MODS, bits, 0.0, None)
+
+    def cancel(self, tag=None):
+        """
+        Drop queued events (all, or only those pushed with `tag`), stop the
+        running text macro and release anything the queue is holding.
+        Returns the number of dropped events.
+        """
+        dropped = 0
+        if self._steps is not None and (tag is None or self._steps_tag == tag):
+            if self._step_down:
+                self._send_step(0, 0)
+            self._steps = None
+            dropped += 1
+
+        kept = 0
+        for n in range(self._count):
+            idx = (self._head + n) % self.depth
+            if tag is None or self._tags[idx] == tag:
+                dropped += 1
+                continue
+            dst = (self._head + kept) % self.depth
+            self._ops[dst] = self._ops[idx]
+            self._args[dst] = self._args[idx]
+            self._waits[dst] = self._waits[idx]
+            self._tags[dst] = self._tags[idx]
+            kept += 1
+        for n in range(kept, self._count):
+            self._args[(self._head + n) % self.depth] = None
+        self._count = kept
+
+        if self._held is not None:
+            self._release()
+        return dropped
+
+    def _send_public(self, rep):
+        """Send a boot report through Keyboard's public API (an extra release report each time)."""
+        kbd = self.kbd
+        kbd.release_all()
+        codes = [MOD_FIRST + n for n in range(8) if rep[0] >> n & 1]
+        for k in rep[2:]:
+            if k:
+                codes.append(k)
+        if codes:
+            kbd.press(*codes)
+
+    def _release(self):
+        # the queue holds one thing at a time, so releasing it leaves only the held modifiers
+        rep = self._report
+        rep[0] = self.mods
+        for i in range(2, len(rep)):
+            rep[i] = 0
+        try:
+            self._send(rep)
+        except Exception as e:
+            print("HID release error:", e)
+        self._held = None
+
+    def _send_step(self, mods, key):
+        rep = self._report
+        rep[0] = mods | self.mods
+        rep[2] = key
+        self._step_down = bool(mods or key)
+        try:
+            self._send(rep)
+        except Exception as e:
+            print("HID send error:", e)
+
+    def _next_step(self, now):
+        """Emit one report of the active step job; returns False once it is finished."""
+        steps = self._steps
+        pos = self._step_pos
+        if pos < len(steps):
+            mods = steps[pos]
+            key = steps[pos + 1]
+            rep = self._report
+            # roll over when only the key changes: one report per character
+            if not self._step_down or (mods | self.mods == rep[0] and key != rep[2] and key and rep[2]):
+                self._send_step(mods, key)
+                self._step_pos = pos + 2
+                self._next_due = now + self.key_delay
+                return True
+        elif not self._step_down:
+            self._steps = None
+            return False
+        self._send_step(0, 0)
+        self._next_due = now + self.key_delay
+        return True
+
+    def poll(self, now=None):
+        """Emit every report that is due. Call this once per main loop pass."""
+        if now is None:
+            now = time.monotonic()
+        emitted = 0
+        while emitted < self.max_burst and now >= self._next_due:
+            if self._held is not None:
+                self._release()
+                self._next_due = now
+                emitted += 1
+                continue
+
+            if self._steps is not None:
+                if self._next_step(now):
+                    emitted += 1
+                continue
+
+            if not self._count:
+                break
+
+            idx = self._head
+            op = self._ops[idx]
+            arg = self._args[idx]
+            wait = self._waits[idx]
+            tag = self._tags[idx]
+            self._args[idx] = None
+            self._head = (self._head + 1) % self.depth
+            self._count -= 1
+
+            try:
+                if op == OP_KEYS:
+                    self.kbd.press(*arg)
+                    self._held = arg
+                    self._next_due = now + wait
+                    emitted += 1
+                elif op == OP_CONSUMER:
+                    if self.consumer:
+                        self.consumer.send(arg)
+                    emitted += 1
+                elif op == OP_MODS:
+                    self.mods = arg
+                    self._report[0] = arg
+                    self._send(self._report)
+                    emitted += 1
+                elif op == OP_STEPS:
+                    self._steps = arg
+                    self._step_pos = 0
+                    self._step_down = False
+                    self._steps_tag = tag
+            except Exception as e:
+                print("HID send error:", e)
+                self._held = None
+        return emitted
@@ -0,0 +1,80 @@
+# key_scanner.py
+
+try:
+    import keypad
+except ImportError:
+    keypad = None
+
+import digitalio
+
+
+class KeyScanner:
+    """
+    Snapshot a set of active-low switches into one integer bitmask per scan.
+
+    scan() returns (pressed, changed): bit n of `pressed` is set while key n is
+    down and bit n of `changed` is set on the scan where key n had an edge.
+    A press and release that both happened since the previous scan (only
+    possible with keypad) is reported in `taps` instead of being lost.
+    Uses CircuitPython's background keypad.Keys scanner when available and
+    falls back to reading DigitalInOut pins.
+    """
+
+    def __init__(self, pins, use_keypad=True, interval=0.002):
+        self.count = len(pins)
+        self.pressed = 0
+        self.taps = 0
+        self._keys = None
+        self._event = None
+        self._pins = []
+        if use_keypad and keypad is not None:
+            self._keys = keypad.Keys(pins, value_when_pressed=False, pull=True, interval=interval)
+            self._event = keypad.Event()
+        else:
+            for pin in pins:
+                io = digitalio.DigitalInOut(pin)
+                io.direction = digitalio.Direction.INPUT
+                io.pull = digitalio.Pull.UP
+                self._pins.append(io)
+
+    @property
+    def backend(self):
+        return "keypad" if self._keys is not None else "digitalio"
+
+    def scan(self):
+        prev = self.pressed
+        if self._keys is not None:
+            events = self._keys.events
+            if events.overflowed:
+                # Lost events: start from scratch, keypad re-reports held keys
+                events.clear()
+                self._keys.reset()
+                self.pressed = prev = 0
+            ev = self._event
+            state = prev
+            taps = 0
+            while events.get_into(ev):
+                bit = 1 << ev.key_number
+                if ev.pressed:
+                    state |= bit
+                else:
+                    if state & bit and not prev & bit:
+                        taps |= bit
+                    state &= ~bit
+            self.pressed = state
+            self.taps = taps
+        else:
+            state = 0
+            bit = 1
+            for io in self._pins:
+                if not io.value:
+                    state |= bit
+                bit <<= 1
+            self.pressed = state
+        return state, state ^ prev
+
+    def deinit(self):
+        if self._keys is not None:
+            self._keys.deinit()
+        for io in self._pins:
+            io.deinit()
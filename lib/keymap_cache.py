@@ -0,0 +1,258 @@
+# keymap_cache.py
+#
+# Compact binary cache of the compiled keymap so boot and RELOAD can skip
+# json.load + normalisation + key compilation when layers.json is unchanged.
+# Layers are indexed by file offset so they can be materialised one at a
+# time (see layer_store.py).
+#
+# The cache is keyed by (size, crc32) of layers.json, with the keymap
+# compiler version folded into the crc so that a firmware whose
+# compile_key_entry() output changed rebuilds it. Layout, little-endian:
+#
+#   "TKC4" | src_size:u32 | src_crc:u32 | grid_size:u8 | n_layers:u16 | index_pos:u32
+#   layer records, each:
+#     name: str16 | macros: str16 (JSON of the layer's macros[], "" if none) | n_keys:u8
+#     per key: label: str16 | key: str16 | action
+#   index (at index_pos):
+#     extra: str16                    JSON of physical_layout + other top-level fields
+#     n_macros:u16, per macro: id:i32 | sequence: str16 | compiled
+#     n_layers x (offset:u32 | length:u32), then n_layers x name: str16
+#
+# str16 is u16 length + UTF-8. An action is a tuple of ints, strings and
+# int tuples: n:u8 then per element 'i' + i32 | 's' + str16 | 't' + n:u8 + n x u16.
+# A compiled macro (code.py compile_macro) is 't' + a keycode tuple or
+# 'b' + u16 length + report steps (macro_compiler.py).
+
+import json
+import os
+import struct
+
+from framed_upload import crc32_update
+
+MAGIC = b"TKC4"
+HEADER_FMT = "<IIBHI"
+HEADER = 19
+
+
+def source_key(path, version=0):
+    """
+    (size, crc32) of the source file, read in small chunks without parsing
+    it. A non-zero compiler `version` is folded into the crc.
+    """
+    size = 0
+    crc = 0
+    buf = bytearray(512)
+    view = memoryview(buf)
+    with open(path, "rb") as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            crc = crc32_update(view[:n], crc)
+            size += n
+    if version:
+        crc = crc32_update(struct.pack("<H", version), crc)
+    return (size, crc)
+
+
+class _Writer:
+    def __init__(self, f):
+        self.f = f
+
+    def u8(self, v):
+        self.f.write(struct.pack("<B", v))
+
+    def u16(self, v):
+        self.f.write(struct.pack("<H", v))
+
+    def i32(self, v):
+        self.f.write(struct.pack("<i", v))
+
+    def str16(self, s):
+        data = str(s).encode()
+        self.u16(len(data))
+        self.f.write(data)
+
+    def action(self, act):
+        self.u8(len(act))
+        for v in act:
+            if isinstance(v, str):
+                self.f.write(b"s")
+                self.str16(v)
+            elif isinstance(v, tuple):
+                self.f.write(b"t")
+                self.u8(len(v))
+                for x in v:
+                    self.u16(x)
+            else:
+                self.f.write(b"i")
+                self.i32(v if v is not None else 0)
+
+    def compiled(self, value):
+        if isinstance(value, tuple):
+            self.f.write(b"t")
+            self.u8(len(value))
+            for x in value:
+                self.u16(x)
+        else:
+            self.f.write(b"b")
+            self.u16(len(value))
+            self.f.write(value)
+
+
+class _Reader:
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def u8(self):
+        v = self.data[self.pos]
+        self.pos += 1
+        return v
+
+    def u16(self):
+        (v,) = struct.unpack_from("<H", self.data, self.pos)
+        self.pos += 2
+        return v
+
+    def i32(self):
+        (v,) = struct.unpack_from("<i", self.data, self.pos)
+        self.pos += 4
+        return v
+
+    def u32(self):
+        (v,) = struct.unpack_from("<I", self.data, self.pos)
+        self.pos += 4
+        return v
+
+    def str16(self):
+        n = self.u16()
+        s = str(self.data[self.pos:self.pos + n], "utf-8")
+        self.pos += n
+        return s
+
+    def action(self):
+        out = []
+        for _ in range(self.u8()):
+            tag = self.u8()
+            if tag == 0x73:  # 's'
+                out.append(self.str16())
+            elif tag == 0x74:  # 't'
+                out.append(tuple(self.u16() for _ in range(self.u8())))
+            else:
+                out.append(self.i32())
+        return tuple(out)
+
+    def compiled(self):
+        if self.u8() == 0x74:  # 't'
+            return tuple(self.u16() for _ in range(self.u8()))
+        n = self.u16()
+        v = bytes(self.data[self.pos:self.pos + n])
+        self.pos += n
+        return v
+
+
+def write(path, key, grid_size, layers, macros, compiled, extra_json):
+    """
+    Write the compiled keymap. layers is indexable (list or LayerStore) and
+    yields dicts with name/labels/keys/actions/macros; each is visited once.
+    compiled maps each macro id to its compiled form.
+    """
+    n_layers = len(layers)
+    spans = []
+    names = []
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        w = _Writer(f)
+        f.write(MAGIC)
+        f.write(struct.pack(HEADER_FMT, key[0], key[1], grid_size, n_layers, 0))
+        for i in range(n_layers):
+            lyr = layers[i]
+            start = f.tell()
+            w.str16(lyr["name"])
+            w.str16(json.dumps(lyr["macros"]) if lyr.get("macros") else "")
+            keys = lyr["keys"]
+            w.u8(len(keys))
+            for k in range(len(keys)):
+                w.str16(lyr["labels"][k])
+                w.str16(keys[k])
+                w.action(lyr["actions"][k])
+            spans.append((start, f.tell() - start))
+            names.append(lyr["name"])
+
+        index_pos = f.tell()
+        w.str16(extra_json)
+        w.u16(len(macros))
+        for mid in macros:
+            w.i32(mid)
+            w.str16(macros[mid])
+            w.compiled(compiled.get(mid, ()))
+        for start, length in spans:
+            f.write(struct.pack("<II", start, length))
+        for name in names:
+            w.str16(name)
+
+        f.seek(4)
+        f.write(struct.pack(HEADER_FMT, key[0], key[1], grid_size, n_layers, index_pos))
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+    os.rename(tmp, path)
+
+
+def open_index(path, key):
+    """
+    Read everything but the layer records if the cache matches key, else None.
+    Returns (grid_size, macros, compiled, extra_json, spans, names); spans are (offset, length).
+    """
+    try:
+        f = open(path, "rb")
+    except OSError:
+        return None
+    with f:
+        head = f.read(4 + HEADER)
+        if len(head) < 4 + HEADER or head[:4] != MAGIC:
+            return None
+        size, crc, grid_size, n_layers, index_pos = struct.unpack_from(HEADER_FMT, head, 4)
+        if (size, crc) != tuple(key):
+            return None
+        f.seek(index_pos)
+        r = _Reader(f.read())
+    extra_json = r.str16()
+    macros = {}
+    compiled = {}
+    for _ in range(r.u16()):
+        mid = r.i32()
+        macros[mid] = r.str16()
+        compiled[mid] = r.compiled()
+    spans = []
+    for _ in range(n_layers):
+        spans.append((r.u32(), r.u32()))
+    names = [r.str16() for _ in range(n_layers)]
+    return grid_size, macros, compiled, extra_json, spans, names
+
+
+def read_layer(path, span):
+    """Materialise one layer record as a dict with name/labels/keys/actions/macros."""
+    with open(path, "rb") as f:
+        f.seek(span[0])
+        data = f.read(span[1])
+    r = _Reader(data)
+    name = r.str16()
+    macros_json = r.str16()
+    n_keys = r.u8()
+    labels = [""] * n_keys
+    keys = [""] * n_keys
+    actions = [None] * n_keys
+    for i in range(n_keys):
+        labels[i] = r.str16()
+        keys[i] = r.str16()
+        actions[i] = r.action()
+    return {
+        "name": name,
+        "labels": labels,
+        "keys": keys,
+        "actions": actions,
+        "macros": json.loads(macros_json) if macros_json else [],
+    }
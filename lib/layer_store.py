@@ -0,0 +1,87 @@
+# layer_store.py
+
+import keymap_cache
+
+
+class LayerStore:
+    """
+    Sequence of layer dicts that keeps only a few layers in RAM.
+
+    Backed by the compiled keymap cache: layer names and record offsets are
+    indexed up front, and a layer is read from flash the first time it is
+    indexed and kept in a small LRU. Pinned layers (edited in RAM and not yet
+    saved) are never evicted. A store built with from_list() holds every
+    layer resident, for when no cache file could be written.
+    """
+
+    def __init__(self, path=None, spans=None, names=None, resident=3):
+        self.path = path
+        self.spans = spans or []
+        self.names = names or []
+        self.resident = max(1, resident)
+        self._layers = {}   # index -> layer dict
+        self._lru = []      # resident indices, most recently used last
+        self._pinned = set()
+        self._last_idx = -1
+        self._last = None
+
+    @classmethod
+    def from_list(cls, layer_list):
+        store = cls(names=[lyr["name"] for lyr in layer_list], resident=len(layer_list))
+        for i, lyr in enumerate(layer_list):
+            store._layers[i] = lyr
+            store._lru.append(i)
+            store._pinned.add(i)
+        return store
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        for i in range(len(self.names)):
+            yield self[i]
+
+    def __getitem__(self, idx):
+        if idx == self._last_idx:
+            return self._last
+        n = len(self.names)
+        if idx < 0:
+            idx += n
+        if not 0 <= idx < n:
+            raise IndexError("layer index out of range")
+
+        lyr = self._layers.get(idx)
+        if lyr is None:
+            lyr = keymap_cache.read_layer(self.path, self.spans[idx])
+            self._layers[idx] = lyr
+            self._lru.append(idx)
+            self._evict()
+        elif self._lru[-1] != idx:
+            self._lru.remove(idx)
+            self._lru.append(idx)
+        self._last_idx = idx
+        self._last = lyr
+        return lyr
+
+    def _evict(self):
+        i = 0
+        # never evict the entry just used (last), even if everything else is pinned
+        while len(self._lru) > self.resident and i < len(self._lru) - 1:
+            idx = self._lru[i]
+            if idx in self._pinned:
+                i += 1
+                continue
+            self._lru.pop(i)
+            del self._layers[idx]
+            if idx == self._last_idx:
+                self._last_idx = -1
+                self._last = None
+
+    def pin(self, idx):
+        """Keep a layer resident (e.g. it holds unsaved PATCH edits)."""
+        self[idx]
+        self._pinned.add(idx)
+
+    def set_name(self, idx, name):
+        self[idx]["name"] = name
+        self.names[idx] = name
@@ -0,0 +1,118 @@
+# loop_stats.py
+
+import array
+import time
+
+try:
+    import gc
+except ImportError:
+    gc = None
+
+BUCKETS = 16
+BUCKET_BASE_US = 16  # bucket 0 is < 16 us, bucket n is < 16 << n us, the last is open-ended
+
+
+class Histogram:
+    """Fixed log2-bucket histogram of durations, kept in a preallocated array."""
+
+    def __init__(self, name):
+        self.name = name
+        self.counts = array.array("L", [0] * BUCKETS)
+        self.count = 0
+        self.total_us = 0
+        self.max_us = 0
+
+    def add_ns(self, ns):
+        us = ns // 1000
+        v = us // BUCKET_BASE_US
+        b = 0
+        while v and b < BUCKETS - 1:
+            v >>= 1
+            b += 1
+        self.counts[b] += 1
+        self.count += 1
+        self.total_us += us
+        if us > self.max_us:
+            self.max_us = us
+
+    def mark(self, start_ns):
+        """Record the time since start_ns and return the current monotonic_ns."""
+        end = time.monotonic_ns()
+        self.add_ns(end - start_ns)
+        return end
+
+    def percentile(self, pct):
+        """Upper edge (us) of the bucket holding the pct-th sample, capped at max."""
+        if not self.count:
+            return 0
+        target = (self.count * pct + 99) // 100
+        seen = 0
+        for b in range(BUCKETS):
+            seen += self.counts[b]
+            if seen >= target:
+                if b == BUCKETS - 1:
+                    return self.max_us
+                return min(BUCKET_BASE_US << b, self.max_us)
+        return self.max_us
+
+    def reset(self):
+        for b in range(BUCKETS):
+            self.counts[b] = 0
+        self.count = 0
+        self.total_us = 0
+        self.max_us = 0
+
+    def line(self):
+        avg = self.total_us // self.count if self.count else 0
+        return (f"STATS {self.name} n={self.count} avg={avg}us max={self.max_us}us "
+                f"p50={self.percentile(50)}us p90={self.percentile(90)}us p99={self.percentile(99)}us")
+
+
+class LoopStats:
+    """
+    Main-loop instrumentation: one Histogram per timed section plus free-heap
+    sampling. Percentiles are bucket upper bounds, so they are exact to a
+    factor of two.
+    """
+
+    def __init__(self, sections=("loop", "keys", "cdc", "hid", "ui", "latency"), heap_every=256):
+        self.sections = [Histogram(name) for name in sections]
+        for h in self.sections:
+            setattr(self, h.name, h)
+        self.heap_every = heap_every
+        self.since_ns = time.monotonic_ns()
+        self.loops = 0
+        self.heap_min = -1
+
+    def tick(self):
+        """Count one main loop pass; samples free heap every heap_every passes."""
+        self.loops += 1
+        if self.loops % self.heap_every == 0:
+            self.sample_heap()
+
+    def sample_heap(self):
+        if gc is None or not hasattr(gc, "mem_free"):
+            return -1
+        free = gc.mem_free()
+        if self.heap_min < 0 or free < self.heap_min:
+            self.heap_min = free
+        return free
+
+    def lines(self):
+        elapsed = max(time.monotonic_ns() - self.since_ns, 1) / 1e9
+        free = self.sample_heap()
+        out = [f"STATS window={elapsed:.1f}s loops={self.loops} loop_rate={self.loops / elapsed:.0f}/s"]
+        for h in self.sections:
+            out.append(h.line())
+        if free < 0:
+            out.append("STATS heap free=n/a min_free=n/a")
+        else:
+            out.append(f"STATS heap free={free} min_free={self.heap_min}")
+        return out
+
+    def reset(self):
+        for h in self.sections:
+            h.reset()
+        self.since_ns = time.monotonic_ns()
+        self.loops = 0
+        self.heap_min = -1
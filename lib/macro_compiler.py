@@ -0,0 +1,45 @@
+# macro_compiler.py
+#
+# Turns macro text into HID report steps once, when layers are loaded, so
+# pressing a macro key only streams precomputed reports (hid_queue.py)
+# instead of looking every character up in the keyboard layout again.
+#
+# A compiled text macro is a bytes object of 2-byte steps:
+#
+#   modifier bits:u8 | keycode:u8   ...
+#
+# Modifier bits are the boot-report modifier byte (bit 0 LEFT_CONTROL ...
+# bit 7 RIGHT_GUI). Characters the layout cannot type are dropped at
+# compile time with a message, not on every press.
+
+MOD_FIRST = 0xE0  # Keycode.LEFT_CONTROL
+MOD_LAST = 0xE7   # Keycode.RIGHT_GUI
+
+
+def modifier_bit(keycode):
+    """Report modifier bit for a modifier keycode, 0 for any other key."""
+    return 1 << (keycode - MOD_FIRST) if MOD_FIRST <= keycode <= MOD_LAST else 0
+
+
+def text_steps(layout, text):
+    """Compile text for `layout` (a KeyboardLayout) into step bytes."""
+    out = bytearray()
+    for ch in text:
+        try:
+            kcs = layout.keycodes(ch)
+        except Exception as e:
+            print("Macro char error:", e)
+            continue
+        mods = 0
+        key = 0
+        for kc in kcs:
+            bit = modifier_bit(kc)
+            if bit:
+                mods |= bit
+            else:
+                key = kc
+        if key or mods:
+            out.append(mods)
+            out.append(key)
+    return bytes(out)
+
@@ -0,0 +1,156 @@
+# tap_hold.py
+
+
+class TapHoldResolver:
+    """
+    Decides whether tap-hold keys (LT/MT) are tapped or held.
+
+    Sits after the Debouncer (and ChordEngine) and works on the same
+    (pressed, changed) bitmasks. While a tap-hold key is undecided, every
+    other key edge is queued instead of reported, then replayed in order
+    once the key is decided:
+
+    - released before `term` ms: tap. The key is reported as an ordinary
+      press, released on the next update.
+    - held for `term` ms, or (permissive hold) another key was pressed and
+      released while it was down: hold. The key is never reported; it is
+      set in `hold_started` on that update and in `hold_ended` on the
+      update it is released.
+    - pressed again within `quick_tap` ms of its last tap: tap at once and
+      stay pressed, so auto-repeat works.
+
+    A tap is reported on release, so tapping costs no tapping-term delay.
+    Replayed presses go out one per update to keep their order.
+    """
+
+    def __init__(self, term_ms=200, quick_tap_ms=150, permissive=True, depth=32):
+        self.term = term_ms
+        self.quick_tap = quick_tap_ms
+        self.permissive = permissive
+        self.depth = depth
+        self.hold_started = 0
+        self.hold_ended = 0
+        self._queue = [0] * depth  # key * 2 + down, oldest at _head
+        self._head = 0
+        self._count = 0
+        self._carry = 0           # edges that did not fit in the queue yet
+        self._pending = -1        # undecided key index
+        self._since = 0           # ms its press was seen
+        self._holding = 0         # keys resolved as hold and still down
+        self._out = 0
+        self._last_tap = -1       # key index and release time of the last tap
+        self._last_tap_ms = 0
+
+    def configure(self, term_ms=None, quick_tap_ms=None, permissive=None):
+        if term_ms is not None:
+            self.term = term_ms
+        if quick_tap_ms is not None:
+            self.quick_tap = quick_tap_ms
+        if permissive is not None:
+            self.permissive = permissive
+
+    def busy(self):
+        return self._pending >= 0 or self._count > 0
+
+    def _push(self, ev):
+        self._queue[(self._head + self._count) % self.depth] = ev
+        self._count += 1
+
+    def _pop(self):
+        self._head = (self._head + 1) % self.depth
+        self._count -= 1
+
+    def _decision(self, now_ms):
+        """For the pending key: 1 tap, 2 hold, 0 undecided."""
+        p = self._pending
+        down = 0  # keys pressed after the pending key
+        for n in range(self._count):
+            ev = self._queue[(self._head + n) % self.depth]
+            key = ev >> 1
+            if key == p:
+                return 1 if not ev & 1 else 2
+            bit = 1 << key
+            if ev & 1:
+                down |= bit
+            elif down & bit and self.permissive:
+                return 2
+        if now_ms - self._since >= self.term or self._count >= self.depth:
+            return 2
+        return 0
+
+    def update(self, pressed, changed, now_ms, th_mask):
+        """th_mask: keys that are tap-hold keys on the current layer."""
+        self.hold_started = 0
+        self.hold_ended = 0
+        prev = self._out
+        changed ^= self._carry  # carried edges, net of any change since
+        self._carry = 0
+        if not changed and self._pending < 0 and not self._count:
+            return prev, 0
+
+        replaying = self._count > 0  # edges left over from a decision
+        i = 0
+        bits = changed
+        while bits:
+            if bits & 1:
+                if self._count >= self.depth:
+                    # full (the pending key is decided below): queue the rest later
+                    self._carry = bits << i
+                    break
+                self._push(i * 2 + (1 if pressed & (1 << i) else 0))
+            bits >>= 1
+            i += 1
+
+        out = prev
+        touched = 0
+        while True:
+            if self._pending >= 0:
+                decision = self._decision(now_ms)
+                if not decision:
+                    break
+                bit = 1 << self._pending
+                if decision == 1:
+                    out |= bit  # its release is still queued: next update
+                    touched |= bit
+                    self._last_tap = self._pending
+                    self._last_tap_ms = now_ms
+                else:
+                    self._holding |= bit
+                    self.hold_started |= bit
+                self._pending = -1
+                break  # replay the queue from the next update, with the new layer in effect
+            if not self._count:
+                break
+            ev = self._queue[self._head]
+            key = ev >> 1
+            bit = 1 << key
+            if touched & bit:
+                break  # press and release of one key never share an update
+            if ev & 1:
+                if th_mask & bit:
+                    if key == self._last_tap and now_ms - self._last_tap_ms < self.quick_tap:
+                        out |= bit  # quick tap: tap and keep it pressed
+                    else:
+                        self._pending = key
+                        self._since = now_ms
+                        self._pop()
+                        continue
+                else:
+                    out |= bit
+                touched |= bit
+                self._pop()
+                if replaying:
+                    break
+            else:
+                if self._holding & bit:
+                    self._holding &= ~bit
+                    self.hold_ended |= bit
+                else:
+                    out &= ~bit
+                    if key == self._last_tap:
+                        self._last_tap_ms = now_ms
+                touched |= bit
+                self._pop()
+
+        self._out = out
+        return out, out ^ prev
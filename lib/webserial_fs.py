@@ -3,107 +3,142 @@
 import os
 import usb_cdc
 
+from cdc_transport import CDCTransport
+from framed_upload import FramedUpload
+import binproto
+import ztransfer
+
+EOF_MARKER = b"<EOF>"
+
+
 class USBFileServer:
     def __init__(self, uart=None):
         # Use usb_cdc.data if available, otherwise fallback to console
         self.uart = uart if uart else (usb_cdc.data if usb_cdc.data else usb_cdc.console)
-        self.buffer = b""
+        self.cdc = CDCTransport(self.uart)
+        self.upload = FramedUpload(self.cdc, root="/")
+        self.bin_files = binproto.BinaryFileOps(self.cdc, root="/")
+        self.binary_mode = False
         self.receiving_file = False
         self.file = None
         self.filename = ""
 
     def poll(self):
         """Call this repeatedly inside your main loop."""
-        if self.receiving_file:
-            self._receive_file_data()
-        else:
-            self._read_command()
+        self.cdc.poll()
+        while True:
+            if self.receiving_file:
+                if not self._receive_file_data():
+                    break
+                continue
+            if self.upload.active:
+                if not self.upload.feed():
+                    break
+                continue
+            if self.binary_mode and binproto.at_frame(self.cdc):
+                if not self._read_frame():
+                    break
+                continue
+            if not self._read_command():
+                break
+        self.cdc.flush()
 
     def _read_command(self):
-        while self.uart.in_waiting:
-            char = self.uart.read(1)
-            if char == b'\r':
-                continue
-            if char == b'\n':
-                try:
-                    cmd = self.buffer.decode().strip()
-                    if cmd:
-                        self._handle_command(cmd)
-                except Exception as e:
-                    self.uart.write(b"ERR: " + str(e).encode() + b"\n")
-                self.buffer = b""
-            else:
-                self.buffer += char
+        line = self.cdc.readline()
+        if line is None:
+            return False
+        try:
+            cmd = line.decode().strip()
+            if cmd:
+                self._handle_command(cmd)
+        except Exception as e:
+            self.cdc.write(b"ERR: " + str(e).encode() + b"\n")
+        return True
+
+    def _read_frame(self):
+        frame = binproto.read_frame(self.cdc)
+        if frame is None:
+            return False
+        ftype, seq, payload, total = frame
+        if ftype == binproto.T_PROTO_TEXT:
+            self.binary_mode = False
+            binproto.write_frame(self.cdc, binproto.R_OK, seq)
+        elif ftype is not None and not self.bin_files.handle(ftype, seq, payload):
+            binproto.write_frame(self.cdc, binproto.R_ERR, seq, b"UNKNOWN FRAME")
+        self.cdc.skip(total)
+        return True
 
     def _receive_file_data(self):
-        if self.uart.in_waiting:
-            data = self.uart.read(self.uart.in_waiting)
-            self.buffer += data
-
-            if b"<EOF>" in self.buffer:
-                # split only once so leftover commands are preserved
-                parts = self.buffer.split(b"<EOF>", 1)
-                if self.file:
-                    self.file.write(parts[0])
-                    self.file.close()
-                    self.file = None
-                self.receiving_file = False
-                self.uart.write(b"FILE RECEIVED\n")
-                self.buffer = parts[1]
-
-                # process any leftover command immediately
-                if self.buffer.strip():
-                    try:
-                        self._handle_command(self.buffer.decode().strip())
-                    except Exception as e:
-                        self.uart.write(b"ERR: " + str(e).encode() + b"\n")
-                    self.buffer = b""
-            else:
-                if self.file:
-                    self.file.write(self.buffer)
-                    self.buffer = b""  # flush after writing
+        idx = self.cdc.find(EOF_MARKER)
+        if idx >= 0:
+            if self.file:
+                if idx:
+                    self.file.write(self.cdc.peek(idx))
+                self.file.close()
+                self.file = None
+            self.cdc.skip(idx + len(EOF_MARKER))
+            self.receiving_file = False
+            self.cdc.write(b"FILE RECEIVED\n")
+            # leftover bytes are handled as commands by poll()
+            return True
+
+        # keep a possible partial marker buffered until the next read
+        n = self.cdc.available() - (len(EOF_MARKER) - 1)
+        if n > 0:
+            if self.file:
+                self.file.write(self.cdc.peek(n))
+            self.cdc.skip(n)
+        return False
 
     def _handle_command(self, cmd):
         if cmd == "LIST":
             try:
-                self.uart.write(b"Files:\n")
+                self.cdc.write(b"Files:\n")
                 for f in os.listdir("/"):
-                    self.uart.write((f + "\n").encode())
-                self.uart.write(b"<END>\n")
+                    self.cdc.write((f + "\n").encode())
+                self.cdc.write(b"<END>\n")
             except Exception as e:
-                self.uart.write(b"ERROR: " + str(e).encode() + b"\n")
+                self.cdc.write(b"ERROR: " + str(e).encode() + b"\n")
 
         elif cmd.startswith("DEL "):
             fname = cmd[4:].strip()
             try:
                 os.remove("/" + fname)
-                self.uart.write(b"DELETED\n")
+                self.cdc.write(b"DELETED\n")
             except Exception as e:
-                self.uart.write(b"ERROR: " + str(e).encode() + b"\n")
+                self.cdc.write(b"ERROR: " + str(e).encode() + b"\n")
 
         elif cmd.startswith("PUT "):
             self.filename = cmd[4:].strip()
             try:
                 self.file = open("/" + self.filename, "wb")
                 self.receiving_file = True
-                self.buffer = b""  # reset buffer for file data
-                self.uart.write(b"READY\n")
+                self.cdc.write(b"READY\n")
             except Exception as e:
-                self.uart.write(b"ERROR: " + str(e).encode() + b"\n")
+                self.cdc.write(b"ERROR: " + str(e).encode() + b"\n")
 
-        elif cmd.startswith("GET "):
-            fname = cmd[4:].strip()
+        elif cmd.startswith("PUTF ") or cmd.startswith("PUTR ") or cmd.startswith("PUTZ "):
+            self.upload.start(cmd[5:], resume=cmd.startswith("PUTR "), compressed=cmd.startswith("PUTZ "))
+
+        elif cmd.startswith("GET ") or cmd.startswith("GETZ "):
             try:
-                with open("/" + fname, "rb") as f:
-                    while True:
-                        chunk = f.read(512)
-                        if not chunk:
-                            break
-                        self.uart.write(chunk)
-                self.uart.write(b"<EOF>\n")
+                fname, offset, length = ztransfer.parse_range(cmd[cmd.index(" ") + 1:])
+                if cmd.startswith("GETZ "):
+                    ztransfer.send_blocks(self.cdc, "/" + fname, offset, length)
+                else:
+                    ztransfer.send_range(self.cdc, "/" + fname, offset, length)
+                    self.cdc.write(b"<EOF>\n")
             except Exception as e:
-                self.uart.write(b"ERROR: " + str(e).encode() + b"\n")
+                self.cdc.write(b"ERROR: " + str(e).encode() + b"\n")
+
+        elif cmd == "PROTO BIN":
+            self.binary_mode = True
+            self.cdc.write(b"PROTO BIN OK\n")
+
+        elif cmd == "PROTO TEXT":
+            self.binary_mode = False
+            self.cdc.write(b"PROTO TEXT OK\n")
 
         else:
-            self.uart.write(b"UNKNOWN COMMAND\n")
+            self.cdc.write(b"UNKNOWN COMMAND\n")
 
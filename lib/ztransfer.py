@@ -0,0 +1,198 @@
+# ztransfer.py
+#
+# Ranged and compressed file transfers on the CDC command channel.
+#
+#   GET  <file> [<offset> <length>]          raw bytes of the range, then <EOF>
+#   GETZ <file> [<offset> <length>]          ZDATA <length>, then a block stream, then <EOF>
+#   PUTZ <size> <crc32-hex> <zsize> <file>   framed upload (framed_upload.py) whose
+#                                            frames carry a <zsize>-byte block stream
+#
+# Block stream (both directions):
+#
+#   hdr:u16le | payload   ...   0x0000
+#
+# With bit 15 of hdr set the payload is `hdr & 0x7FFF` stored bytes,
+# otherwise it is a zlib stream of that length that inflates to at most
+# BLOCK bytes. Blocks are independent, so the receiver inflates one at a
+# time with plain zlib.decompress() and never holds more than one block;
+# the sender stores any block that does not shrink. CircuitPython's zlib
+# can only inflate, so on the device GETZ sends stored blocks unless the
+# port's zlib also has compress().
+
+import os
+import struct
+
+try:
+    import zlib
+except ImportError:
+    zlib = None
+
+BLOCK = 4096           # max inflated bytes per block
+STORED = 0x8000
+WBITS = 12             # 4 KiB window: a block never needs more
+CHUNK = 512            # raw GET read size
+EOF_LINE = b"<EOF>\n"
+END = b"\x00\x00"
+
+can_inflate = zlib is not None and hasattr(zlib, "decompress")
+can_deflate = zlib is not None and hasattr(zlib, "compress")
+
+
+def parse_range(args):
+    """`<file> [<offset> <length>]` -> (file, offset, length); length -1 means to the end."""
+    args = args.strip()
+    parts = args.rsplit(" ", 2)
+    if len(parts) == 3 and parts[1].isdigit() and parts[2].isdigit():
+        return parts[0].strip(), int(parts[1]), int(parts[2])
+    return args, 0, -1
+
+
+def range_size(path, offset, length):
+    size = os.stat(path)[6]
+    end = size if length < 0 else min(size, offset + length)
+    return max(0, end - offset)
+
+
+def send_range(cdc, path, offset=0, length=-1, buf=None):
+    """Write bytes [offset, offset + length) of path to cdc. Returns the count."""
+    if buf is None:
+        buf = bytearray(CHUNK)
+    view = memoryview(buf)
+    sent = 0
+    with open(path, "rb") as f:
+        if offset:
+            f.seek(offset)
+        while length < 0 or sent < length:
+            want = len(buf) if length < 0 else min(len(buf), length - sent)
+            n = f.readinto(view[:want])
+            if not n:
+                break
+            cdc.write(view[:n])
+            sent += n
+    return sent
+
+
+def _deflate(data):
+    try:
+        return zlib.compress(data, 9, WBITS)
+    except TypeError:
+        return zlib.compress(data)  # ports without level/wbits arguments
+
+
+def send_blocks(cdc, path, offset=0, length=-1, block=BLOCK):
+    """GETZ reply: `ZDATA <n>` line, the range as a block stream, then <EOF>."""
+    remaining = range_size(path, offset, length)
+    cdc.write(f"ZDATA {remaining}\n".encode())
+    buf = bytearray(block)
+    view = memoryview(buf)
+    hdr = bytearray(2)
+    with open(path, "rb") as f:
+        if offset:
+            f.seek(offset)
+        while remaining:
+            n = f.readinto(view[:min(block, remaining)])
+            if not n:
+                break
+            raw = view[:n]
+            z = _deflate(raw) if can_deflate else None
+            if z is not None and len(z) < n:
+                struct.pack_into("<H", hdr, 0, len(z))
+                cdc.write(hdr)
+                cdc.write(z)
+            else:
+                struct.pack_into("<H", hdr, 0, STORED | n)
+                cdc.write(hdr)
+                cdc.write(raw)
+            remaining -= n
+    cdc.write(END)
+    cdc.write(EOF_LINE)
+
+
+class BlockInflater:
+    """
+    Inflates a block stream fed in arbitrary pieces (upload frames);
+    write(data) is called with each block's bytes. Memory stays at one
+    block plus its header no matter how large the file is.
+    """
+
+    def __init__(self, write, block=BLOCK):
+        self.write = write
+        self.block = block
+        self._buf = bytearray(2 + block)
+        self._view = memoryview(self._buf)
+        self._have = 0
+        self._need = 2
+        self.done = False  # end marker seen
+        self.out = 0       # inflated bytes so far
+
+    def feed(self, data):
+        pos = 0
+        total = len(data)
+        while pos < total:
+            if self.done:
+                raise ValueError("data after end of block stream")
+            take = min(self._need - self._have, total - pos)
+            self._buf[self._have:self._have + take] = data[pos:pos + take]
+            self._have += take
+            pos += take
+            if self._have < self._need:
+                return
+            hdr = self._buf[0] | self._buf[1] << 8
+            if self._need == 2:
+                if hdr == 0:
+                    self.done = True
+                    self._have = 0
+                    continue
+                if (hdr & 0x7FFF) > self.block:
+                    raise ValueError("block too large")
+                self._need = 2 + (hdr & 0x7FFF)
+                continue
+            body = self._view[2:self._need]
+            if hdr & STORED:
+                out = body
+            else:
+                if not can_inflate:
+                    raise ValueError("zlib not available")
+                out = zlib.decompress(body)
+                if len(out) > self.block:
+                    raise ValueError("block inflates too large")
+            self.write(out)
+            self.out += len(out)
+            self._have = 0
+            self._need = 2
+
+
+def deflate_blocks(data, block=BLOCK, level=9):
+    """Host side: data as a complete block stream (end marker included)."""
+    out = bytearray()
+    for pos in range(0, len(data), block):
+        raw = data[pos:pos + block]
+        co = zlib.compressobj(level, zlib.DEFLATED, WBITS)
+        z = co.compress(raw) + co.flush()
+        if len(z) < len(raw):
+            out += struct.pack("<H", len(z)) + z
+        else:
+            out += struct.pack("<H", STORED | len(raw)) + raw
+    return bytes(out + END)
+
+
+def block_stream_end(buf, start=0):
+    """Index just past the end marker of the block stream at buf[start:], or -1 if incomplete."""
+    pos = start
+    while pos + 2 <= len(buf):
+        hdr = buf[pos] | buf[pos + 1] << 8
+        pos += 2
+        if hdr == 0:
+            return pos
+        pos += hdr & 0x7FFF
+    return -1
+
+
+def inflate_blocks(buf):
+    """Host side: decode a complete block stream."""
+    out = bytearray()
+    inflater = BlockInflater(out.extend)
+    inflater.feed(buf)
+    if not inflater.done:
+        raise ValueError("truncated block stream")
+    return bytes(out)
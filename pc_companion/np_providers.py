@@ -0,0 +1,307 @@
+"""Now-playing sources for the companion.
+
+A provider watches a player and reports to a sink (normally a
+trkey_link.NowPlayingSync):
+
+    sink.update(title=..., artist=..., source=..., duration=..., position=..., playing=...)
+    await sink.clear()
+
+Any subset of fields may be passed to update(); the sink drops reports that
+change nothing on the device and rate-limits the rest. Providers are event
+driven: they wait for D-Bus signals or pipe input and never poll the player.
+
+    mpris[:<name>]   Linux media players over D-Bus/MPRIS (needs: pip install dbus-next)
+    file:<path>      JSON lines from a FIFO, or a JSON file that another program rewrites
+
+File/FIFO lines are JSON objects with any of the update() fields, plus
+"status": "playing" | "paused" | "stopped" as an alternative to "playing".
+"stopped" (or {"clear": true}) hides the now-playing view.
+
+    mkfifo /tmp/trkey-np
+    python trkey_music_companion.py --port /dev/ttyACM0 --source file:/tmp/trkey-np
+    echo '{"title": "Song", "artist": "Artist", "duration": 200, "position": 0}' > /tmp/trkey-np
+"""
+
+import asyncio
+import json
+import os
+import stat
+import sys
+
+try:
+    from dbus_next import BusType
+    from dbus_next.aio import MessageBus
+except Exception:
+    MessageBus = None
+    BusType = None
+
+FIELDS = ("title", "artist", "source", "duration", "position", "playing")
+
+
+class NowPlayingProvider:
+    """Base class: run(sink) reports player changes until cancelled."""
+
+    name = "provider"
+
+    async def run(self, sink):
+        raise NotImplementedError
+
+
+def _report(sink, state):
+    """Forward one decoded state dict to the sink; returns a clear() awaitable for stop."""
+    status = str(state.get("status", "")).lower()
+    if state.get("clear") or status == "stopped":
+        return sink.clear()
+    fields = {k: state[k] for k in FIELDS if k in state}
+    if status in ("playing", "paused"):
+        fields["playing"] = status == "playing"
+    if fields:
+        sink.update(**fields)
+    return None
+
+
+class FileProvider(NowPlayingProvider):
+    """
+    JSON now-playing updates from a FIFO (one object per line, read as it
+    arrives) or from a regular file holding one object. A regular file is
+    re-read when its mtime/size changes, checked every `interval` seconds
+    with a stat() - nothing is read while it stays the same.
+    """
+
+    name = "file"
+
+    def __init__(self, path, interval=1.0):
+        self.path = path
+        self.interval = interval
+
+    async def run(self, sink):
+        if stat.S_ISFIFO(os.stat(self.path).st_mode):
+            await self._run_fifo(sink)
+        else:
+            await self._run_file(sink)
+
+    async def _handle(self, sink, text):
+        try:
+            state = json.loads(text)
+        except ValueError:
+            # an appended-to file: the last line is the current state
+            try:
+                state = json.loads(text.splitlines()[-1])
+            except ValueError as exc:
+                print(f"[np-file] bad input {text[-80:]!r}: {exc}", file=sys.stderr)
+                return
+        if not isinstance(state, dict):
+            return
+        pending = _report(sink, state)
+        if pending is not None:
+            await pending
+
+    async def _run_fifo(self, sink):
+        loop = asyncio.get_running_loop()
+        fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+        # Hold a writer open ourselves so the FIFO never reports EOF (and wakes us
+        # in a loop) between writers.
+        keep = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+        lines = asyncio.Queue()
+        buf = bytearray()
+
+        def readable():
+            try:
+                data = os.read(fd, 4096)
+            except BlockingIOError:
+                return
+            buf.extend(data)
+            while True:
+                nl = buf.find(b"\n")
+                if nl < 0:
+                    break
+                line = buf[:nl].decode("utf-8", errors="replace").strip()
+                del buf[:nl + 1]
+                if line:
+                    lines.put_nowait(line)
+
+        loop.add_reader(fd, readable)
+        try:
+            while True:
+                await self._handle(sink, await lines.get())
+        finally:
+            loop.remove_reader(fd)
+            os.close(fd)
+            os.close(keep)
+
+    async def _run_file(self, sink):
+        seen = None
+        while True:
+            try:
+                st = os.stat(self.path)
+                sig = (st.st_mtime_ns, st.st_size)
+            except OSError:
+                sig = None
+            if sig is not None and sig != seen:
+                seen = sig
+                with open(self.path, encoding="utf-8") as f:
+                    text = f.read().strip()
+                if text:
+                    await self._handle(sink, text)
+            await asyncio.sleep(self.interval)
+
+
+MPRIS_PREFIX = "org.mpris.MediaPlayer2."
+MPRIS_PATH = "/org/mpris/MediaPlayer2"
+MPRIS_PLAYER = "org.mpris.MediaPlayer2.Player"
+
+
+def _value(variant, default=None):
+    return getattr(variant, "value", default) if variant is not None else default
+
+
+class MprisProvider(NowPlayingProvider):
+    """
+    Follows an MPRIS media player on the D-Bus session bus. Metadata and
+    playback status arrive as PropertiesChanged signals and seeks as the
+    Seeked signal; the position is only read when one of those fires. With
+    no `player` given, the first org.mpris.MediaPlayer2.* name is used, and
+    the provider moves on to another player when it exits.
+    """
+
+    name = "mpris"
+
+    def __init__(self, player=None, bus=None):
+        if MessageBus is None and bus is None:
+            raise RuntimeError("Missing dependency: dbus-next. Install with: pip install dbus-next")
+        self.player = player  # bus name suffix, e.g. "spotify"; None: any player
+        self.bus = bus
+        self.sink = None
+        self.current = None  # bus name being followed
+        self.identity = ""
+        self._daemon = None
+        self._iface = None
+        self._props = None
+
+    def _wanted(self, name):
+        if not name.startswith(MPRIS_PREFIX):
+            return False
+        if self.player is None:
+            return True
+        suffix = name[len(MPRIS_PREFIX):]
+        return suffix == self.player or suffix.startswith(self.player + ".")
+
+    async def run(self, sink):
+        self.sink = sink
+        if self.bus is None:
+            self.bus = await MessageBus(bus_type=BusType.SESSION).connect()
+        intro = await self.bus.introspect("org.freedesktop.DBus", "/org/freedesktop/DBus")
+        self._daemon = self.bus.get_proxy_object("org.freedesktop.DBus", "/org/freedesktop/DBus", intro) \
+            .get_interface("org.freedesktop.DBus")
+        self._daemon.on_name_owner_changed(self._on_owner_changed)
+        await self._attach_any()
+        try:
+            await self.bus.wait_for_disconnect()
+        finally:
+            self._daemon.off_name_owner_changed(self._on_owner_changed)
+            self._detach()
+
+    async def _attach_any(self, skip=None):
+        for name in sorted(await self._daemon.call_list_names()):
+            if name != skip and self._wanted(name):
+                await self._attach(name)
+                return
+
+    def _on_owner_changed(self, name, old_owner, new_owner):
+        if not self._wanted(name):
+            return
+        if not new_owner and name == self.current:
+            asyncio.ensure_future(self._player_gone(name))
+        elif new_owner and self.current is None:
+            asyncio.ensure_future(self._attach(name))
+
+    async def _player_gone(self, name):
+        self._detach()
+        await self.sink.clear()
+        await self._attach_any(skip=name)
+
+    async def _attach(self, name):
+        if self.current is not None:
+            return
+        self.current = name
+        try:
+            intro = await self.bus.introspect(name, MPRIS_PATH)
+            obj = self.bus.get_proxy_object(name, MPRIS_PATH, intro)
+            self._iface = obj.get_interface(MPRIS_PLAYER)
+            self._props = obj.get_interface("org.freedesktop.DBus.Properties")
+            try:
+                self.identity = await obj.get_interface("org.mpris.MediaPlayer2").get_identity()
+            except Exception:
+                self.identity = name[len(MPRIS_PREFIX):].split(".")[0]
+            self._props.on_properties_changed(self._on_properties_changed)
+            self._iface.on_seeked(self._on_seeked)
+            metadata = await self._iface.get_metadata()
+            status = await self._iface.get_playback_status()
+        except Exception as exc:
+            print(f"[mpris] cannot follow {name}: {exc}", file=sys.stderr)
+            self._detach()
+            return
+        await self._publish(metadata, status)
+
+    def _detach(self):
+        if self._props is not None:
+            self._props.off_properties_changed(self._on_properties_changed)
+        if self._iface is not None:
+            self._iface.off_seeked(self._on_seeked)
+        self._props = self._iface = None
+        self.current = None
+
+    def _on_properties_changed(self, interface, changed, _invalidated):
+        if interface != MPRIS_PLAYER or self._iface is None:
+            return
+        metadata = _value(changed.get("Metadata"))
+        status = _value(changed.get("PlaybackStatus"))
+        if metadata is not None or status is not None:
+            asyncio.ensure_future(self._publish(metadata, status))
+
+    def _on_seeked(self, position_us):
+        self.sink.update(position=position_us / 1000000)
+
+    async def _position(self):
+        try:
+            return await self._iface.get_position() / 1000000
+        except Exception:
+            return None  # players may not implement Position
+
+    async def _publish(self, metadata, status):
+        if self._iface is None:
+            return
+        if status == "Stopped":
+            await self.sink.clear()
+            return
+        fields = {}
+        if metadata is not None:
+            artist = _value(metadata.get("xesam:artist"), [])
+            fields["title"] = _value(metadata.get("xesam:title"), "")
+            fields["artist"] = ", ".join(artist) if isinstance(artist, list) else str(artist)
+            fields["duration"] = int(_value(metadata.get("mpris:length"), 0) or 0) // 1000000
+            fields["source"] = self.identity
+        if status is not None:
+            fields["playing"] = status == "Playing"
+        position = await self._position()
+        if position is not None:
+            fields["position"] = position
+        self.sink.update(**fields)
+
+
+PROVIDERS = {
+    "mpris": MprisProvider,
+    "file": FileProvider,
+}
+
+
+def make_provider(spec):
+    """Provider from a `--source` spec: "mpris", "mpris:<player>" or "file:<path>"."""
+    kind, _, arg = spec.partition(":")
+    if kind not in PROVIDERS:
+        raise ValueError(f"unknown now-playing source {kind!r} (choose from {', '.join(PROVIDERS)})")
+    if kind == "file":
+        if not arg:
+            raise ValueError("file source needs a path: file:<path>")
+        return FileProvider(arg)
+    return MprisProvider(arg or None)
@@ -0,0 +1,815 @@
+"""Asyncio link to a Trkey macropad over its USB CDC serial port.
+
+Library API used by trkey_music_companion.py; also importable on its own:
+
+    import asyncio
+    from trkey_link import TrkeyDevice
+
+    async def main():
+        async with TrkeyDevice("/dev/ttyACM0") as dev:
+            dev.on_event(lambda action: print("pad pressed", action))
+            await dev.np_set("Track", "Artist", 12, 180, "Spotify")
+            await asyncio.sleep(60)
+
+    asyncio.run(main())
+
+Device output is read as it arrives (no polling, no blocking reads on the
+event loop): `APP_EVENT` lines are dispatched to on_event handlers
+immediately, replies resolve the pending request that expects them, and
+anything else goes to on_line handlers.
+"""
+
+import asyncio
+import inspect
+import json
+import os
+import struct
+import sys
+import threading
+import zlib
+
+# Frame layouts are shared with the firmware (lib/binproto.py)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+import binproto  # noqa: E402
+import ztransfer  # noqa: E402
+
+try:
+    import serial
+    from serial.tools import list_ports
+except Exception:
+    serial = None
+    list_ports = None
+
+ERROR_PREFIXES = ("ERROR", "UNKNOWN COMMAND")
+COMPRESS_MIN = 512     # smaller uploads are sent as they are
+COMPRESS_RATIO = 0.9   # compress only if the block stream is at most this fraction of the file
+
+
+def format_frame(ftype, payload):
+    """Render a device frame as the equivalent text-protocol line for display."""
+    if ftype == binproto.E_APP_EVENT:
+        return "APP_EVENT " + payload.decode("utf-8", errors="replace")
+    if ftype == binproto.R_OK:
+        return "OK"
+    if ftype == binproto.R_ERR:
+        return "ERROR: " + payload.decode("utf-8", errors="replace")
+    if ftype == binproto.R_ACK:
+        return f"ACK {struct.unpack_from('<I', payload)[0]}"
+    if ftype == binproto.R_NP:
+        title, artist, source, pos, dur, flags = binproto.unpack_np(payload)
+        # same keys as the text NP_GET reply
+        return json.dumps({"title": title, "artist": artist, "position": pos,
+                           "duration": dur, "source": source, "playing": bool(flags & binproto.NP_PLAYING)})
+    if ftype == binproto.R_LIST:
+        return "Files:\n" + payload.decode("utf-8", errors="replace") + "\n<END>"
+    return f"[frame 0x{ftype:02x}] {payload.hex()}"
+
+
+class StreamParser:
+    """
+    Splits device output into text lines. In binary mode a sync byte at a line
+    boundary starts a frame, which is rendered with format_frame().
+    """
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.binary = False
+        self.raw = None  # reader(buf) -> bytes consumed, or None for more data; see TrkeyDevice.expect_body
+
+    def feed(self, data, emit=None):
+        """Split data into lines; with emit, each line is passed to it as soon as it is complete."""
+        self.buf += data
+        out = []
+        if emit is None:
+            emit = out.append
+        buf = self.buf
+        while buf:
+            if self.raw is not None:
+                n = self.raw(buf)
+                if n is None:
+                    break
+                del buf[:n]
+                continue
+            if self.binary and buf[0] == binproto.SYNC:
+                if len(buf) < binproto.HEADER:
+                    break
+                _sync, ftype, _seq, length = struct.unpack_from(binproto.HEADER_FMT, buf, 0)
+                if len(buf) < binproto.HEADER + length:
+                    break
+                payload = bytes(buf[binproto.HEADER:binproto.HEADER + length])
+                del buf[:binproto.HEADER + length]
+                for line in format_frame(ftype, payload).split("\n"):
+                    emit(line)
+                continue
+            nl = buf.find(b"\n")
+            if nl < 0:
+                break
+            line = buf[:nl].decode("utf-8", errors="replace").strip()
+            del buf[:nl + 1]
+            if line:
+                emit(line)
+        return out
+
+
+class SerialTransport:
+    """
+    Non-blocking reads from a pyserial port. On POSIX the port's file
+    descriptor is watched by the event loop; elsewhere a small reader thread
+    hands data to the loop with call_soon_threadsafe.
+    """
+
+    def __init__(self, ser, loop, on_data):
+        self.ser = ser
+        self.loop = loop
+        self.on_data = on_data
+        self._fd = None
+        self._thread = None
+        self._closing = False
+
+    def start(self):
+        fd = None
+        if os.name == "posix":
+            try:
+                fd = self.ser.fileno()
+            except Exception:
+                fd = None
+        if fd is not None:
+            self.ser.timeout = 0
+            self._fd = fd
+            self.loop.add_reader(fd, self._readable)
+        else:
+            self.ser.timeout = 0.1
+            self._thread = threading.Thread(target=self._read_thread, daemon=True)
+            self._thread.start()
+
+    def _readable(self):
+        try:
+            data = self.ser.read(self.ser.in_waiting or 1)
+        except Exception as exc:
+            self.loop.remove_reader(self._fd)
+            self._fd = None
+            self.on_data(None, exc)
+            return
+        if data:
+            self.on_data(data, None)
+
+    def _read_thread(self):
+        while not self._closing:
+            try:
+                data = self.ser.read(self.ser.in_waiting or 1)
+            except Exception as exc:
+                if not self._closing:
+                    self.loop.call_soon_threadsafe(self.on_data, None, exc)
+                return
+            if data:
+                self.loop.call_soon_threadsafe(self.on_data, data, None)
+
+    def write(self, data):
+        self.ser.write(data)
+
+    def close(self):
+        self._closing = True
+        if self._fd is not None:
+            self.loop.remove_reader(self._fd)
+            self._fd = None
+        try:
+            self.ser.close()
+        except Exception:
+            pass
+        if self._thread is not None:
+            self._thread.join(0.5)
+
+
+class TrkeyDevice:
+    """One macropad connection on an asyncio event loop."""
+
+    def __init__(self, port, baud=115200, binary=False, ser=None):
+        self.port = port
+        self.baud = baud
+        self.want_binary = binary
+        self.binary = False
+        self.ser = ser
+        self.transport = None
+        self.parser = StreamParser()
+        self.seq = 0
+        self.connected = False
+        self.closed = None  # future, set when the link drops
+        self._waiters = []  # [prefixes, future]
+        self._streams = []  # [prefixes, asyncio.Queue] for replies that come in bursts (ACK/NAK)
+        self._bodies = []  # [prefixes, reader, future] for replies with a binary body (GET/GETZ)
+        self._blocks = []  # [first, end, lines or None before the header, future] for multi-line replies
+        self._event_handlers = []
+        self._line_handlers = []
+
+    # --- lifecycle ---
+    async def connect(self):
+        loop = asyncio.get_running_loop()
+        if self.ser is None:
+            if serial is None:
+                raise RuntimeError("Missing dependency: pyserial. Install with: pip install pyserial")
+            self.ser = serial.Serial(port=self.port, baudrate=self.baud, timeout=0)
+        self.closed = loop.create_future()
+        self.transport = SerialTransport(self.ser, loop, self._on_data)
+        self.transport.start()
+        self.connected = True
+        if self.want_binary:
+            await self.negotiate_binary()
+        return self
+
+    async def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+        self._drop(ConnectionError("link closed"))
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def _drop(self, exc):
+        self.connected = False
+        for _prefixes, fut in self._waiters:
+            if not fut.done():
+                fut.set_exception(exc)
+        self._waiters = []
+        for _first, _end, _lines, fut in self._blocks:
+            if not fut.done():
+                fut.set_exception(exc)
+        self._blocks = []
+        if self.closed is not None and not self.closed.done():
+            self.closed.set_result(exc)
+
+    # --- incoming ---
+    def on_event(self, handler):
+        """handler(action) for every APP_EVENT; may be a coroutine function."""
+        self._event_handlers.append(handler)
+        return handler
+
+    def on_line(self, handler):
+        """handler(line) for device lines that are not a reply or an APP_EVENT."""
+        self._line_handlers.append(handler)
+        return handler
+
+    def _call(self, handler, arg):
+        try:
+            result = handler(arg)
+            if inspect.isawaitable(result):
+                asyncio.ensure_future(result)
+        except Exception as exc:
+            print(f"[handler-error] {exc}", file=sys.stderr)
+
+    def _on_data(self, data, exc):
+        if exc is not None:
+            self._drop(exc)
+            return
+        # lines are dispatched while parsing, so a reply header can switch the parser to its body
+        self.parser.feed(data, self._dispatch)
+
+    def _dispatch(self, line):
+        if line.startswith("APP_EVENT "):
+            action = line.split(" ", 1)[1]
+            for handler in self._event_handlers:
+                self._call(handler, action)
+            return
+        if self._bodies and self._body_header(line):
+            return
+        if self._blocks and self._block_line(line):
+            return
+        for prefixes, q in self._streams:
+            if line.startswith(prefixes):
+                q.put_nowait(line)
+                return
+        for i, (prefixes, fut) in enumerate(self._waiters):
+            if line.startswith(prefixes):
+                del self._waiters[i]
+                if not fut.done():
+                    fut.set_result(line)
+                return
+        for handler in self._line_handlers:
+            self._call(handler, line)
+
+    # --- outgoing ---
+    def write(self, data):
+        if not self.connected:
+            raise ConnectionError("not connected")
+        try:
+            self.transport.write(data)
+        except OSError as exc:  # includes serial.SerialException: pad unplugged mid-write
+            self._drop(exc)
+            raise ConnectionError(str(exc)) from exc
+
+    def send_line(self, line):
+        self.write((line.strip() + "\n").encode("utf-8"))
+
+    def expect(self, prefixes):
+        """Future for the next line starting with one of prefixes (register before sending)."""
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append([tuple(prefixes), fut])
+        return fut
+
+    def expect_body(self, prefixes, reader):
+        """
+        Future for (header line, body) of a reply whose header line starts with
+        one of prefixes and is followed by bytes: reader(buf) returns
+        (consumed, body) once the body is complete, or None for more data.
+        An error line instead of the header fails the future. With prefixes
+        None the body starts with the next byte received (header is None).
+        """
+        fut = asyncio.get_running_loop().create_future()
+        if prefixes is None:
+            self._read_body(None, reader, fut)
+        else:
+            self._bodies.append([tuple(prefixes), reader, fut])
+        return fut
+
+    def _cancel_body(self, fut):
+        self._bodies = [b for b in self._bodies if b[2] is not fut]
+        self.parser.raw = None
+
+    def _body_header(self, line):
+        prefixes, reader, fut = self._bodies[0]
+        if line.startswith(ERROR_PREFIXES):
+            del self._bodies[0]
+            if not fut.done():
+                fut.set_exception(RuntimeError(line))
+            return True
+        if not line.startswith(prefixes):
+            return False
+        del self._bodies[0]
+        self._read_body(line, reader, fut)
+        return True
+
+    def _read_body(self, line, reader, fut):
+        def raw(buf):
+            got = reader(buf)
+            if got is None:
+                return None
+            consumed, body = got
+            self.parser.raw = None
+            if not fut.done():
+                fut.set_result((line, body))
+            return consumed
+
+        self.parser.raw = raw
+
+    def _block_line(self, line):
+        block = self._blocks[0]
+        first, end, lines, fut = block
+        if lines is None:
+            if line.startswith(ERROR_PREFIXES):
+                del self._blocks[0]
+                if not fut.done():
+                    fut.set_exception(RuntimeError(line))
+                return True
+            if not line.startswith(first):
+                return False
+            block[2] = []
+            return True
+        # the device writes a block in one go: every line up to `end` belongs to it
+        if line == end:
+            del self._blocks[0]
+            if not fut.done():
+                fut.set_result(lines)
+        else:
+            lines.append(line)
+        return True
+
+    def subscribe(self, prefixes):
+        """Queue that receives every line starting with one of prefixes until unsubscribe()."""
+        q = asyncio.Queue()
+        self._streams.append([tuple(prefixes), q])
+        return q
+
+    def unsubscribe(self, q):
+        self._streams = [s for s in self._streams if s[1] is not q]
+
+    async def wait_for(self, fut, timeout):
+        try:
+            return await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            self._waiters = [w for w in self._waiters if w[1] is not fut]
+            return None
+
+    async def request(self, line, prefixes, timeout=3.0):
+        """Send a text command and return its reply line (None on timeout)."""
+        fut = self.expect(tuple(prefixes) + ERROR_PREFIXES)
+        self.send_line(line)
+        return await self.wait_for(fut, timeout)
+
+    async def request_block(self, line, first, end="<END>", timeout=3.0):
+        """
+        Send a command whose reply is a `first` line, body lines and an `end`
+        line; returns the body (what arrived so far if `end` times out).
+        """
+        fut = asyncio.get_running_loop().create_future()
+        block = [first, end, None, fut]
+        self._blocks.append(block)  # before sending: the body can arrive in the header's read
+        self.send_line(line)
+        try:
+            return await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            self._blocks = [b for b in self._blocks if b is not block]
+            if block[2] is None:
+                raise RuntimeError(f"no reply to {line}") from None
+            return block[2]
+
+    def send_frame(self, ftype, payload=b""):
+        self.seq = (self.seq + 1) & 0xFF
+        self.write(binproto.encode_frame(ftype, self.seq, payload))
+
+    async def negotiate_binary(self, timeout=2.0):
+        """Ask the firmware for binary framing; returns True if it agreed."""
+        reply = await self.request("PROTO BIN", ("PROTO BIN OK",), timeout)
+        self.binary = self.parser.binary = reply == "PROTO BIN OK"
+        return self.binary
+
+    # --- commands ---
+    async def mode(self, name, timeout=3.0):
+        return await self.request(f"MODE {name}", ("MODE LOADED",), timeout)
+
+    async def modes(self, timeout=3.0):
+        return await self.request_block("MODE LIST", "Modes:", timeout=timeout)
+
+    async def _np_frame(self, ftype, payload, timeout):
+        fut = self.expect(("OK",) + ERROR_PREFIXES)
+        self.send_frame(ftype, payload)
+        return await self.wait_for(fut, timeout)
+
+    async def np_set(self, title, artist="", position=0, duration=0, source="", playing=True, timeout=3.0):
+        if self.binary:
+            flags = binproto.NP_PLAYING if playing else 0
+            return await self._np_frame(binproto.T_NP_SET,
+                                        binproto.pack_np(title, artist, source, position, duration, flags), timeout)
+        payload = {"title": title, "artist": artist, "position": int(position),
+                   "duration": int(duration), "source": source}
+        if not playing:
+            payload["playing"] = False
+        return await self.request("NP_SET " + json.dumps(payload, separators=(",", ":")), ("NP_OK",), timeout)
+
+    async def np_pos(self, position, timeout=3.0):
+        """Re-anchor the device's position; it keeps counting on its own while playing."""
+        if self.binary:
+            return await self._np_frame(binproto.T_NP_POS, struct.pack("<I", max(0, int(position))), timeout)
+        return await self.request(f"NP_POS {int(position)}", ("NP_OK",), timeout)
+
+    async def np_playstate(self, playing, timeout=3.0):
+        if self.binary:
+            flags = binproto.NP_PLAYING if playing else 0
+            return await self._np_frame(binproto.T_NP_STATE, bytes((flags,)), timeout)
+        return await self.request("NP_PLAYSTATE " + ("playing" if playing else "paused"), ("NP_OK",), timeout)
+
+    async def np_field(self, name, value, timeout=3.0):
+        """Update one of title, artist, source or duration."""
+        if self.binary:
+            return await self._np_frame(binproto.T_NP_FIELD, binproto.pack_np_field(name, value), timeout)
+        verb = {"title": "NP_TITLE", "artist": "NP_ARTIST", "source": "NP_SOURCE", "duration": "NP_DUR"}[name]
+        if name == "duration":
+            value = int(value)
+        return await self.request(f"{verb} {value}", ("NP_OK",), timeout)
+
+    async def np_clear(self, timeout=3.0):
+        if self.binary:
+            return await self._np_frame(binproto.T_NP_CLEAR, b"", timeout)
+        return await self.request("NP_CLEAR", ("NP_CLEARED",), timeout)
+
+    async def np_get(self, timeout=3.0):
+        """Current now-playing state as a dict (None on timeout)."""
+        if self.binary:
+            fut = self.expect(("{",) + ERROR_PREFIXES)
+            self.send_frame(binproto.T_NP_GET)
+            reply = await self.wait_for(fut, timeout)
+        else:
+            reply = await self.request("NP_GET", ("{",), timeout)
+        if reply is None or not reply.startswith("{"):
+            return None
+        return json.loads(reply)
+
+    async def patch(self, args, timeout=3.0):
+        return await self.request("PATCH " + args.strip(), ("PATCHED",), timeout)
+
+    async def get(self, name, offset=0, length=None, compress=True, timeout=5.0):
+        """
+        Read a file, or `length` bytes of it from `offset`. Uses GETZ (the
+        device compresses blocks that shrink, see lib/ztransfer.py) and falls
+        back to plain GET on firmware without it.
+        """
+        rng = f" {offset} {length if length is not None else 2 ** 31}" if offset or length is not None else ""
+        if compress:
+            def blocks(buf):
+                end = ztransfer.block_stream_end(buf)
+                if end < 0 or len(buf) < end + len(ztransfer.EOF_LINE):
+                    return None
+                return end + len(ztransfer.EOF_LINE), ztransfer.inflate_blocks(bytes(buf[:end]))
+
+            fut = self.expect_body(("ZDATA ",), blocks)
+            self.send_line(f"GETZ {name}{rng}")
+            try:
+                return (await asyncio.wait_for(fut, timeout))[1]
+            except RuntimeError as exc:
+                if not str(exc).startswith("UNKNOWN COMMAND"):
+                    raise
+            except asyncio.TimeoutError:
+                self._cancel_body(fut)
+                raise
+
+        def until_eof(buf):
+            # plain GET: the body starts right away and ends at <EOF>; errors are a single line
+            if buf.startswith(b"ERROR") and b"\n" in buf:
+                nl = buf.find(b"\n")
+                return nl + 1, RuntimeError(bytes(buf[:nl]).decode(errors="replace").strip())
+            end = buf.find(ztransfer.EOF_LINE)
+            return None if end < 0 else (end + len(ztransfer.EOF_LINE), bytes(buf[:end]))
+
+        fut = self.expect_body(None, until_eof)
+        self.send_line(f"GET {name}{rng}")
+        try:
+            data = (await asyncio.wait_for(fut, timeout))[1]
+        except asyncio.TimeoutError:
+            self._cancel_body(fut)
+            raise
+        if isinstance(data, Exception):
+            if rng:
+                # firmware without ranges: fetch it all and slice here
+                data = await self.get(name, compress=False, timeout=timeout)
+                return data[offset:offset + length] if length is not None else data[offset:]
+            raise data
+        return data
+
+    async def put(self, local_path, remote_name=None, resume=False, compress=None, timeout=3.0, retries=5):
+        """
+        Upload a file with the framed PUTF/PUTR protocol (see lib/framed_upload.py).
+        Keeps up to `window` chunks in flight and goes back to the device's offset on NAK/timeout.
+        Gives up after `retries` timeouts in a row; call again with resume=True to continue.
+        compress=None sends a compressed block stream (PUTZ) when it is clearly smaller and the
+        firmware supports it; True/False force it on/off. Returns the number of bytes sent.
+        """
+        with open(local_path, "rb") as f:
+            data = f.read()
+        remote_name = remote_name or os.path.basename(local_path)
+        size = len(data)
+        crc = zlib.crc32(data) & 0xFFFFFFFF
+
+        wire = data
+        reply = None
+        if compress is not False and not resume and size >= (0 if compress else COMPRESS_MIN):
+            blob = ztransfer.deflate_blocks(data)
+            if compress or len(blob) <= size * COMPRESS_RATIO:
+                reply = await self.request(f"PUTZ {size} {crc:08x} {len(blob)} {remote_name}",
+                                           ("READY FRAMED",), timeout)
+                if reply and reply.startswith("READY FRAMED"):
+                    wire = blob
+                else:
+                    reply = None  # firmware without PUTZ: plain framed upload
+        if reply is None:
+            verb = "PUTR" if resume else "PUTF"
+            reply = await self.request(f"{verb} {size} {crc:08x} {remote_name}", ("READY FRAMED",), timeout)
+        if not reply or not reply.startswith("READY FRAMED"):
+            raise RuntimeError(reply or "no READY from device")
+        size = len(wire)
+        offset, chunk, window, prefix_crc = reply.split()[2:6]
+        offset, chunk, window = int(offset), int(chunk), int(window)
+        if offset and (zlib.crc32(data[:offset]) & 0xFFFFFFFF) != int(prefix_crc, 16):
+            # Part file on the device is not a prefix of this file: start over
+            await self.request("ABORT", ("ABORTED",), timeout)
+            return await self.put(local_path, remote_name, resume=False, compress=compress,
+                                  timeout=timeout, retries=retries)
+
+        done = self.expect(("FILE RECEIVED",) + ERROR_PREFIXES)
+        acks = self.subscribe(("ACK ", "NAK "))
+        acked = sent = offset
+        stalls = 0
+        try:
+            while acked < size and not done.done():
+                while sent < size and sent - acked < window * chunk:
+                    payload = wire[sent:sent + chunk]
+                    self.write(struct.pack("<BIH", 0x01, sent, len(payload)) + payload
+                               + struct.pack("<I", zlib.crc32(payload) & 0xFFFFFFFF))
+                    sent += len(payload)
+                ack = asyncio.ensure_future(acks.get())
+                finished, _pending = await asyncio.wait([ack, done], timeout=timeout,
+                                                        return_when=asyncio.FIRST_COMPLETED)
+                if ack not in finished:
+                    ack.cancel()
+                    if done in finished:
+                        break
+                    stalls += 1
+                    if stalls > retries:
+                        raise RuntimeError(f"device stopped acknowledging at offset {acked}")
+                    sent = acked  # nothing heard back: resend from the last acknowledged offset
+                    continue
+                stalls = 0
+                reply = ack.result()
+                pos = int(reply.split()[1])
+                if reply.startswith("ACK "):
+                    acked = max(acked, pos)
+                else:
+                    acked = sent = pos
+        except BaseException:
+            self._waiters = [w for w in self._waiters if w[1] is not done]
+            raise
+        finally:
+            self.unsubscribe(acks)
+
+        reply = await self.wait_for(done, timeout)
+        if not reply or not reply.startswith("FILE RECEIVED"):
+            raise RuntimeError(reply or "no FILE RECEIVED from device")
+        return size - offset
+
+
+class NowPlayingSync:
+    """
+    Keeps a device's now-playing view in step with a player while sending as
+    little as possible. Call update() whenever the player reports anything;
+    reports that change nothing the device shows are dropped, and real
+    changes are debounced by `debounce` seconds (players tend to report in
+    bursts) and flushed at most every `min_interval` seconds:
+
+    - a new title (or most fields changing at once) sends one NP_SET,
+    - other field changes send NP_TITLE/NP_ARTIST/NP_SOURCE/NP_DUR,
+    - play/pause sends NP_PLAYSTATE,
+    - the position is only sent when it drifts more than `drift` seconds
+      from what the device interpolates itself (seeks, buffering).
+
+    Firmware without the delta commands gets full NP_SETs, with position-only
+    changes limited to one per `legacy_interval` seconds.
+    """
+
+    FIELDS = ("title", "artist", "source", "duration")
+
+    def __init__(self, dev, min_interval=0.25, drift=2.0, keepalive=5.0, legacy_interval=1.0, debounce=0.05):
+        self.dev = dev
+        self.min_interval = min_interval
+        self.debounce = debounce
+        self.drift = drift
+        self.keepalive = keepalive  # resend cadence when the device cannot time out on the track end
+        self.legacy_interval = legacy_interval
+        self.delta = True
+        self.want = {"title": "", "artist": "", "source": "", "duration": 0}
+        self.want_pos = 0.0
+        self.want_pos_at = 0.0
+        self.want_playing = True
+        self.sent = None  # fields the device shows, None before the first NP_SET
+        self.sent_pos = 0.0  # device's anchor
+        self.sent_at = 0.0
+        self.sent_playing = True
+        self.last_flush = 0.0
+        self.commands = 0
+        self._task = None
+        self._due = 0.0
+        self._flushing = False
+        self._dirty = False
+
+    def _clock(self):
+        return asyncio.get_running_loop().time()
+
+    def update(self, position=None, playing=None, **fields):
+        """Record new player state (any subset of title/artist/source/duration/position/playing)."""
+        now = self._clock()
+        changed = False
+        for name, value in fields.items():
+            if name not in self.FIELDS:
+                raise TypeError(f"unknown now-playing field: {name}")
+            value = int(value or 0) if name == "duration" else str(value or "")
+            if self.want[name] != value:
+                if name == "title" and position is None:
+                    self.want_pos, self.want_pos_at = 0.0, now  # new track starts from the top
+                self.want[name] = value
+                changed = True
+        if playing is not None and bool(playing) != self.want_playing:
+            if position is None:
+                self.want_pos = self._position(self.want_pos, self.want_pos_at, self.want_playing, now)
+                self.want_pos_at = now
+            self.want_playing = bool(playing)
+            changed = True
+        if position is not None:
+            self.want_pos = float(position)
+            self.want_pos_at = now
+            expected = self._position(self.sent_pos, self.sent_at, self.sent_playing, now)
+            changed = changed or abs(self.want_pos - expected) > self.drift
+        if changed or self.sent is None:
+            self._schedule()
+
+    def _schedule(self):
+        if self._flushing:
+            self._dirty = True  # the running flush loops once more
+            return
+        now = self._clock()
+        due = max(now + self.debounce, self.last_flush + self.min_interval)
+        if self._task is not None and not self._task.done():
+            if self._due <= due:
+                return  # an earlier flush is already coming
+            self._task.cancel()  # only ever sleeping here (keepalive); flush sooner instead
+        self._due = due
+        self._task = asyncio.ensure_future(self._run(due - now))
+
+    async def _run(self, delay):
+        while delay is not None:
+            await asyncio.sleep(delay)
+            self._flushing = True
+            try:
+                delay = await self.flush()
+            except ConnectionError:
+                return
+            finally:
+                self._flushing = False
+            if self._dirty:
+                self._dirty = False
+                delay = self.min_interval
+            if delay is not None:
+                self._due = self._clock() + delay
+
+    def _position(self, pos, at, playing, now):
+        return pos + (now - at if playing else 0.0)
+
+    async def flush(self):
+        """
+        Send whatever differs from the device's state now. Returns the delay
+        until a resend is due without new input (None: nothing to resend).
+        """
+        now = self._clock()
+        self.last_flush = now
+        want = self.want
+        pos = self._position(self.want_pos, self.want_pos_at, self.want_playing, now)
+        changed = [n for n in self.FIELDS if self.sent is None or self.sent[n] != want[n]]
+        expected = self._position(self.sent_pos, self.sent_at, self.sent_playing, now)
+        drifted = abs(pos - expected) > self.drift
+        stale = self.want_playing and not want["duration"] and now - self.sent_at >= self.keepalive
+
+        if not self.delta:
+            # no interpolation on the device: keep its position fresh ourselves
+            if changed or drifted or self.want_playing != self.sent_playing or \
+                    (self.want_playing and now - self.sent_at >= self.legacy_interval):
+                await self._send_full(pos, now)
+            return self.legacy_interval if self.want_playing else None
+        if self.sent is None or "title" in changed or len(changed) > 2:
+            await self._send_full(pos, now)
+            return self._next_keepalive()
+        for name in changed:
+            if not await self._delta(self.dev.np_field(name, want[name])):
+                return await self.flush()
+            self.sent[name] = want[name]
+        if self.want_playing != self.sent_playing:
+            if not await self._delta(self.dev.np_playstate(self.want_playing)):
+                return await self.flush()
+            self.sent_pos, self.sent_at, self.sent_playing = expected, now, self.want_playing
+            drifted = abs(pos - expected) > self.drift
+        if drifted or stale:
+            if not await self._delta(self.dev.np_pos(pos)):
+                return await self.flush()
+            self.sent_pos, self.sent_at = float(int(pos)), now
+        return self._next_keepalive()
+
+    def _next_keepalive(self):
+        # without a duration the device hides the view SHOW_NOW_PLAYING_TIMEOUT after the last update
+        return self.keepalive if self.want_playing and not self.want["duration"] else None
+
+    async def _delta(self, request):
+        reply = await request
+        self.commands += 1
+        if reply is None or reply.startswith(ERROR_PREFIXES):
+            if reply == "UNKNOWN COMMAND" or reply.endswith("UNKNOWN FRAME"):
+                self.delta = False  # older firmware: full NP_SETs from now on
+            self.sent = None  # resync with a full NP_SET
+            return False
+        return True
+
+    async def _send_full(self, pos, now):
+        want = self.want
+        await self.dev.np_set(want["title"], want["artist"], int(pos), want["duration"], want["source"],
+                              playing=self.want_playing)
+        self.commands += 1
+        self.sent = dict(want)
+        self.sent_pos, self.sent_at, self.sent_playing = float(int(pos)), now, self.want_playing
+
+    async def clear(self):
+        if self._task is not None:
+            self._task.cancel()
+        self.sent = None
+        return await self.dev.np_clear()
+
+
+def list_serial_ports():
+    """[(device, description)] of the serial ports pyserial can see."""
+    if list_ports is None:
+        raise RuntimeError("Missing dependency: pyserial. Install with: pip install pyserial")
+    return [(p.device, p.description) for p in list_ports.comports()]
+
+
+TRKEY_MATCH = ("Trkey", "TRKEY")
+
+
+def find_trkey_ports(match=TRKEY_MATCH):
+    """
+    [(device, serial_number)] of ports whose USB descriptor strings (product,
+    manufacturer, interface or description) contain one of `match`.
+    """
+    if list_ports is None:
+        raise RuntimeError("Missing dependency: pyserial. Install with: pip install pyserial")
+    found = []
+    for p in list_ports.comports():
+        strings = (p.product, p.manufacturer, p.interface, p.description)
+        if any(s and any(m in s for m in match) for s in strings):
+            found.append((p.device, p.serial_number or ""))
+    return found
@@ -2,159 +2,300 @@
 """Trkey Music Companion (beta).
 ///so many bugs
 Simple optional PC companion app for Arduino firmware.
-- Sends now-playing metadata via NP_SET.
+- Sends now-playing metadata: NP_SET for a new track, then only deltas
+  (NP_POS, NP_PLAYSTATE, NP_TITLE, ...) coalesced by NowPlayingSync.
 - Loads layer by name, e.g. `music` -> MODE music.
 - Listens for APP_EVENT lines from firmware.
+- Optional binary protocol (`--binary`, firmware `PROTO BIN`) for NP_* commands.
+- `--source mpris` / `--source file:<path>` follows a player by itself
+  (see np_providers.py) and pushes only real changes.
+- `--daemon` serves every Trkey pad it finds (USB descriptor "Trkey"),
+  reconnecting on hotplug; see trkey_pool.py.
+- Runs on asyncio: device events are handled as they arrive, even while
+  waiting for input. The device link itself is in trkey_link.py.
 """
 
 import argparse
+import asyncio
 import json
-import queue
+import os
+import shlex
 import sys
 import threading
 import time
 
-try:
-    import serial
-    from serial.tools import list_ports
-except Exception:
-    print("Missing dependency: pyserial. Install with: pip install pyserial")
-    sys.exit(1)
+from np_providers import make_provider
+from trkey_link import TRKEY_MATCH, NowPlayingSync, TrkeyDevice, list_serial_ports as _list_ports
+from trkey_pool import DevicePool
 
 
 def list_serial_ports():
-    ports = list(list_ports.comports())
+    try:
+        ports = _list_ports()
+    except RuntimeError as exc:
+        print(exc)
+        return
     if not ports:
         print("No serial ports found.")
         return
     print("Available ports:")
-    for p in ports:
-        print(f"- {p.device} ({p.description})")
+    for device, description in ports:
+        print(f"- {device} ({description})")
+
+
+def handle_incoming(line):
+    print(f"[DEVICE] {line}")
 
 
-def send_line(ser, line):
-    ser.write((line.strip() + "\n").encode("utf-8"))
+def handle_app_event(action):
+    print(f"[APP_EVENT] {action}")
 
 
-def reader_loop(ser, out_queue):
-    while True:
+def start_stdin_reader(loop, prompt="trkey> "):
+    """
+    Read stdin lines on a daemon thread and hand them to the event loop, so
+    device output keeps being handled while waiting for input. Yields None on EOF.
+    """
+    lines = asyncio.Queue()
+
+    def reader():
+        while True:
+            line = sys.stdin.readline()
+            loop.call_soon_threadsafe(lines.put_nowait, line.rstrip("\n") if line else None)
+            if not line:
+                return
+
+    threading.Thread(target=reader, daemon=True).start()
+    return lines
+
+
+HELP = """Commands:
+  ports                          # list available serial ports
+  music                          # shortcut -> MODE music
+  mode <name-or-index>           # send MODE command
+  modes                          # list layer modes
+  np <title>|<artist>|<p>|<d>|<source>
+  pos <seconds>                  # seek (device keeps counting by itself)
+  play | pause                   # playback state
+  clear                          # NP_CLEAR
+  get                            # NP_GET
+  patch <KEY|LABEL|NAME|MACRO> ...  # live keymap edit (PATCH)
+  put <local> [remote]           # framed, checksummed upload (compressed when it helps)
+  pull <remote> [local]          # download a file
+  peek <remote> <offset> <length>  # print part of a file (GET range)
+  resume <local> [remote]        # continue a dropped upload
+  send <raw-line>                # raw command
+  quit                           # exit"""
+
+
+async def handle_cli_command(dev, cmd, sync=None):
+    """Run one interactive command. Returns False to quit."""
+    if cmd in {"quit", "exit"}:
+        return False
+
+    if cmd == "help":
+        print(HELP)
+    elif cmd == "ports":
+        list_serial_ports()
+    elif cmd == "music":
+        print(await dev.mode("music") or "No reply.")
+    elif cmd == "modes":
         try:
-            raw = ser.readline()
-            if not raw:
-                continue
-            line = raw.decode("utf-8", errors="replace").strip()
-            out_queue.put(line)
+            for line in await dev.modes():
+                print(line)
+        except RuntimeError as exc:
+            print(exc)
+    elif cmd.startswith("mode "):
+        print(await dev.mode(cmd[5:].strip()) or "No reply.")
+    elif cmd == "clear":
+        print(await (sync.clear() if sync is not None else dev.np_clear()) or "No reply.")
+    elif cmd == "get":
+        state = await dev.np_get()
+        print(json.dumps(state) if state is not None else "No reply.")
+    elif cmd.startswith("np "):
+        parts = cmd[3:].split("|")
+        while len(parts) < 5:
+            parts.append("")
+        title, artist, pos, dur, source = [p.strip() for p in parts[:5]]
+        try:
+            pos_i = int(pos) if pos else 0
+            dur_i = int(dur) if dur else 0
+        except ValueError:
+            print("position/duration must be integers (seconds).")
+            return True
+        if sync is None:
+            print(await dev.np_set(title, artist, pos_i, dur_i, source) or "No reply.")
+        else:
+            sync.update(title=title, artist=artist, source=source, duration=dur_i, position=pos_i, playing=True)
+    elif sync is not None and cmd.startswith("pos "):
+        try:
+            sync.update(position=float(cmd[4:]))
+        except ValueError:
+            print("position must be a number of seconds.")
+    elif sync is not None and cmd in {"play", "pause"}:
+        sync.update(playing=cmd == "play")
+    elif cmd.startswith("patch "):
+        print(await dev.patch(cmd[6:]) or "No reply.")
+    elif cmd.startswith("put ") or cmd.startswith("resume "):
+        verb, _, rest = cmd.partition(" ")
+        args = rest.split()
+        try:
+            start = time.time()
+            sent = await dev.put(args[0], args[1] if len(args) > 1 else None, resume=(verb == "resume"))
+            elapsed = max(time.time() - start, 1e-6)
+            size = os.path.getsize(args[0])
+            print(f"Uploaded {size} bytes ({sent} on the wire) in {elapsed:.2f}s ({size / elapsed:.0f} B/s)")
         except Exception as exc:
-            out_queue.put(f"[reader-error] {exc}")
-            return
+            print(f"Upload failed: {exc}")
+    elif cmd.startswith("pull "):
+        args = cmd[5:].split()
+        try:
+            data = await dev.get(args[0])
+            local = args[1] if len(args) > 1 else os.path.basename(args[0])
+            with open(local, "wb") as f:
+                f.write(data)
+            print(f"Saved {len(data)} bytes to {local}")
+        except Exception as exc:
+            print(f"Download failed: {exc}")
+    elif cmd.startswith("peek "):
+        args = cmd[5:].split()
+        try:
+            data = await dev.get(args[0], int(args[1]), int(args[2]))
+            print(data.decode("utf-8", errors="replace"))
+        except (IndexError, ValueError):
+            print("usage: peek <remote> <offset> <length>")
+        except Exception as exc:
+            print(f"Read failed: {exc}")
+    elif cmd.startswith("send "):
+        dev.send_line(cmd[5:])
+    else:
+        print("Unknown command. Type 'help'.")
+    return True
 
 
-def handle_incoming(line):
-    if line.startswith("APP_EVENT "):
-        action = line.split(" ", 1)[1]
-        print(f"[APP_EVENT] {action}")
-        return
-    print(f"[DEVICE] {line}")
+async def run_provider(provider, sync):
+    try:
+        await provider.run(sync)
+    except asyncio.CancelledError:
+        raise
+    except Exception as exc:
+        print(f"\n[{provider.name}] now-playing source stopped: {exc}")
 
 
-def run_cli(port, baud):
-    ser = serial.Serial(port=port, baudrate=baud, timeout=0.2)
+async def run_cli(port, baud, binary=False, source=None):
+    try:
+        provider = make_provider(source) if source else None
+    except (ValueError, RuntimeError) as exc:
+        print(exc)
+        return
+    dev = TrkeyDevice(port, baud)
+    dev.on_event(handle_app_event)
+    dev.on_line(handle_incoming)
+    try:
+        await dev.connect()
+    except Exception as exc:
+        print(f"Could not open {port}: {exc}")
+        return
     print(f"Connected: {port} @ {baud}")
+    if binary:
+        if await dev.negotiate_binary():
+            print("Binary protocol enabled.")
+        else:
+            print("Device does not support PROTO BIN, using text protocol.")
     print("Type 'help' for commands.")
+    sync = NowPlayingSync(dev)
+    provider_task = None
+    if provider is not None:
+        provider_task = asyncio.ensure_future(run_provider(provider, sync))
+        print(f"Following now-playing source: {source}")
 
-    q = queue.Queue()
-    t = threading.Thread(target=reader_loop, args=(ser, q), daemon=True)
-    t.start()
-
-    last_pump = time.time()
-
+    lines = start_stdin_reader(asyncio.get_running_loop())
     try:
         while True:
-            # drain incoming lines
-            while True:
-                try:
-                    line = q.get_nowait()
-                except queue.Empty:
-                    break
-                handle_incoming(line)
-
-            # keep prompt responsive
-            if time.time() - last_pump > 0.05:
-                last_pump = time.time()
-
-            cmd = input("trkey> ").strip()
+            print("trkey> ", end="", flush=True)
+            next_line = asyncio.ensure_future(lines.get())
+            done, _pending = await asyncio.wait([next_line, dev.closed], return_when=asyncio.FIRST_COMPLETED)
+            if next_line not in done:
+                next_line.cancel()
+                print(f"\nDevice disconnected: {dev.closed.result()}")
+                break
+            cmd = next_line.result()
+            if cmd is None:
+                break
+            cmd = cmd.strip()
             if not cmd:
                 continue
-
-            if cmd in {"quit", "exit"}:
+            try:
+                if not await handle_cli_command(dev, cmd, sync):
+                    break
+            except ConnectionError as exc:
+                print(f"Device disconnected: {exc}")
                 break
+    finally:
+        if provider_task is not None:
+            provider_task.cancel()
+        await dev.close()
 
-            if cmd == "help":
-                print("Commands:")
-                print("  ports                          # list available serial ports")
-                print("  music                          # shortcut -> MODE music")
-                print("  mode <name-or-index>           # send MODE command")
-                print("  modes                          # list layer modes")
-                print("  np <title>|<artist>|<p>|<d>|<source>")
-                print("  clear                          # NP_CLEAR")
-                print("  get                            # NP_GET")
-                print("  send <raw-line>                # raw command")
-                print("  quit                           # exit")
-                continue
-
-            if cmd == "ports":
-                list_serial_ports()
-                continue
-
-            if cmd == "music":
-                send_line(ser, "MODE music")
-                continue
-
-            if cmd == "modes":
-                send_line(ser, "MODE LIST")
-                continue
-
-            if cmd.startswith("mode "):
-                send_line(ser, f"MODE {cmd[5:].strip()}")
-                continue
-
-            if cmd == "clear":
-                send_line(ser, "NP_CLEAR")
-                continue
-
-            if cmd == "get":
-                send_line(ser, "NP_GET")
-                continue
 
-            if cmd.startswith("np "):
-                payload_raw = cmd[3:]
-                parts = payload_raw.split("|")
-                while len(parts) < 5:
-                    parts.append("")
-                title, artist, pos, dur, source = [p.strip() for p in parts[:5]]
-                try:
-                    pos_i = int(pos) if pos else 0
-                    dur_i = int(dur) if dur else 0
-                except ValueError:
-                    print("position/duration must be integers (seconds).")
-                    continue
-                payload = {
-                    "title": title,
-                    "artist": artist,
-                    "position": pos_i,
-                    "duration": dur_i,
-                    "source": source,
-                }
-                send_line(ser, "NP_SET " + json.dumps(payload, separators=(",", ":")))
-                continue
+def parse_routes(specs):
+    """`--on-event [<port-or-serial>=]<command>` -> {pad name or "*": command}."""
+    routes = {}
+    for spec in specs or ():
+        target, sep, command = spec.partition("=")
+        if sep and target and " " not in target:
+            routes[target] = command
+        else:
+            routes["*"] = spec
+    return routes
 
-            if cmd.startswith("send "):
-                send_line(ser, cmd[5:])
-                continue
 
-            print("Unknown command. Type 'help'.")
+async def run_daemon(ports, baud, binary=False, source=None, match=TRKEY_MATCH, routes=None, max_jobs=4):
+    """Serve every pad found (plus fixed `ports`) until interrupted."""
+    try:
+        provider = make_provider(source) if source else None
+    except (ValueError, RuntimeError) as exc:
+        print(exc)
+        return
+    pool = DevicePool(ports=ports, match=match, baud=baud, binary=binary)
+    routes = routes or {}
+    jobs = asyncio.Semaphore(max_jobs)  # bounds concurrent --on-event commands
+
+    @pool.on_status
+    def status(pad, text):
+        print(f"[{pad.port}] {text}")
+
+    @pool.on_event
+    async def event(pad, action):
+        print(f"[{pad.port}] APP_EVENT {action}")
+        command = routes.get(pad.serial_number) or routes.get(pad.port) or routes.get("*")
+        if not command:
+            return
+        # no shell: values come from the pad and only ever fill whole arguments
+        fields = {"action": action, "port": pad.port, "serial": pad.serial_number}
+        try:
+            argv = [arg.format(**fields) for arg in shlex.split(command)]
+        except (ValueError, KeyError, IndexError) as exc:
+            print(f"[{pad.port}] bad --on-event command: {exc}")
+            return
+        async with jobs:
+            try:
+                proc = await asyncio.create_subprocess_exec(*argv)
+            except OSError as exc:
+                print(f"[{pad.port}] --on-event failed: {exc}")
+                return
+            await proc.wait()
+
+    tasks = [asyncio.ensure_future(pool.run())]
+    if provider is not None:
+        tasks.append(asyncio.ensure_future(run_provider(provider, pool)))
+        print(f"Following now-playing source: {source}")
+    print("Daemon running; waiting for pads (Ctrl+C to stop).")
+    try:
+        await asyncio.gather(*tasks)
     finally:
-        ser.close()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
 
 def main():
@@ -162,17 +303,38 @@ def main():
     parser.add_argument("--port", help="Serial port (e.g. COM5 or /dev/ttyACM0)")
     parser.add_argument("--baud", type=int, default=115200)
     parser.add_argument("--list-ports", action="store_true")
+    parser.add_argument("--binary", action="store_true", help="use the binary frame protocol (PROTO BIN)")
+    parser.add_argument("--source", help="follow a player: mpris[:<name>] or file:<path> (FIFO or JSON file)")
+    parser.add_argument("--daemon", action="store_true",
+                        help="serve every pad found by USB descriptor (plus --port) and reconnect on hotplug")
+    parser.add_argument("--match", action="append",
+                        help=f"descriptor substring that identifies a pad (default: {', '.join(TRKEY_MATCH)})")
+    parser.add_argument("--on-event", action="append", metavar="[PAD=]COMMAND",
+                        help="daemon: command per APP_EVENT, run without a shell ({action}, {port}, {serial}); "
+                             "prefix with a port or serial number to route one pad")
     args = parser.parse_args()
 
     if args.list_ports:
         list_serial_ports()
         return
 
+    if args.daemon:
+        try:
+            asyncio.run(run_daemon([args.port] if args.port else [], args.baud, binary=args.binary,
+                                   source=args.source, match=tuple(args.match or TRKEY_MATCH),
+                                   routes=parse_routes(args.on_event)))
+        except KeyboardInterrupt:
+            pass
+        return
+
     if not args.port:
-        print("Missing --port. Use --list-ports to discover ports.")
+        print("Missing --port. Use --list-ports to discover ports, or --daemon to find pads automatically.")
         return
 
-    run_cli(args.port, args.baud)
+    try:
+        asyncio.run(run_cli(args.port, args.baud, binary=args.binary, source=args.source))
+    except KeyboardInterrupt:
+        pass
 
 
 if __name__ == "__main__":
@@ -0,0 +1,188 @@
+"""Serve several Trkey pads from one process.
+
+DevicePool finds pads by their USB descriptor strings (see
+trkey_link.find_trkey_ports and boot.py), keeps one TrkeyDevice per pad
+and reconnects with exponential backoff when a pad is unplugged or resets.
+Everything runs on one asyncio loop: one task per pad plus one discovery
+task, and serial reads go through loop.add_reader on POSIX (a reader
+thread per pad elsewhere).
+
+    pool = DevicePool(binary=True)
+    pool.on_event(lambda pad, action: print(pad.port, action))
+    await pool.run()                 # until cancelled
+    pool.update(title="Song", ...)   # now-playing fan-out to every pad
+
+Now-playing state is kept by the pool, so a pad that (re)connects gets
+the current track straight away; each pad has its own NowPlayingSync and
+receives only what it is missing.
+"""
+
+import asyncio
+import inspect
+import sys
+
+from trkey_link import TRKEY_MATCH, NowPlayingSync, TrkeyDevice, find_trkey_ports
+
+
+class Pad:
+    """One pool slot: a port, its live connection (if any) and its now-playing sync."""
+
+    def __init__(self, port, serial_number=""):
+        self.port = port
+        self.serial_number = serial_number
+        self.dev = None
+        self.sync = None
+        self.task = None
+        self.failures = 0  # consecutive failed connects, drives the backoff
+
+    @property
+    def connected(self):
+        return self.dev is not None and self.dev.connected
+
+    @property
+    def name(self):
+        return self.serial_number or self.port
+
+    def __repr__(self):
+        return f"<Pad {self.port} {'up' if self.connected else 'down'}>"
+
+
+class DevicePool:
+    """Connection pool for every pad found by discovery plus any fixed `ports`."""
+
+    def __init__(self, ports=(), match=TRKEY_MATCH, baud=115200, binary=False,
+                 scan_interval=2.0, backoff_min=0.5, backoff_max=30.0, discover=True):
+        self.fixed = list(ports)
+        self.match = match
+        self.baud = baud
+        self.binary = binary
+        self.scan_interval = scan_interval
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.discover = discover
+        self.pads = {}  # port -> Pad
+        self.np_state = {}  # last now-playing fields, replayed to pads that connect
+        self._np_pos_at = 0.0  # loop time of np_state["position"]
+        self._event_handlers = []
+        self._status_handlers = []
+
+    # --- callbacks ---
+    def on_event(self, handler):
+        """handler(pad, action) for every APP_EVENT from any pad; may be a coroutine function."""
+        self._event_handlers.append(handler)
+        return handler
+
+    def on_status(self, handler):
+        """handler(pad, text) when a pad connects, drops or fails to connect."""
+        self._status_handlers.append(handler)
+        return handler
+
+    def _call(self, handlers, *args):
+        for handler in handlers:
+            try:
+                result = handler(*args)
+                if inspect.isawaitable(result):
+                    asyncio.ensure_future(result)
+            except Exception as exc:
+                print(f"[handler-error] {exc}", file=sys.stderr)
+
+    # --- now-playing fan-out (a sink for np_providers) ---
+    def update(self, **fields):
+        now = asyncio.get_running_loop().time()
+        if "position" in fields:
+            pos = fields["position"]
+        elif fields.get("title", self.np_state.get("title")) != self.np_state.get("title"):
+            pos = 0.0  # new track
+        else:
+            pos = self._np_position(now)  # re-based so pause/resume keeps the replayed position right
+        self.np_state.update(fields)
+        self.np_state["position"] = pos
+        self._np_pos_at = now
+        for pad in self.pads.values():
+            if pad.connected:
+                pad.sync.update(**fields)
+
+    def _np_position(self, now):
+        pos = self.np_state.get("position", 0.0)
+        if self.np_state.get("playing", True):
+            pos += now - self._np_pos_at
+        return pos
+
+    def _np_snapshot(self):
+        state = dict(self.np_state)
+        state["position"] = self._np_position(asyncio.get_running_loop().time())
+        return state
+
+    async def clear(self):
+        self.np_state = {}
+        pads = [pad for pad in self.pads.values() if pad.connected]
+        await asyncio.gather(*(pad.sync.clear() for pad in pads), return_exceptions=True)
+
+    # --- pool ---
+    def available_ports(self):
+        ports = {port: "" for port in self.fixed}
+        if self.discover:
+            try:
+                for port, serial_number in find_trkey_ports(self.match):
+                    ports[port] = serial_number
+            except RuntimeError as exc:
+                print(exc, file=sys.stderr)
+        return ports
+
+    async def run(self):
+        """Discover pads and keep them connected until cancelled."""
+        try:
+            while True:
+                for port, serial_number in self.available_ports().items():
+                    pad = self.pads.get(port)
+                    if pad is None:
+                        pad = self.pads[port] = Pad(port, serial_number)
+                    if pad.task is None or pad.task.done():
+                        pad.task = asyncio.ensure_future(self._keep(pad))
+                await asyncio.sleep(self.scan_interval)
+        finally:
+            await self.close()
+
+    async def close(self):
+        tasks = [pad.task for pad in self.pads.values() if pad.task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def connected(self):
+        return [pad for pad in self.pads.values() if pad.connected]
+
+    def backoff(self, pad):
+        return min(self.backoff_max, self.backoff_min * (2 ** max(pad.failures - 1, 0)))
+
+    async def _keep(self, pad):
+        """Connect, serve until the link drops, back off, repeat while the port is still present."""
+        while True:
+            dev = TrkeyDevice(pad.port, self.baud, binary=self.binary)
+            dev.on_event(lambda action, pad=pad: self._call(self._event_handlers, pad, action))
+            try:
+                await dev.connect()
+            except Exception as exc:
+                pad.failures += 1
+                self._call(self._status_handlers, pad, f"connect failed: {exc}")
+            else:
+                pad.failures = 0
+                pad.dev = dev
+                pad.sync = NowPlayingSync(dev)
+                self._call(self._status_handlers, pad, "connected")
+                if self.np_state:
+                    pad.sync.update(**self._np_snapshot())
+                try:
+                    reason = await dev.closed
+                finally:
+                    await dev.close()
+                    pad.dev = None
+                    pad.sync = None
+                pad.failures = 1
+                self._call(self._status_handlers, pad, f"disconnected: {reason}")
+
+            await asyncio.sleep(self.backoff(pad))
+            if pad.port not in self.available_ports():
+                # unplugged: discovery starts a new task when it comes back
+                del self.pads[pad.port]
+                return
@@ -0,0 +1,14 @@
+"""
+Host-side simulator for the CircuitPython firmware.
+
+Runs the unmodified code.py on CPython against stand-in hardware modules
+(simulator/fakes), driven by scripted key presses and CDC input, and
+records the HID reports, display frames and CDC output it produces.
+
+    python -m simulator run simulator/timelines/smoke.json
+    python -m simulator bench
+"""
+
+from .sim import Simulator, SimulationDone, pin_name
+
+__all__ = ["Simulator", "SimulationDone", "pin_name"]
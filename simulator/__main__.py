@@ -0,0 +1,96 @@
+"""Command line entry point: python -m simulator {run,bench} ..."""
+
+import argparse
+import json
+import os
+import sys
+
+from .sim import Simulator
+
+
+def run_timeline(args):
+    with open(args.timeline) as f:
+        spec = json.load(f)
+    base = os.path.dirname(os.path.abspath(args.timeline))
+    layers = args.layers or spec.get("layers")
+    if layers and not os.path.isabs(layers) and not args.layers:
+        layers = os.path.join(base, layers)
+    sim = Simulator(layers=layers, files=spec.get("files"), use_keypad=not args.no_keypad, echo=args.echo)
+    sim.load_timeline(spec.get("events", []))
+    try:
+        sim.run(args.duration or spec.get("duration", 1.0))
+        result = sim.summary()
+        result["hid_log"] = [[round(t, 6), dev, rep.hex()] for t, dev, rep in sim.hid]
+        result["frame_log"] = [[round(t, 6), [list(lbl) for lbl in labels]] for t, labels in sim.frames]
+        result["cdc"] = sim.cdc_output.decode(errors="replace")
+        result["typed"] = sim.typed_text()
+    finally:
+        sim.cleanup()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"Wrote {args.json}")
+        return
+    for key in ("elapsed", "passes", "hid_reports", "frames", "cdc_bytes", "cpu_boot_s", "cpu_loop_s"):
+        print(f"{key}: {result[key]}")
+    print(f"typed: {result['typed']!r}")
+    print("--- HID ---")
+    for t, dev, rep in result["hid_log"]:
+        print(f"{t:9.4f} {dev:8} {rep}")
+    print("--- CDC ---")
+    print(result["cdc"], end="")
+    if result["frame_log"]:
+        t, labels = result["frame_log"][-1]
+        print(f"--- last frame ({t:.4f}s) ---")
+        for x, y, text, color in labels:
+            print(f"{x:3} {y:3} #{color:06X} {text}")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m simulator", description="Trkey firmware simulator")
+    sub = parser.add_subparsers(dest="command")
+
+    run = sub.add_parser("run", help="run code.py against a scripted timeline")
+    run.add_argument("timeline", help="timeline JSON file (see simulator/timelines)")
+    run.add_argument("--layers", help="layers.json to boot with (default: timeline's, else the repo's)")
+    run.add_argument("--duration", type=float, help="simulated seconds to run (default: timeline's)")
+    run.add_argument("--no-keypad", action="store_true", help="hide the keypad module (DigitalInOut scanning)")
+    run.add_argument("--echo", action="store_true", help="also echo device print() output to stdout")
+    run.add_argument("--json", help="write the full recording to this file")
+
+    bench = sub.add_parser("bench", help="run the benchmark suite")
+    bench.add_argument("--quick", action="store_true", help="shorter runs")
+    bench.add_argument("--json", help="write results to this file")
+    bench.add_argument("--only", help="comma-separated benchmark names")
+
+    proto = sub.add_parser("protobench", help="benchmark the CDC command protocol over a pty stand-in")
+    proto.add_argument("--target", choices=("firmware", "server"), default="firmware",
+                       help="code.py command handlers or lib/webserial_fs.USBFileServer")
+    proto.add_argument("--mix", help="weighted commands, e.g. LIST:1,GET:2,PUT:2,NP_SET:4,RELOAD:1")
+    proto.add_argument("--count", type=int, default=200, help="commands to send")
+    proto.add_argument("--size", type=int, default=4096, help="file size for GET/PUT in bytes")
+    proto.add_argument("--depth", type=int, default=1, help="commands kept in flight (pipelining)")
+    proto.add_argument("--legacy", action="store_true", help="emulate the old 1-byte-per-pass, 10 ms tick reader")
+    proto.add_argument("--bytes-per-tick", type=int, default=0, help="limit device reads per pass (0: no limit)")
+    proto.add_argument("--tick", type=float, help="device idle sleep per pass in seconds")
+    proto.add_argument("--layers", help="layers.json for the firmware target")
+    proto.add_argument("--timeout", type=float, default=30.0, help="seconds to wait for each reply")
+    proto.add_argument("--json", help="write results to this file")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run_timeline(args)
+    elif args.command == "bench":
+        from . import bench as bench_mod
+        bench_mod.main(args)
+    elif args.command == "protobench":
+        from . import protobench
+        protobench.main(args)
+    else:
+        parser.print_help()
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""
+Benchmark suite for the firmware running in the simulator.
+
+Numbers are host CPU time, so compare runs from the same machine only; the
+point is catching relative regressions between commits. Simulated-time
+figures (macro chars/s) reflect the firmware's own pacing.
+
+    python -m simulator bench [--quick] [--only idle_loop,macro] [--json out.json]
+"""
+
+import json
+import os
+import tempfile
+import time
+
+from .sim import Simulator
+
+MACRO_TEXT = "The quick brown fox jumps over the lazy dog 0123456789!\n"
+
+
+def _layers_file(layers, macros=None, **extra):
+    data = {"grid_size": 3, "layers": layers}
+    data.update(extra)
+    if macros:
+        data["layers"][0]["macros"] = [{"id": mid, "name": "Macro %d" % mid, "sequence": seq} for mid, seq in macros.items()]
+    fd, path = tempfile.mkstemp(prefix="trkey-bench-", suffix=".json")
+    with os.fdopen(fd, "w") as f:
+        json.dump(data, f)
+    return path
+
+
+def _layer(name, keys):
+    return {"name": name, "labels": [k[:6] for k in keys], "keys": keys}
+
+
+def _basic_layers():
+    return _layers_file([
+        _layer("Base", ["A", "B", "C", "CONTROL_C", "CONTROL_SHIFT_T", "ENTER", "MACRO_1", "MACRO_CANCEL", "TO(1)"]),
+        _layer("Media", ["VOLUME_INCREMENT", "MUTE", "VOLUME_DECREMENT", "SCAN_PREVIOUS_TRACK", "PLAY_PAUSE",
+                         "SCAN_NEXT_TRACK", "", "", "TO(0)"]),
+    ], macros={1: MACRO_TEXT})
+
+
+def _run(layers, duration, schedule=None):
+    sim = Simulator(layers=layers)
+    if schedule:
+        schedule(sim)
+    try:
+        sim.run(duration)
+    finally:
+        sim.cleanup()
+    return sim
+
+
+def bench_idle_loop(quick):
+    """Main loop passes per second of host CPU with no input."""
+    duration = 2.0 if quick else 10.0
+    layers = _basic_layers()
+    try:
+        sim = _run(layers, duration)
+    finally:
+        os.remove(layers)
+    loops = max(sim.passes - 1, 1)
+    return {
+        "passes": sim.passes,
+        "loop_iterations_per_s": round(loops / max(sim.cpu_loop, 1e-9)),
+        "us_per_pass": round(sim.cpu_loop / loops * 1e6, 2),
+    }
+
+
+def bench_key_press(quick):
+    """Extra host CPU per key tap (press, report, release, UI highlight) over an idle pass."""
+    duration = 2.0 if quick else 10.0
+    keys = (0, 1, 2, 3, 4, 5)
+    layers = _basic_layers()
+    try:
+        idle = _run(layers, duration)
+
+        def schedule(sim):
+            t = 0.05
+            n = 0
+            while t < duration - 0.1:
+                sim.tap(t, keys[n % len(keys)], hold=0.02)
+                t += 0.05
+                n += 1
+            schedule.taps = n
+
+        busy = _run(layers, duration, schedule)
+    finally:
+        os.remove(layers)
+    idle_pass = idle.cpu_loop / max(idle.passes - 1, 1)
+    extra = busy.cpu_loop - idle_pass * max(busy.passes - 1, 1)
+    return {
+        "taps": schedule.taps,
+        "hid_reports": len(busy.hid),
+        "us_per_press": round(extra / schedule.taps * 1e6, 2),
+    }
+
+
+def bench_macro(quick):
+    """Macro typing: characters per simulated second and host CPU per character."""
+    repeat = 4 if quick else 16
+    text = MACRO_TEXT * repeat
+    path = _layers_file([_layer("Base", ["MACRO_1", "", "", "", "", "", "", "", ""])], macros={1: text})
+    try:
+        sim = Simulator(layers=path)
+        sim.tap(0.05, 0, hold=0.02)
+        try:
+            sim.run(0.1 + len(text) * 0.03)
+        finally:
+            sim.cleanup()
+    finally:
+        os.remove(path)
+    reports = [t for t, dev, _rep in sim.hid if dev == "keyboard"]
+    typed = sim.typed_text()
+    span = (reports[-1] - reports[0]) if len(reports) > 1 else 0.0
+    return {
+        "chars": len(text),
+        "typed_ok": typed == text.strip(),  # the firmware strips macro text
+        "chars_per_s": round(len(typed) / span, 1) if span else 0.0,
+        "reports": len(reports),
+        "cpu_us_per_char": round(sim.cpu_loop / max(len(typed), 1) * 1e6, 2),
+    }
+
+
+def bench_load_layers(quick):
+    """load_layers() for a large config: cold (JSON + cache write) and warm (layers.bin cache)."""
+    n_layers = 16 if quick else 64
+    rounds = 3 if quick else 10
+    names = ["A", "B", "C", "CONTROL_C", "ALT_TAB", "VOLUME_INCREMENT", "MACRO_1", "MO(1)", "TO(0)"]
+    big = [_layer("Layer %d" % i, names[i % 9:] + names[:i % 9]) for i in range(n_layers)]
+    path = _layers_file(big, macros={i: MACRO_TEXT for i in range(1, 33)})
+    try:
+        sim = Simulator(layers=path)
+        sim.run(0.01)
+        cold = []
+        warm = []
+        with sim.patched() as g:
+            for _ in range(rounds):
+                try:
+                    os.remove("/layers.bin")
+                except OSError:
+                    pass
+                started = time.perf_counter()
+                g["load_layers"]()
+                cold.append(time.perf_counter() - started)
+                started = time.perf_counter()
+                g["load_layers"]()
+                warm.append(time.perf_counter() - started)
+        sim.cleanup()
+    finally:
+        os.remove(path)
+    cold.sort()
+    warm.sort()
+    return {
+        "layers": n_layers,
+        "cold_ms": round(cold[len(cold) // 2] * 1000, 3),
+        "warm_ms": round(warm[len(warm) // 2] * 1000, 3),
+        "boot_ms": round(sim.cpu_boot * 1000, 3),
+    }
+
+
+BENCHMARKS = {
+    "idle_loop": bench_idle_loop,
+    "key_press": bench_key_press,
+    "macro": bench_macro,
+    "load_layers": bench_load_layers,
+}
+
+
+def main(args):
+    names = args.only.split(",") if args.only else list(BENCHMARKS)
+    results = {}
+    for name in names:
+        result = BENCHMARKS[name](args.quick)
+        results[name] = result
+        print(name + ": " + " ".join(f"{k}={v}" for k, v in result.items()))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Wrote {args.json}")
+    return results
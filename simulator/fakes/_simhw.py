@@ -0,0 +1,39 @@
+# _simhw.py
+#
+# State shared by the stand-in CircuitPython modules in this directory. The
+# Simulator installs a fresh Hardware as `current` before running code.py;
+# the fakes look it up on every call, so they can be imported once and
+# reused across runs.
+
+
+class Hardware:
+    def __init__(self, clock=None):
+        self.clock = clock or (lambda: 0.0)
+        self.levels = {}        # pin name -> level (pull-ups: True while released)
+        self.pin_listeners = []  # callables(name, level), e.g. keypad.Keys
+        self.hid = []           # (t, device name, report bytes)
+        self.frames = []        # (t, ((x, y, text, color), ...))
+        self.cdc_in = bytearray()
+        self.cdc_out = bytearray()
+        self.cdc_log = []       # (t, bytes) per write
+        self.passes = 0         # usb_cdc.console.in_waiting reads, once per main loop pass
+        self.display = None     # the SSD1306 created by code.py
+        self.display_dirty = False
+        self.power_log = []     # (t, event, value): display brightness/sleep/wake, alarm light sleeps
+        self.i2c_devices = [0x3C]
+
+    def now(self):
+        return self.clock()
+
+    def set_level(self, name, level):
+        if self.levels.get(name, True) == level:
+            return
+        self.levels[name] = level
+        for cb in self.pin_listeners:
+            cb(name, level)
+
+    def level(self, name, default=True):
+        return self.levels.get(name, default)
+
+
+current = Hardware()
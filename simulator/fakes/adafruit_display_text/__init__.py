@@ -0,0 +1 @@
+# adafruit_display_text - stand-in for the Adafruit display text library
@@ -0,0 +1,35 @@
+# label.py - stand-in for adafruit_display_text.label
+
+import _simhw
+
+
+class Label:
+    def __init__(self, font, *, text="", color=0xFFFFFF, x=0, y=0, **kwargs):
+        self.font = font
+        self.x = x
+        self.y = y
+        self.hidden = False
+        self._text = text
+        self._color = color
+        for k in kwargs:
+            setattr(self, k, kwargs[k])
+
+    @property
+    def text(self):
+        return self._text
+
+    @text.setter
+    def text(self, value):
+        if value != self._text:
+            self._text = value
+            _simhw.current.display_dirty = True
+
+    @property
+    def color(self):
+        return self._color
+
+    @color.setter
+    def color(self, value):
+        if value != self._color:
+            self._color = value
+            _simhw.current.display_dirty = True
@@ -0,0 +1,81 @@
+# adafruit_displayio_ssd1306.py - stand-in for the SSD1306 displayio driver
+#
+# Every refresh that finds the screen dirty records a frame: the visible
+# labels of root_group as (x, y, text, color) tuples. With auto_refresh the
+# simulator calls _auto_refresh() about 60 times per simulated second, as
+# the CircuitPython background task would.
+
+import _simhw
+import displayio
+
+AUTO_REFRESH_FPS = 60
+
+
+class SSD1306:
+    def __init__(self, bus, *, width=128, height=64, rotation=0, **kwargs):
+        self.bus = bus
+        self.width = width
+        self.height = height
+        self.rotation = rotation
+        self.auto_refresh = True
+        self._brightness = 1.0
+        self.is_awake = True
+        self._root_group = None
+        self._last_refresh = None
+        self.refreshes = 0
+        _simhw.current.display = self
+
+    @property
+    def root_group(self):
+        return self._root_group
+
+    @root_group.setter
+    def root_group(self, group):
+        self._root_group = group
+        _simhw.current.display_dirty = True
+
+    def _capture(self):
+        hw = _simhw.current
+        now = hw.now()
+        self._last_refresh = now
+        if hw.display_dirty:
+            hw.display_dirty = False
+            hw.frames.append((now, displayio.snapshot(self._root_group)))
+            self.refreshes += 1
+
+    def _auto_refresh(self):
+        if not self.auto_refresh or not _simhw.current.display_dirty:
+            return
+        now = _simhw.current.now()
+        if self._last_refresh is None or now - self._last_refresh >= 1 / AUTO_REFRESH_FPS:
+            self._capture()
+
+    def refresh(self, *, target_frames_per_second=None, minimum_frames_per_second=0):
+        now = _simhw.current.now()
+        if (target_frames_per_second and self._last_refresh is not None
+                and now - self._last_refresh < 1 / target_frames_per_second):
+            return False
+        self._capture()
+        return True
+
+    @property
+    def brightness(self):
+        return self._brightness
+
+    @brightness.setter
+    def brightness(self, value):
+        if not 0 <= value <= 1:
+            raise ValueError("brightness must be 0.0-1.0")
+        self._brightness = value
+        hw = _simhw.current
+        hw.power_log.append((hw.now(), "brightness", value))
+
+    def sleep(self):
+        self.is_awake = False
+        hw = _simhw.current
+        hw.power_log.append((hw.now(), "display_sleep", None))
+
+    def wake(self):
+        self.is_awake = True
+        hw = _simhw.current
+        hw.power_log.append((hw.now(), "display_wake", None))
@@ -0,0 +1,8 @@
+# adafruit_hid - stand-in for the Adafruit HID library, built on the fake usb_hid
+
+
+def find_device(devices, *, usage_page, usage, timeout=None):
+    for device in devices:
+        if device.usage_page == usage_page and device.usage == usage:
+            return device
+    raise ValueError("Could not find matching HID device.")
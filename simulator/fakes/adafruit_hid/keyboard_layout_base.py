@@ -0,0 +1,25 @@
+# keyboard_layout_base.py - stand-in for adafruit_hid.keyboard_layout_base
+
+
+class KeyboardLayoutBase:
+    SHIFT_FLAG = 0x80
+    SHIFT_CODE = 0xE1
+    ASCII_TO_KEYCODE = b""
+
+    def __init__(self, keyboard):
+        self.keyboard = keyboard
+
+    def write(self, string, delay=None):
+        for char in string:
+            keycodes = self.keycodes(char)
+            self.keyboard.press(*keycodes)
+            self.keyboard.release_all()
+
+    def keycodes(self, char):
+        code = ord(char)
+        if code >= len(self.ASCII_TO_KEYCODE) or not self.ASCII_TO_KEYCODE[code]:
+            raise ValueError("Unsupported character: " + repr(char))
+        keycode = self.ASCII_TO_KEYCODE[code]
+        if keycode & self.SHIFT_FLAG:
+            return (self.SHIFT_CODE, keycode & ~self.SHIFT_FLAG)
+        return (keycode,)
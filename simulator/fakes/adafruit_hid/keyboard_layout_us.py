@@ -0,0 +1,18 @@
+# keyboard_layout_us.py - stand-in for adafruit_hid.keyboard_layout_us
+
+from .keyboard_layout_base import KeyboardLayoutBase
+
+
+class KeyboardLayoutUS(KeyboardLayoutBase):
+    """US layout: ASCII code -> keycode, with 0x80 set where SHIFT is needed."""
+
+    ASCII_TO_KEYCODE = (
+        b"\x00\x00\x00\x00\x00\x00\x00\x00\x2a\x2b\x28\x00\x00\x00\x00\x00"
+        b"\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x29\x00\x00\x00\x00"
+        b"\x2c\x9e\xb4\xa0\xa1\xa2\xa4\x34\xa6\xa7\xa5\xae\x36\x2d\x37\x38"
+        b"\x27\x1e\x1f\x20\x21\x22\x23\x24\x25\x26\xb3\x33\xb6\x2e\xb7\xb8"
+        b"\x9f\x84\x85\x86\x87\x88\x89\x8a\x8b\x8c\x8d\x8e\x8f\x90\x91\x92"
+        b"\x93\x94\x95\x96\x97\x98\x99\x9a\x9b\x9c\x9d\x2f\x31\x30\xa3\xad"
+        b"\x35\x04\x05\x06\x07\x08\x09\x0a\x0b\x0c\x0d\x0e\x0f\x10\x11\x12"
+        b"\x13\x14\x15\x16\x17\x18\x19\x1a\x1b\x1c\x1d\xaf\xb1\xb0\xb5\x4c"
+    )
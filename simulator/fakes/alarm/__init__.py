@@ -0,0 +1,52 @@
+# alarm - stand-in for CircuitPython's alarm module (light sleep only)
+#
+# light_sleep_until_alarms() advances simulated time in small steps until a
+# pin alarm's pin reaches its level or a time alarm is due, and returns that
+# alarm, as on hardware. Sleeps and wakes are logged in _simhw power_log.
+
+import time as _time
+
+import _simhw
+
+from . import pin
+from . import time
+
+STEP = 0.002  # simulated seconds per check while asleep
+
+wake_alarm = None
+
+
+def light_sleep_until_alarms(*alarms):
+    global wake_alarm
+    hw = _simhw.current
+    pins = [a for a in alarms if isinstance(a, pin.PinAlarm)]
+    timers = [a for a in alarms if isinstance(a, time.TimeAlarm)]
+    for a in pins:
+        a._claim()
+    woke = []
+
+    def listener(name, level):
+        for a in pins:
+            if a.pin.name == name and level == a.value and not woke:
+                woke.append(a)
+
+    for a in pins:
+        if hw.level(a.pin.name) == a.value:
+            woke.append(a)
+            break
+    hw.pin_listeners.append(listener)
+    hw.power_log.append((hw.now(), "light_sleep", len(alarms)))
+    try:
+        while not woke:
+            now = _time.monotonic()
+            for a in timers:
+                if now >= a.monotonic_time:
+                    woke.append(a)
+                    break
+            else:
+                _time.sleep(STEP)
+    finally:
+        hw.pin_listeners.remove(listener)
+    wake_alarm = woke[0]
+    hw.power_log.append((hw.now(), "wake", repr(wake_alarm)))
+    return wake_alarm
@@ -0,0 +1,23 @@
+# alarm/pin.py - stand-in for alarm.pin
+
+import _simhw
+
+
+class PinAlarm:
+    def __init__(self, pin, value, edge=False, pull=False):
+        if edge:
+            raise NotImplementedError("edge pin alarms are not supported on RP2040")
+        self.pin = pin
+        self.value = value
+        self.edge = edge
+        self.pull = pull
+
+    def _claim(self):
+        # the pin must not be in use, e.g. by a keypad.Keys that was not deinit()ed
+        for cb in _simhw.current.pin_listeners:
+            names = getattr(getattr(cb, "__self__", None), "_names", ())
+            if self.pin.name in names:
+                raise ValueError("%r in use" % self.pin)
+
+    def __repr__(self):
+        return "<PinAlarm %r>" % self.pin
@@ -0,0 +1,15 @@
+# alarm/time.py - stand-in for alarm.time
+
+import time as _time
+
+
+class TimeAlarm:
+    def __init__(self, *, monotonic_time=None, epoch_time=None):
+        if monotonic_time is None:
+            if epoch_time is None:
+                raise ValueError("monotonic_time or epoch_time required")
+            monotonic_time = _time.monotonic() + epoch_time - _time.time()
+        self.monotonic_time = monotonic_time
+
+    def __repr__(self):
+        return "<TimeAlarm %.3f>" % self.monotonic_time
@@ -0,0 +1,15 @@
+# board.py - stand-in for CircuitPython's board module (Raspberry Pi Pico pins)
+
+
+class Pin:
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return "board." + self.name
+
+
+for _i in range(29):
+    globals()["GP%d" % _i] = Pin("GP%d" % _i)
+LED = GP25  # noqa: F821
+A0, A1, A2 = GP26, GP27, GP28  # noqa: F821
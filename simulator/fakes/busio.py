@@ -0,0 +1,29 @@
+# busio.py - stand-in for CircuitPython's busio module
+
+import _simhw
+
+
+class I2C:
+    def __init__(self, scl, sda, *, frequency=100000, timeout=255):
+        self.scl = scl
+        self.sda = sda
+        self.frequency = frequency
+        self._locked = False
+
+    def try_lock(self):
+        if self._locked:
+            return False
+        self._locked = True
+        return True
+
+    def unlock(self):
+        self._locked = False
+
+    def scan(self):
+        return list(_simhw.current.i2c_devices)
+
+    def writeto(self, address, buffer, *, start=0, end=None):
+        pass
+
+    def deinit(self):
+        pass
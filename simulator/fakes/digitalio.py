@@ -0,0 +1,54 @@
+# digitalio.py - stand-in for CircuitPython's digitalio module
+
+import _simhw
+
+
+class Direction:
+    INPUT = "INPUT"
+    OUTPUT = "OUTPUT"
+
+
+class Pull:
+    UP = "UP"
+    DOWN = "DOWN"
+
+
+class DriveMode:
+    PUSH_PULL = "PUSH_PULL"
+    OPEN_DRAIN = "OPEN_DRAIN"
+
+
+class DigitalInOut:
+    def __init__(self, pin):
+        self.pin = pin
+        self.direction = Direction.INPUT
+        self.pull = None
+        self.drive_mode = DriveMode.PUSH_PULL
+
+    @property
+    def value(self):
+        # Unconnected inputs read high with a pull-up and low otherwise
+        return _simhw.current.level(self.pin.name, self.pull != Pull.DOWN)
+
+    @value.setter
+    def value(self, level):
+        if self.direction == Direction.OUTPUT:
+            _simhw.current.set_level(self.pin.name, bool(level))
+
+    def switch_to_input(self, pull=None):
+        self.direction = Direction.INPUT
+        self.pull = pull
+
+    def switch_to_output(self, value=False, drive_mode=DriveMode.PUSH_PULL):
+        self.direction = Direction.OUTPUT
+        self.drive_mode = drive_mode
+        self.value = value
+
+    def deinit(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.deinit()
@@ -0,0 +1,139 @@
+# displayio.py - stand-in for CircuitPython's displayio module
+
+import _simhw
+
+
+def release_displays():
+    _simhw.current.display = None
+
+
+def _mark_dirty():
+    _simhw.current.display_dirty = True
+
+
+class Group:
+    def __init__(self, *, scale=1, x=0, y=0):
+        self.scale = scale
+        self.x = x
+        self.y = y
+        self._hidden = False
+        self._items = []
+
+    @property
+    def hidden(self):
+        return self._hidden
+
+    @hidden.setter
+    def hidden(self, value):
+        if bool(value) != self._hidden:
+            self._hidden = bool(value)
+            _mark_dirty()
+
+    def append(self, item):
+        self._items.append(item)
+        _mark_dirty()
+
+    def insert(self, index, item):
+        self._items.insert(index, item)
+        _mark_dirty()
+
+    def remove(self, item):
+        self._items.remove(item)
+        _mark_dirty()
+
+    def pop(self, index=-1):
+        _mark_dirty()
+        return self._items.pop(index)
+
+    def index(self, item):
+        return self._items.index(item)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, index):
+        return self._items[index]
+
+    def __setitem__(self, index, item):
+        self._items[index] = item
+        _mark_dirty()
+
+    def __delitem__(self, index):
+        del self._items[index]
+        _mark_dirty()
+
+    def __iter__(self):
+        return iter(self._items)
+
+
+def snapshot(group, x=0, y=0, out=None):
+    """Visible text of a group tree as a tuple of (x, y, text, color)."""
+    if out is None:
+        out = []
+    if group is None or getattr(group, "hidden", False):
+        return tuple(out)
+    x += group.x
+    y += group.y
+    for item in group:
+        if isinstance(item, Group):
+            snapshot(item, x, y, out)
+        elif not getattr(item, "hidden", False) and hasattr(item, "text"):
+            out.append((x + item.x, y + item.y, item.text, item.color))
+    return tuple(out)
+
+
+class I2CDisplay:
+    def __init__(self, i2c_bus, *, device_address, reset=None):
+        self.i2c_bus = i2c_bus
+        self.device_address = device_address
+
+    def send(self, command, data):
+        pass
+
+    def reset(self):
+        pass
+
+
+class Bitmap:
+    def __init__(self, width, height, value_count):
+        self.width = width
+        self.height = height
+        self._data = bytearray(width * height)
+
+    def __getitem__(self, xy):
+        x, y = xy
+        return self._data[y * self.width + x]
+
+    def __setitem__(self, xy, value):
+        x, y = xy
+        self._data[y * self.width + x] = value
+        _mark_dirty()
+
+    def fill(self, value):
+        for i in range(len(self._data)):
+            self._data[i] = value
+        _mark_dirty()
+
+
+class Palette:
+    def __init__(self, color_count):
+        self._colors = [0] * color_count
+
+    def __getitem__(self, index):
+        return self._colors[index]
+
+    def __setitem__(self, index, color):
+        self._colors[index] = color
+        _mark_dirty()
+
+    def __len__(self):
+        return len(self._colors)
+
+
+class TileGrid:
+    def __init__(self, bitmap, *, pixel_shader, x=0, y=0, **kwargs):
+        self.bitmap = bitmap
+        self.pixel_shader = pixel_shader
+        self.x = x
+        self.y = y
+        self.hidden = False
@@ -0,0 +1,94 @@
+# keypad.py - stand-in for CircuitPython's keypad module
+#
+# Real keypad.Keys scans in the background; here pin changes made by the
+# simulator are turned into events as they happen, so a press and release
+# between two main loop passes are both queued, like on hardware.
+
+import _simhw
+
+
+class Event:
+    def __init__(self, key_number=0, pressed=True, timestamp=None):
+        self.key_number = key_number
+        self.pressed = pressed
+        self.timestamp = timestamp
+
+    @property
+    def released(self):
+        return not self.pressed
+
+    def __eq__(self, other):
+        return self.key_number == other.key_number and self.pressed == other.pressed
+
+    def __repr__(self):
+        return "<Event: key_number %d %s>" % (self.key_number, "pressed" if self.pressed else "released")
+
+
+class EventQueue:
+    def __init__(self, max_events):
+        self.max_events = max_events
+        self._events = []
+        self.overflowed = False
+
+    def _put(self, key_number, pressed, timestamp):
+        if len(self._events) >= self.max_events:
+            self.overflowed = True
+            return
+        self._events.append((key_number, pressed, timestamp))
+
+    def get(self):
+        if not self._events:
+            return None
+        key_number, pressed, timestamp = self._events.pop(0)
+        return Event(key_number, pressed, timestamp)
+
+    def get_into(self, event):
+        if not self._events:
+            return False
+        event.key_number, event.pressed, event.timestamp = self._events.pop(0)
+        return True
+
+    def clear(self):
+        self._events = []
+        self.overflowed = False
+
+    def __len__(self):
+        return len(self._events)
+
+    def __bool__(self):
+        return bool(self._events)
+
+
+class Keys:
+    def __init__(self, pins, *, value_when_pressed, pull=True, interval=0.02, max_events=64):
+        self._names = [p.name for p in pins]
+        self._value_when_pressed = value_when_pressed
+        self.interval = interval
+        self.key_count = len(pins)
+        self.events = EventQueue(max_events)
+        self._hw = _simhw.current
+        self._hw.pin_listeners.append(self._pin_changed)
+        self.reset()  # like hardware, keys already down are reported on the first scan
+
+    def _pressed(self, name):
+        return self._hw.level(name) == self._value_when_pressed
+
+    def _pin_changed(self, name, level):
+        for i, n in enumerate(self._names):
+            if n == name:
+                pressed = level == self._value_when_pressed
+                if pressed != self._state[i]:
+                    self._state[i] = pressed
+                    self.events._put(i, pressed, int(self._hw.now() * 1000))
+
+    def reset(self):
+        # keys that are down are reported as pressed again
+        self._state = [False] * self.key_count
+        for i, n in enumerate(self._names):
+            if self._pressed(n):
+                self._state[i] = True
+                self.events._put(i, True, int(self._hw.now() * 1000))
+
+    def deinit(self):
+        if self._pin_changed in self._hw.pin_listeners:
+            self._hw.pin_listeners.remove(self._pin_changed)
@@ -0,0 +1,9 @@
+# terminalio.py - stand-in for CircuitPython's terminalio module
+
+
+class _BuiltinFont:
+    def get_bounding_box(self):
+        return (6, 12)
+
+
+FONT = _BuiltinFont()
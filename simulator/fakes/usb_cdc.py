@@ -0,0 +1,70 @@
+# usb_cdc.py - stand-in for CircuitPython's usb_cdc module
+#
+# console reads from and writes to the simulated hardware's CDC buffers.
+# Each in_waiting read counts as one main loop pass (CDCTransport.poll
+# checks it exactly once per process_usb_cdc call).
+
+import _simhw
+
+
+class Serial:
+    def __init__(self):
+        self.timeout = 1
+        self.write_timeout = None
+
+    @property
+    def connected(self):
+        return True
+
+    @property
+    def in_waiting(self):
+        hw = _simhw.current
+        hw.passes += 1
+        return len(hw.cdc_in)
+
+    @property
+    def out_waiting(self):
+        return 0
+
+    def read(self, size=1):
+        buf = _simhw.current.cdc_in
+        data = bytes(buf[:size])
+        del buf[:size]
+        return data
+
+    def readinto(self, buf):
+        src = _simhw.current.cdc_in
+        n = min(len(buf), len(src))
+        buf[:n] = src[:n]
+        del src[:n]
+        return n
+
+    def readline(self, size=-1):
+        src = _simhw.current.cdc_in
+        idx = src.find(b"\n")
+        n = len(src) if idx < 0 else idx + 1
+        if size >= 0:
+            n = min(n, size)
+        data = bytes(src[:n])
+        del src[:n]
+        return data
+
+    def write(self, data):
+        hw = _simhw.current
+        data = bytes(data)
+        hw.cdc_out += data
+        hw.cdc_log.append((hw.now(), data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def reset_input_buffer(self):
+        del _simhw.current.cdc_in[:]
+
+    def reset_output_buffer(self):
+        pass
+
+
+console = Serial()
+data = None
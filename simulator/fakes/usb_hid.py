@@ -0,0 +1,39 @@
+# usb_hid.py - stand-in for CircuitPython's usb_hid module
+#
+# Reports sent through a Device are recorded on the simulated hardware as
+# (t, device name, report bytes).
+
+import _simhw
+
+
+class Device:
+    def __init__(self, *, name, usage_page, usage, report_length):
+        self.name = name
+        self.usage_page = usage_page
+        self.usage = usage
+        self.report_length = report_length
+
+    def send_report(self, report, report_id=None):
+        hw = _simhw.current
+        hw.hid.append((hw.now(), self.name, bytes(report)))
+
+    def get_last_received_report(self, report_id=None):
+        return None
+
+    def __repr__(self):
+        return "<usb_hid.Device %s>" % self.name
+
+
+Device.KEYBOARD = Device(name="keyboard", usage_page=0x01, usage=0x06, report_length=8)
+Device.MOUSE = Device(name="mouse", usage_page=0x01, usage=0x02, report_length=4)
+Device.CONSUMER_CONTROL = Device(name="consumer", usage_page=0x0C, usage=0x01, report_length=2)
+
+devices = (Device.KEYBOARD, Device.MOUSE, Device.CONSUMER_CONTROL)
+
+
+def enable(devices, boot_device=0):
+    pass
+
+
+def disable():
+    pass
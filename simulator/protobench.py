@@ -0,0 +1,321 @@
+"""
+Protocol throughput benchmark against the pty stand-in (simulator/ptydevice.py).
+
+Sends a configurable mix of text commands, keeps up to `depth` of them in
+flight and reports commands/s, payload bytes/s and per-command latency
+percentiles.
+
+    python -m simulator protobench --target firmware --mix LIST:1,GET:2,PUT:2,NP_SET:4,RELOAD:1 \\
+        --count 200 --size 4096 --depth 4 [--legacy] [--json out.json]
+"""
+
+import json
+import os
+import random
+import select
+import subprocess
+import sys
+import threading
+import time
+import tty
+import zlib
+
+from .sim import REPO
+
+sys.path.insert(0, os.path.join(REPO, "lib"))
+import ztransfer  # noqa: E402
+sys.path.remove(os.path.join(REPO, "lib"))
+
+DEFAULT_MIX = {
+    "firmware": "LIST:1,GET:2,PUT:2,NP_SET:4,RELOAD:1",
+    "server": "LIST:1,GET:2,PUT:2",
+}
+
+
+class RawPort:
+    """Minimal serial port on a pty path: writes plus a background reader that never lets the device block."""
+
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDWR | os.O_NOCTTY)
+        tty.setraw(self.fd)
+        self.buf = bytearray()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.rx_bytes = 0
+        self.tx_bytes = 0
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._reader.start()
+
+    def _read_loop(self):
+        while not self.closed:
+            ready, _, _ = select.select([self.fd], [], [], 0.1)
+            if not ready:
+                continue
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError:
+                return
+            with self.cond:
+                self.buf += data
+                self.rx_bytes += len(data)
+                self.cond.notify_all()
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            n = os.write(self.fd, view)
+            view = view[n:]
+        self.tx_bytes += len(data)
+
+    def read_until(self, marker, timeout):
+        """Bytes up to and including marker, or None on timeout."""
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while True:
+                idx = self.buf.find(marker)
+                if idx >= 0:
+                    end = idx + len(marker)
+                    data = bytes(self.buf[:end])
+                    del self.buf[:end]
+                    return data
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+
+    def read_exact(self, n, timeout):
+        """Exactly n bytes, or None on timeout."""
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while len(self.buf) < n:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+            data = bytes(self.buf[:n])
+            del self.buf[:n]
+            return data
+
+    def readline(self, timeout=1.0):
+        data = self.read_until(b"\n", timeout)
+        return data.decode(errors="replace").rstrip("\r\n") if data is not None else None
+
+    def wait_line(self, prefixes, timeout):
+        """Next line starting with one of prefixes; other lines (device prints) are skipped."""
+        deadline = time.monotonic() + timeout
+        while True:
+            line = self.readline(max(deadline - time.monotonic(), 0.0))
+            if line is None:
+                return None
+            if line.startswith(prefixes):
+                return line
+
+    def close(self):
+        self.closed = True
+        self._reader.join(1.0)
+        os.close(self.fd)
+
+
+def start_device(target, legacy=False, bytes_per_tick=0, tick=None, layers=None):
+    cmd = [sys.executable, "-m", "simulator.ptydevice", "--target", target]
+    if legacy:
+        cmd.append("--legacy")
+    else:
+        cmd += ["--bytes-per-tick", str(bytes_per_tick)]
+        if tick is not None:
+            cmd += ["--tick", str(tick)]
+    if layers:
+        cmd += ["--layers", os.path.abspath(layers)]
+    proc = subprocess.Popen(cmd, cwd=REPO, stdout=subprocess.PIPE, text=True)
+    line = proc.stdout.readline()
+    if not line.startswith("PTY "):
+        proc.kill()
+        raise RuntimeError("device stand-in failed to start")
+    return proc, line.split(" ", 1)[1].strip()
+
+
+def parse_mix(spec):
+    mix = []
+    for part in spec.split(","):
+        name, _, weight = part.partition(":")
+        mix.append((name.strip().upper(), float(weight or 1)))
+    return mix
+
+
+class Workload:
+    """Builds each command's request bytes and knows how to read its reply."""
+
+    def __init__(self, size, seed=1):
+        rnd = random.Random(seed)
+        # printable payload that cannot contain the <EOF> marker
+        self.payload = bytes(rnd.choice(b"abcdefghijklmnopqrstuvwxyz0123456789 \n") for _ in range(size))
+        self.crc = zlib.crc32(self.payload) & 0xFFFFFFFF
+        self.n = 0
+
+    def request(self, name):
+        """Returns (bytes to send, payload bytes counted towards throughput)."""
+        self.n += 1
+        if name == "LIST":
+            return b"LIST\n", 0
+        if name == "GET":
+            return b"GET bench.dat\n", len(self.payload)
+        if name == "GETR":
+            off, n = self.range()
+            return b"GET bench.dat %d %d\n" % (off, n), n
+        if name == "GETZ":
+            return b"GETZ bench.dat\n", len(self.payload)
+        if name == "PUT":
+            return b"PUT bench.dat\n" + self.payload + b"<EOF>", len(self.payload)
+        if name == "NP_SET":
+            np = {"title": "Track %d" % self.n, "artist": "Bench", "source": "bench", "position": self.n % 300, "duration": 300}
+            return ("NP_SET " + json.dumps(np) + "\n").encode(), 0
+        if name == "NP_GET":
+            return b"NP_GET\n", 0
+        if name == "RELOAD":
+            return b"RELOAD\n", 0
+        if name == "STATS":
+            return b"STATS\n", 0
+        raise ValueError("unknown command in mix: " + name)
+
+    def range(self):
+        """A 256-byte window that moves with the command count."""
+        n = min(256, len(self.payload))
+        return (self.n * 97) % (len(self.payload) - n + 1), n
+
+    def reply(self, port, name, timeout):
+        """Consume the reply; returns True if it was a success reply."""
+        if name == "LIST" or name == "STATS":
+            return port.wait_line(("<END>", "ERROR", "UNKNOWN"), timeout) == "<END>"
+        if name == "GET":
+            data = port.read_until(b"<EOF>\n", timeout)
+            return data is not None and data[:-6].endswith(self.payload)
+        if name == "GETR":
+            off, n = self.range()
+            data = port.read_until(b"<EOF>\n", timeout)
+            return data is not None and data[:-6] == self.payload[off:off + n]
+        if name == "GETZ":
+            head = port.wait_line(("ZDATA", "ERROR", "UNKNOWN"), timeout)
+            if not head or not head.startswith("ZDATA"):
+                return False
+            stream = bytearray()
+            while True:
+                hdr = port.read_exact(2, timeout)
+                if hdr is None:
+                    return False
+                stream += hdr
+                size = (hdr[0] | hdr[1] << 8) & 0x7FFF
+                if not size:
+                    break
+                body = port.read_exact(size, timeout)
+                if body is None:
+                    return False
+                stream += body
+            if port.read_until(b"<EOF>\n", timeout) is None:
+                return False
+            return ztransfer.inflate_blocks(stream) == self.payload
+        if name == "PUT":
+            if port.wait_line(("READY", "ERROR", "UNKNOWN"), timeout) != "READY":
+                return False
+            return port.wait_line(("FILE RECEIVED", "ERROR"), timeout) == "FILE RECEIVED"
+        if name == "NP_SET":
+            return port.wait_line(("NP_OK", "ERROR", "UNKNOWN"), timeout) == "NP_OK"
+        if name == "NP_GET":
+            line = port.wait_line(("{", "ERROR", "UNKNOWN"), timeout)
+            return bool(line) and line.startswith("{")
+        if name == "RELOAD":
+            return port.wait_line(("LAYERS RELOADED", "ERROR", "UNKNOWN"), timeout) == "LAYERS RELOADED"
+        return False
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, max(0, int(round(pct / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[idx]
+
+
+def run(port, mix, count, size, depth, timeout=30.0, seed=1):
+    work = Workload(size, seed)
+    rnd = random.Random(seed)
+    names = [m[0] for m in mix]
+    weights = [m[1] for m in mix]
+    plan = [rnd.choices(names, weights)[0] for _ in range(count)]
+
+    # GET needs the file to exist
+    port.write(work.request("PUT")[0])
+    if not work.reply(port, "PUT", timeout):
+        raise RuntimeError("initial PUT bench.dat failed")
+
+    latencies = {name: [] for name in names}
+    failures = {name: 0 for name in names}
+    in_flight = []
+    payload_bytes = 0
+    sent = 0
+    rx0, tx0 = port.rx_bytes, port.tx_bytes
+    started = time.perf_counter()
+    while sent < count or in_flight:
+        while sent < count and len(in_flight) < depth:
+            name = plan[sent]
+            data, nbytes = work.request(name)
+            in_flight.append((name, time.perf_counter()))
+            port.write(data)
+            payload_bytes += nbytes
+            sent += 1
+        name, t0 = in_flight.pop(0)
+        ok = work.reply(port, name, timeout)
+        latencies[name].append(time.perf_counter() - t0)
+        if not ok:
+            failures[name] += 1
+    elapsed = time.perf_counter() - started
+
+    result = {
+        "commands": count,
+        "depth": depth,
+        "size": size,
+        "elapsed_s": round(elapsed, 4),
+        "commands_per_s": round(count / elapsed, 1),
+        "payload_bytes_per_s": round(payload_bytes / elapsed),
+        "wire_bytes_per_s": round((port.rx_bytes - rx0 + port.tx_bytes - tx0) / elapsed),
+        "per_command": {},
+    }
+    for name in names:
+        lat = sorted(latencies[name])
+        if not lat:
+            continue
+        result["per_command"][name] = {
+            "n": len(lat),
+            "failed": failures[name],
+            "p50_ms": round(percentile(lat, 50) * 1000, 3),
+            "p90_ms": round(percentile(lat, 90) * 1000, 3),
+            "p99_ms": round(percentile(lat, 99) * 1000, 3),
+            "max_ms": round(lat[-1] * 1000, 3),
+        }
+    return result
+
+
+def main(args):
+    mix = parse_mix(args.mix or DEFAULT_MIX[args.target])
+    proc, path = start_device(args.target, legacy=args.legacy, bytes_per_tick=args.bytes_per_tick,
+                              tick=args.tick, layers=args.layers)
+    port = RawPort(path)
+    try:
+        result = run(port, mix, args.count, args.size, args.depth, timeout=args.timeout)
+    finally:
+        port.close()
+        proc.terminate()
+        proc.wait()
+    result["target"] = args.target
+    result["legacy"] = bool(args.legacy)
+
+    print(f"target={args.target} legacy={result['legacy']} commands={result['commands']} depth={result['depth']} "
+          f"size={result['size']} elapsed={result['elapsed_s']}s")
+    print(f"commands/s={result['commands_per_s']} payload B/s={result['payload_bytes_per_s']} "
+          f"wire B/s={result['wire_bytes_per_s']}")
+    for name, s in result["per_command"].items():
+        print(f"  {name:7} n={s['n']:<5} failed={s['failed']:<3} p50={s['p50_ms']}ms p90={s['p90_ms']}ms "
+              f"p99={s['p99_ms']}ms max={s['max_ms']}ms")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"Wrote {args.json}")
+    return result
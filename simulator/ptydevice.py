@@ -0,0 +1,135 @@
+"""
+Pseudo-terminal stand-in for the device's CDC command channel.
+
+Serves either the code.py command handlers (`--target firmware`, booted in
+the simulator) or lib/webserial_fs.USBFileServer (`--target server`) on a
+pty, so host tools can talk to it like a serial port. Prints
+`PTY <path>` once ready.
+
+    python -m simulator.ptydevice --target firmware [--legacy | --bytes-per-tick N --tick S]
+
+`--legacy` emulates the old firmware loop: one byte read per pass and a
+fixed 10 ms sleep every pass.
+"""
+
+import argparse
+import fcntl
+import os
+import select
+import struct
+import sys
+import termios
+import time
+import tty
+
+from .sim import Simulator
+
+
+class PtySerial:
+    """usb_cdc.Serial-compatible wrapper around the pty's device side."""
+
+    def __init__(self, fd, bytes_per_tick=0):
+        self.fd = fd
+        self.bytes_per_tick = bytes_per_tick  # 0: no limit
+        self.rx_bytes = 0
+        self.tx_bytes = 0
+        self.connected = True
+        self.timeout = 0
+
+    @property
+    def in_waiting(self):
+        n = struct.unpack("I", fcntl.ioctl(self.fd, termios.FIONREAD, b"\0\0\0\0"))[0]
+        if self.bytes_per_tick:
+            n = min(n, self.bytes_per_tick)
+        return n
+
+    def read(self, size=1):
+        n = min(size, self.in_waiting)
+        if n <= 0:
+            return b""
+        data = os.read(self.fd, n)
+        self.rx_bytes += len(data)
+        return data
+
+    def readinto(self, buf):
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def write(self, data):
+        view = memoryview(bytes(data))
+        while view:
+            try:
+                n = os.write(self.fd, view)
+            except BlockingIOError:
+                select.select([], [self.fd], [], 0.1)
+                continue
+            view = view[n:]
+        self.tx_bytes += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def reset_input_buffer(self):
+        termios.tcflush(self.fd, termios.TCIFLUSH)
+
+
+def serve(args):
+    # the device serves the master side; host tools open the slave path like a serial port
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    port = PtySerial(master, bytes_per_tick=args.bytes_per_tick)
+
+    sim = Simulator(layers=args.layers)
+    if args.target == "firmware":
+        sim.run(0.0)  # boot code.py up to its first main loop sleep
+    sim.realtime = True
+    with sim.patched() as g:
+        if args.target == "firmware":
+            g["cdc"].uart = port
+
+            def poll():
+                g["process_usb_cdc"]()
+                g["flush_layers_if_due"](time.monotonic())
+        else:
+            import webserial_fs
+            server = webserial_fs.USBFileServer(uart=port)
+            poll = server.poll
+
+        sys.__stdout__.write("PTY " + os.ttyname(slave) + "\n")
+        sys.__stdout__.flush()
+        hw = sim.hw
+        while True:
+            before = port.rx_bytes
+            poll()
+            if hw.cdc_out:
+                # device print() output shares the console, as on hardware
+                port.write(hw.cdc_out)
+                del hw.cdc_out[:]
+            if args.legacy_sleep:
+                time.sleep(args.tick)
+            elif port.rx_bytes == before:
+                select.select([master], [], [], args.tick)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m simulator.ptydevice", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--target", choices=("firmware", "server"), default="firmware")
+    parser.add_argument("--layers", help="layers.json to boot with (default: the repo's)")
+    parser.add_argument("--bytes-per-tick", type=int, default=0, help="max bytes read per pass (0: no limit)")
+    parser.add_argument("--tick", type=float, default=0.002, help="idle sleep per pass in seconds")
+    parser.add_argument("--legacy", action="store_true", help="emulate 1 byte per pass and a 10 ms sleep every pass")
+    args = parser.parse_args(argv)
+    args.legacy_sleep = args.legacy
+    if args.legacy:
+        args.bytes_per_tick = 1
+        args.tick = 0.01
+    try:
+        serve(args)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
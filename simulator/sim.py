@@ -0,0 +1,337 @@
+"""
+Run the unmodified CircuitPython code.py on CPython.
+
+The stand-in modules in simulator/fakes replace board, digitalio, keypad,
+busio, displayio, usb_hid, usb_cdc, adafruit_hid and the SSD1306 driver.
+Time is virtual: it only advances when code.py calls time.sleep(), and
+scheduled key presses and CDC input are delivered from there.
+"""
+
+import builtins
+import heapq
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FAKES = os.path.join(HERE, "fakes")
+REPO = os.path.dirname(HERE)
+
+sys.path.insert(0, FAKES)
+import _simhw  # noqa: E402
+from adafruit_hid.keyboard_layout_us import KeyboardLayoutUS  # noqa: E402
+sys.path.remove(FAKES)
+
+# Key index 0-8 -> switch pin (see button_pins in code.py); "layer" is the GP15 button
+KEY_PINS = ["GP2", "GP3", "GP4", "GP5", "GP6", "GP7", "GP8", "GP9", "GP10"]
+LAYER_PIN = "GP15"
+
+
+class SimulationDone(BaseException):
+    """Raised from the fake time.sleep to leave code.py's main loop (not caught by `except Exception`)."""
+
+
+def pin_name(key):
+    if key == "layer":
+        return LAYER_PIN
+    if isinstance(key, int):
+        return KEY_PINS[key]
+    return str(key)
+
+
+class _Console(io.TextIOBase):
+    """print() from code.py goes to the CDC console, as on the device."""
+
+    def __init__(self, hw, echo=None):
+        self.hw = hw
+        self.echo = echo
+
+    def write(self, text):
+        data = text.encode()
+        self.hw.cdc_out += data
+        self.hw.cdc_log.append((self.hw.now(), data))
+        if self.echo:
+            self.echo.write(text)
+        return len(text)
+
+
+class Simulator:
+    """
+    One simulated device boot.
+
+    Schedule input with press/release/tap/send (times in seconds from boot),
+    then run(duration). Afterwards hid, frames, cdc_output and passes hold
+    what the firmware produced; call into code.py's globals with
+    `with sim.patched(): sim.globals["load_layers"]()`.
+    """
+
+    def __init__(self, repo=REPO, layers=None, files=None, use_keypad=True, echo=False):
+        self.repo = repo
+        self.lib = os.path.join(repo, "lib")
+        self.use_keypad = use_keypad
+        self.echo = echo
+        self.drive = tempfile.mkdtemp(prefix="trkey-sim-")  # CIRCUITPY root
+        shutil.copy(layers or os.path.join(repo, "layers.json"), os.path.join(self.drive, "layers.json"))
+        for name in files or {}:
+            data = files[name]
+            with open(os.path.join(self.drive, name), "wb") as f:
+                f.write(data.encode() if isinstance(data, str) else data)
+
+        self.hw = _simhw.Hardware(clock=self.now)
+        self.globals = None
+        self.start = 1000.0  # device uptime at boot, like a board that has been up a while
+        self._now = self.start
+        self._end = None
+        self._events = []
+        self._seq = 0
+        self.max_passes = None
+        self.realtime = False  # True: leave the host clock alone in patched() (see ptydevice.py)
+        self.cpu_boot = 0.0
+        self.cpu_loop = 0.0
+        self._cpu_start = None
+        self._cpu_first_sleep = None
+        self._saved = None
+        self._host_roots = set(os.listdir("/"))
+
+    # --- clock ---
+    def now(self):
+        return self._now
+
+    def elapsed(self):
+        return self._now - self.start
+
+    def _monotonic_ns(self):
+        return int(self._now * 1000000000)
+
+    def _sleep(self, seconds):
+        if self._cpu_first_sleep is None:
+            self._cpu_first_sleep = time.perf_counter()
+        self._now += max(seconds, 0.0)
+        self._fire_due()
+        if self.hw.display is not None:
+            self.hw.display._auto_refresh()
+        if self._end is not None and self._now >= self._end:
+            raise SimulationDone()
+        if self.max_passes is not None and self.hw.passes >= self.max_passes:
+            raise SimulationDone()
+
+    # --- timeline ---
+    def at(self, t, fn, *args):
+        """Call fn(*args) at t seconds after boot (from the first sleep at or past t)."""
+        heapq.heappush(self._events, (self.start + t, self._seq, fn, args))
+        self._seq += 1
+
+    def _fire_due(self):
+        while self._events and self._events[0][0] <= self._now:
+            _t, _seq, fn, args = heapq.heappop(self._events)
+            fn(*args)
+
+    def set_key(self, key, down):
+        self.hw.set_level(pin_name(key), not down)  # switches pull the pin low
+
+    def press(self, t, key):
+        self.at(t, self.set_key, key, True)
+
+    def release(self, t, key):
+        self.at(t, self.set_key, key, False)
+
+    def tap(self, t, key, hold=0.03):
+        self.press(t, key)
+        self.release(t + hold, key)
+
+    def send(self, t, data):
+        """Queue bytes (or str) on the CDC console at time t."""
+        if isinstance(data, str):
+            data = data.encode()
+        self.at(t, self.hw.cdc_in.extend, data)
+
+    def load_timeline(self, events):
+        """
+        Schedule a list of dicts, e.g.
+        {"t": 0.1, "press": 0}, {"t": 0.2, "release": 0},
+        {"t": 0.3, "tap": "layer", "hold": 0.05}, {"t": 0.5, "cdc": "LIST\\n"}
+        """
+        for ev in events:
+            t = float(ev["t"])
+            if "press" in ev:
+                self.press(t, ev["press"])
+            elif "release" in ev:
+                self.release(t, ev["release"])
+            elif "tap" in ev:
+                self.tap(t, ev["tap"], ev.get("hold", 0.03))
+            elif "cdc" in ev:
+                self.send(t, ev["cdc"])
+            else:
+                raise ValueError("unknown timeline event: %r" % (ev,))
+
+    # --- environment ---
+    def _map(self, path):
+        # Absolute device paths ("/layers.json", "/") live on the simulated drive;
+        # anything under an existing host top-level directory is left alone.
+        if isinstance(path, str) and path.startswith("/"):
+            top = path[1:].split("/", 1)[0]
+            if top not in self._host_roots:
+                return os.path.join(self.drive, path[1:])
+        return path
+
+    def _install(self):
+        saved = {
+            "path": list(sys.path),
+            "cwd": os.getcwd(),
+            "stdout": sys.stdout,
+            "time": (time.monotonic, time.monotonic_ns, time.sleep),
+            "open": builtins.open,
+            "os": (os.listdir, os.remove, os.rename, os.stat, os.mkdir, os.rmdir),
+            "modules": {},
+        }
+        self._saved = saved
+        # Fresh copies of the firmware modules for every run
+        for name in list(sys.modules):
+            mod = sys.modules[name]
+            f = getattr(mod, "__file__", None) or ""
+            if f.startswith(self.lib) or name == "keypad":
+                saved["modules"][name] = sys.modules.pop(name)
+        if not self.use_keypad:
+            sys.modules["keypad"] = None
+
+        sys.path[:0] = [FAKES, self.lib]
+        os.chdir(self.drive)
+        _simhw.current = self.hw
+        sys.stdout = _Console(self.hw, echo=saved["stdout"] if self.echo else None)
+        if not self.realtime:
+            time.monotonic = self.now
+            time.monotonic_ns = self._monotonic_ns
+            time.sleep = self._sleep
+
+        real_open = saved["open"]
+        listdir, remove, rename, stat, mkdir, rmdir = saved["os"]
+        m = self._map
+        builtins.open = lambda p, *a, **k: real_open(m(p), *a, **k)
+        os.listdir = lambda p=".": listdir(m(p))
+        os.remove = lambda p: remove(m(p))
+        os.rename = lambda a, b: rename(m(a), m(b))
+        os.stat = lambda p, *a, **k: stat(m(p), *a, **k)
+        os.mkdir = lambda p, *a: mkdir(m(p), *a)
+        os.rmdir = lambda p: rmdir(m(p))
+
+    def _uninstall(self):
+        saved = self._saved
+        time.monotonic, time.monotonic_ns, time.sleep = saved["time"]
+        builtins.open = saved["open"]
+        os.listdir, os.remove, os.rename, os.stat, os.mkdir, os.rmdir = saved["os"]
+        sys.stdout = saved["stdout"]
+        os.chdir(saved["cwd"])
+        sys.path[:] = saved["path"]
+        if sys.modules.get("keypad", 0) is None:
+            del sys.modules["keypad"]
+        for name in saved["modules"]:
+            sys.modules.setdefault(name, saved["modules"][name])
+        self._saved = None
+
+    def patched(self):
+        """Context manager that re-installs the simulated environment, e.g. to call code.py functions after run()."""
+        sim = self
+
+        class _Patched:
+            def __enter__(self):
+                sim._install()
+                return sim.globals
+
+            def __exit__(self, *exc):
+                sim._uninstall()
+
+        return _Patched()
+
+    # --- run ---
+    def run(self, duration, max_passes=None):
+        """Boot code.py and run its main loop for `duration` simulated seconds."""
+        self._end = self.start + duration
+        self.max_passes = max_passes
+        with open(os.path.join(self.repo, "code.py")) as f:
+            code = compile(f.read(), os.path.join(self.repo, "code.py"), "exec")
+        self.globals = {"__name__": "__main__", "__file__": "code.py"}
+        self._install()
+        self._cpu_start = time.perf_counter()
+        try:
+            exec(code, self.globals)
+        except SimulationDone:
+            pass
+        finally:
+            done = time.perf_counter()
+            first = self._cpu_first_sleep or done
+            self.cpu_boot = first - self._cpu_start
+            self.cpu_loop = done - first
+            self._uninstall()
+        return self
+
+    # --- results ---
+    @property
+    def passes(self):
+        return self.hw.passes
+
+    @property
+    def hid(self):
+        """(t, device, report) with t in seconds since boot."""
+        return [(t - self.start, dev, rep) for t, dev, rep in self.hw.hid]
+
+    @property
+    def frames(self):
+        return [(t - self.start, labels) for t, labels in self.hw.frames]
+
+    @property
+    def power_log(self):
+        """(t, event, value): display brightness/sleep/wake and alarm light sleeps."""
+        return [(t - self.start, ev, value) for t, ev, value in self.hw.power_log]
+
+    @property
+    def cdc_output(self):
+        return bytes(self.hw.cdc_out)
+
+    def cdc_lines(self):
+        return self.cdc_output.decode(errors="replace").splitlines()
+
+    def key_reports(self):
+        """Keyboard reports as (t, modifier_byte, (keycodes...))."""
+        return [(t, rep[0], tuple(k for k in rep[2:] if k)) for t, dev, rep in self.hid if dev == "keyboard"]
+
+    def consumer_codes(self):
+        """Consumer-control usages pressed, in order."""
+        out = []
+        for t, dev, rep in self.hid:
+            if dev == "consumer" and (rep[0] or rep[1]):
+                out.append((t, rep[0] | rep[1] << 8))
+        return out
+
+    def typed_text(self):
+        """Best-effort decode of keyboard reports back to US-layout text."""
+        table = {}
+        codes = KeyboardLayoutUS.ASCII_TO_KEYCODE
+        for ch in range(len(codes) - 1, 0, -1):
+            if codes[ch]:
+                table[codes[ch]] = chr(ch)
+        out = []
+        held = ()
+        for _t, mods, keys in self.key_reports():
+            for k in keys:
+                if k not in held:
+                    code = k | (0x80 if mods & 0x22 else 0)
+                    out.append(table.get(code, "?"))
+            held = keys
+        return "".join(out)
+
+    def summary(self):
+        return {
+            "elapsed": round(self.elapsed(), 6),
+            "passes": self.passes,
+            "hid_reports": len(self.hw.hid),
+            "frames": len(self.hw.frames),
+            "cdc_bytes": len(self.hw.cdc_out),
+            "cpu_boot_s": round(self.cpu_boot, 6),
+            "cpu_loop_s": round(self.cpu_loop, 6),
+        }
+
+    def cleanup(self):
+        shutil.rmtree(self.drive, ignore_errors=True)